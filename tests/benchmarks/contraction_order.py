@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compares the contraction order search strategies on the kernels of the examples.
+
+For every kernel, the estimated cost of each strategy relative to the optimal cost
+and the run time of the search are reported. The report helps to select a strategy
+per kernel, cf. Generator.generate(search_strategy={kernel name: strategy}).
+
+Usage: python3 tests/benchmarks/contraction_order.py [--min-operands N] [example ...]
+"""
+
+import os
+import sys
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'examples'))
+
+import argparse
+import copy
+import importlib
+import time
+from yateto import Generator, useArchitectureIdentifiedBy
+from yateto.ast.cost import BoundingBoxCostEstimator
+from yateto.ast.node import Einsum
+from yateto.ast.opt import DynamicProgramming, Greedy, RandomRestartGreedy, BranchAndBound, SearchStatistics
+from yateto.ast.transformer import EquivalentSparsityPattern
+
+EXAMPLES = ['minimal', 'matmul', 'hosvd', 'optimal_ind', 'seissol_eqspp', 'springer', 'stock', 'tce']
+
+STRATEGIES = [('Greedy', Greedy()),
+              ('Random', RandomRestartGreedy()),
+              ('B&B(1000)', BranchAndBound(nodeLimit=1000))]
+
+def einsums(node):
+  if isinstance(node, Einsum):
+    yield node
+  for child in node:
+    yield from einsums(child)
+
+def search(strategy, nodes):
+  cost = 0
+  statistics = SearchStatistics()
+  start = time.perf_counter()
+  for node in nodes:
+    tree = strategy(list(node), node.indices, BoundingBoxCostEstimator(), statistics)
+    cost += BoundingBoxCostEstimator().estimate(tree)
+  return cost, time.perf_counter() - start, statistics
+
+cmdLineParser = argparse.ArgumentParser()
+cmdLineParser.add_argument('--arch', type=str, default='dhsw')
+cmdLineParser.add_argument('--min-operands', type=int, default=3, help='Skip kernels whose Einsums have fewer operands.')
+cmdLineParser.add_argument('examples', nargs='*', default=EXAMPLES)
+cmdLineArgs = cmdLineParser.parse_args()
+
+# Some examples load matrices relative to the examples folder
+os.chdir(os.path.join(root, 'examples'))
+
+header = ['Example', 'Kernel', 'Operands', 'Optimal cost', 'Optimal [s]']
+for name, _ in STRATEGIES:
+  header += ['{} cost'.format(name), '{} [s]'.format(name)]
+rows = [header]
+for example in cmdLineArgs.examples:
+  arch = useArchitectureIdentifiedBy(cmdLineArgs.arch)
+  generator = Generator(arch)
+  importlib.import_module(example).add(generator)
+  for kernel in generator.kernels():
+    kernel.prepareUntilUnitTest(unitTest=False)
+    nodes = [node for ast in kernel.ast for node in einsums(EquivalentSparsityPattern().visit(copy.deepcopy(ast)))]
+    operands = max([len(node) for node in nodes], default=0)
+    if operands < cmdLineArgs.min_operands:
+      continue
+    optimalCost, optimalTime, _ = search(DynamicProgramming(), nodes)
+    row = [example, kernel.name, str(operands), str(optimalCost), '{:.3f}'.format(optimalTime)]
+    for _, strategy in STRATEGIES:
+      cost, duration, statistics = search(strategy, nodes)
+      ratio = '{:.3f}'.format(cost / optimalCost) if optimalCost else '1.000'
+      row += [ratio + ('*' if statistics.budgetExceeded else ''), '{:.3f}'.format(duration)]
+    rows.append(row)
+
+widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+for row in rows:
+  print('  '.join(field.ljust(width) if i < 2 else field.rjust(width) for i, (field, width) in enumerate(zip(row, widths))))
+print('\nCosts of the heuristics are relative to the optimal cost; * marks an exceeded budget.')
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Compares the propagation of sparsity patterns through contractions of the SeisSol matrices.
+
+For every contraction of the kernels in examples/seissol_eqspp.py, the run time of
+np.einsum on boolean arrays, which aspp.general.einsum used to call, is compared with
+aspp.general.einsum, which computes large contractions by matrix products. The batch extent of the degrees of freedom is varied
+to show the scaling. The operation cache is disabled.
+
+Usage: python3 tests/benchmarks/sparsity_patterns.py [--batch N ...] [--min-time SECONDS]
+"""
+
+import os
+import sys
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, root)
+
+import argparse
+import time
+import numpy as np
+from yateto import aspp
+from yateto.input import parseXMLMatrixFile
+
+def measure(function, minTime):
+  repetitions = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(repetitions):
+      function()
+    duration = time.perf_counter() - start
+    if duration >= minTime:
+      return duration / repetitions
+    repetitions *= 2
+
+cmdLineParser = argparse.ArgumentParser()
+cmdLineParser.add_argument('--batch', type=int, nargs='+', default=[8, 64, 512], help='Extents of the batch index s.')
+cmdLineParser.add_argument('--min-time', type=float, default=0.1, help='Minimum measurement time per case in seconds.')
+cmdLineArgs = cmdLineParser.parse_args()
+
+aspp.cache.maxBytes = 0
+db = parseXMLMatrixFile(os.path.join(root, 'examples', 'seissol_matrices.xml'))
+spp = lambda tensor: tensor.spp().as_ndarray()
+star = spp(db.star)
+starEla = star[0:9, 0:9]
+dQ = np.ones((20, 9), dtype=bool)
+dQ[10:, :] = False
+
+header = ['Contraction', 'Shapes', 'np.einsum [ms]', 'aspp [ms]', 'Speed-up']
+rows = [header]
+def compare(description, A, B):
+  a, b = aspp.general(A), aspp.general(B)
+  assert np.array_equal(aspp.general.einsum(description, a, b).as_ndarray(), np.einsum(description, A, B))
+  reference = measure(lambda: aspp.general(np.einsum(description, A, B)), cmdLineArgs.min_time)
+  fast = measure(lambda: aspp.general.einsum(description, a, b), cmdLineArgs.min_time)
+  shapes = 'x'.join(map(str, A.shape)) + ', ' + 'x'.join(map(str, B.shape))
+  rows.append([description, shapes, '{:.4f}'.format(1e3 * reference), '{:.4f}'.format(1e3 * fast), '{:.1f}'.format(reference / fast)])
+
+for batch in cmdLineArgs.batch:
+  I = np.ones((batch, 20, 15), dtype=bool)
+  stiffness = np.einsum('lk,slq->skq', spp(db.kXiTDivM), I)
+  compare('lk,slq->skq', spp(db.kXiTDivM), I)
+  compare('skq,qp->skp', stiffness, star)
+for j in range(3):
+  kDivMT = spp(db.kDivMT[j])
+  compare('kl,lq->kq', kDivMT, dQ)
+  compare('kq,qp->kp', np.einsum('kl,lq->kq', kDivMT, dQ), starEla)
+
+widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+for row in rows:
+  print('  '.join(field.ljust(width) if i < 2 else field.rjust(width) for i, (field, width) in enumerate(zip(row, widths))))
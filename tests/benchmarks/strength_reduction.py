@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Compares the run time of the contraction order search versus the number of operands.
+
+Usage: python3 tests/benchmarks/strength_reduction.py [--max-operands N] [--max-exhaustive N]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import argparse
+import time
+from yateto import Tensor
+from yateto.ast.cost import BoundingBoxCostEstimator
+from yateto.ast.node import Einsum
+from yateto.ast.opt import strengthReduction, exhaustiveStrengthReduction, BranchAndBound, SearchStatistics
+from yateto.ast.transformer import DeduceIndices, EquivalentSparsityPattern
+
+def einsum(numOperands, N=8):
+  """Tensor ring C_{a,z} = A0_{a,b,x} A1_{b,c,x} ... with a shared index x."""
+  names = [chr(ord('a') + i) for i in range(numOperands + 1)]
+  shared = 'x'
+  prod = None
+  for i in range(numOperands):
+    indices = names[i] + names[i+1] + shared
+    term = Tensor('A{}'.format(i), (N, N, N))[indices]
+    prod = term if prod is None else prod * term
+  C = Tensor('C', (N, N))
+  ast = C[names[0] + names[-1]] <= prod
+  ast = DeduceIndices().visit(ast)
+  ast = EquivalentSparsityPattern().visit(ast)
+  node = ast.rightTerm()
+  assert isinstance(node, Einsum)
+  return node
+
+def measure(search, node, *args):
+  start = time.perf_counter()
+  tree = search(list(node), node.indices, BoundingBoxCostEstimator(), *args)
+  return time.perf_counter() - start, BoundingBoxCostEstimator().estimate(tree)
+
+cmdLineParser = argparse.ArgumentParser()
+cmdLineParser.add_argument('--max-operands', type=int, default=10)
+cmdLineParser.add_argument('--max-exhaustive', type=int, default=6, help='Largest number of operands for the exhaustive search.')
+cmdLineParser.add_argument('--node-limit', type=int, default=None, help='Node budget of branch and bound.')
+cmdLineArgs = cmdLineParser.parse_args()
+
+row = '{:>8}  {:>14}  {:>14}  {:>14}  {:>10}  {:>10}  {:>10}  {:>8}'
+print(row.format('Operands', 'Exhaustive [s]', 'Subset DP [s]', 'B&B [s]', 'Explored', 'Pruned', 'Cost', 'B&B cost'))
+for numOperands in range(2, cmdLineArgs.max_operands + 1):
+  node = einsum(numOperands)
+  dpTime, dpCost = measure(strengthReduction, node)
+  exhaustive = '-'
+  if numOperands <= cmdLineArgs.max_exhaustive:
+    exTime, exCost = measure(exhaustiveStrengthReduction, node)
+    assert exCost == dpCost
+    exhaustive = '{:.4f}'.format(exTime)
+  statistics = SearchStatistics()
+  bbTime, bbCost = measure(BranchAndBound(nodeLimit=cmdLineArgs.node_limit), node, statistics)
+  print(row.format(numOperands, exhaustive, '{:.4f}'.format(dpTime), '{:.4f}'.format(bbTime),
+                   statistics.explored, statistics.pruned, dpCost, bbCost))
@@ -0,0 +1,174 @@
+import itertools
+import unittest
+import numpy as np
+from yateto import aspp
+
+
+class GeneralTest(unittest.TestCase):
+  def test_matmul(self):
+    rng = np.random.default_rng(6)
+    A = rng.random((20, 30, 10)) < 0.05
+    B = rng.random((10, 30, 25)) < 0.05
+    for description in ['ijk,kjl->il', 'ijk,kjl->lji', 'ijk,kjl->l', 'ijk,klm->ijlm']:
+      expected = np.einsum(description, A, B)
+      result = aspp.general.einsum(description, aspp.general(A), aspp.general(B))
+      self.assertTrue(np.array_equal(result.as_ndarray(), expected))
+      self.assertEqual(result.digest(), aspp.general(expected).digest())
+
+
+class PackedTest(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.default_rng(2)
+    self.patterns = [rng.random(shape) < 0.3 for shape in [(13, 4, 3), (3, 4, 9), (9, 2)]]
+
+  def assertSame(self, packed, general):
+    self.assertIsInstance(packed, aspp.packed)
+    self.assertEqual(packed.shape, general.shape)
+    self.assertTrue(np.array_equal(packed.as_ndarray(), general.as_ndarray()))
+    self.assertEqual(packed.digest(), general.digest())
+
+  def test_unary(self):
+    for pattern in self.patterns:
+      general = aspp.general(pattern)
+      packed = aspp.packed(pattern)
+      self.assertEqual(packed.count_nonzero(), general.count_nonzero())
+      self.assertEqual(packed.nnzbounds(), general.nnzbounds())
+      for perm in itertools.permutations(range(pattern.ndim)):
+        self.assertSame(packed.transposed(perm), general.transposed(perm))
+      self.assertSame(packed.reshape((pattern.shape[0], -1)), general.reshape((pattern.shape[0], -1)))
+      self.assertSame(packed.reshape((-1,)), general.reshape((-1,)))
+      source = 'abc'[:pattern.ndim]
+      for n in range(pattern.ndim + 1):
+        for target in itertools.permutations(source, n):
+          target = ''.join(target)
+          self.assertSame(packed.indexSum(source, target), general.indexSum(source, target))
+
+  def test_binary(self):
+    A, B, C = self.patterns
+    for description, a, b in [('ijk,kjl->il', A, B), ('ijk,kjl->jil', A, B), ('ijk,kjl->ijkl', A, B),
+                              ('ijk,kl->ijl', B, C), ('ijk,kl->l', B, C), ('ijk,ijk->k', A, A),
+                              ('ijk,kl->ijkl', B, C)]:
+      general = aspp.einsum(description, aspp.general(a), aspp.general(b))
+      self.assertSame(aspp.einsum(description, aspp.packed(a), aspp.general(b)), general)
+      self.assertSame(aspp.einsum(description, aspp.dense(a.shape), aspp.packed(b)),
+                      aspp.einsum(description, aspp.dense(a.shape), aspp.general(b)))
+    self.assertSame(aspp.add(aspp.packed(A), aspp.general(A[::-1])), aspp.add(aspp.general(A), aspp.general(A[::-1])))
+
+
+class CooTest(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.default_rng(3)
+    self.patterns = [rng.random(shape) < 0.3 for shape in [(13, 4, 3), (3, 4, 9), (9, 2)]]
+
+  def assertSame(self, coo, general):
+    self.assertIsInstance(coo, aspp.coo)
+    self.assertEqual(coo.shape, general.shape)
+    self.assertTrue(np.array_equal(coo.as_ndarray(), general.as_ndarray()))
+    self.assertEqual(coo.digest(), general.digest())
+
+  def test_unary(self):
+    for pattern in self.patterns:
+      general = aspp.general(pattern)
+      coo = aspp.coo(pattern)
+      self.assertEqual(coo.count_nonzero(), general.count_nonzero())
+      self.assertEqual(coo.nnzbounds(), general.nnzbounds())
+      for nonzero, expected in zip(coo.nonzero(), general.nonzero()):
+        self.assertTrue(np.array_equal(nonzero, expected))
+      for perm in itertools.permutations(range(pattern.ndim)):
+        self.assertSame(coo.transposed(perm), general.transposed(perm))
+      self.assertSame(coo.reshape((-1, pattern.shape[-1])), general.reshape((-1, pattern.shape[-1])))
+      source = 'abc'[:pattern.ndim]
+      for n in range(pattern.ndim + 1):
+        for target in itertools.permutations(source, n):
+          target = ''.join(target)
+          self.assertSame(coo.indexSum(source, target), general.indexSum(source, target))
+
+  def test_binary(self):
+    A, B, C = self.patterns
+    for description, a, b in [('ijk,kjl->il', A, B), ('ijk,kjl->jil', A, B), ('ijk,kjl->ijkl', A, B),
+                              ('ijk,kl->ijl', B, C), ('ijk,kl->', B, C), ('ijk,ijk->k', A, A),
+                              ('ij,kl->ikjl', C, C)]:
+      self.assertSame(aspp.coo.einsum(description, aspp.coo(a), aspp.coo(b)),
+                      aspp.general.einsum(description, aspp.general(a), aspp.general(b)))
+    self.assertSame(aspp.coo.add(aspp.coo(A), aspp.coo(A[::-1])), aspp.add(aspp.general(A), aspp.general(A[::-1])))
+
+  def test_dispatch(self):
+    sparse = np.zeros((20, 20, 20), dtype=bool)
+    sparse[3, 4, 5] = sparse[7, 4, 2] = True
+    A, B, _ = self.patterns
+    self.assertIsInstance(aspp.einsum('ijk,kjl->il', aspp.general(sparse), aspp.general(sparse)), aspp.coo)
+    self.assertIsInstance(aspp.einsum('ijk,kjl->il', aspp.coo(A), aspp.coo(B)), aspp.general)
+    self.assertIsInstance(aspp.einsum('ijk,kjl->il', aspp.coo(sparse), aspp.dense(sparse.shape)), aspp.general)
+
+
+class BlockedTest(unittest.TestCase):
+  def setUp(self):
+    # Dense blocks below the diagonal and a general diagonal, as in DG matrices
+    self.grid = (0, 1, 4, 10)
+    rng = np.random.default_rng(4)
+    self.A = rng.random((10, 10)) < 0.5
+    for i in range(3):
+      for j in range(3):
+        block = self.A[self.grid[i]:self.grid[i+1], self.grid[j]:self.grid[j+1]]
+        block[...] = True if i > j else (block if i == j else False)
+    self.A[np.diag_indices(10)] = True
+    self.B = rng.random((10, 5)) < 0.3
+
+  def test_operations(self):
+    A = aspp.blocked(self.A, (self.grid, self.grid))
+    B = aspp.blocked(self.B, ((0, 5, 10), (0, 2, 5)))
+    self.assertEqual(A.count_nonzero(), np.count_nonzero(self.A))
+    self.assertEqual(A.nnzbounds(), aspp.general(self.A).nnzbounds())
+    for description, a, b, x, y in [('ij,jk->ik', A, A, self.A, self.A), ('ij,jk->ki', A, B, self.A, self.B),
+                                    ('ij,ik->jk', A, B, self.A, self.B), ('ij,kl->ijkl', B, A, self.B, self.A)]:
+      expected = aspp.general(np.einsum(description, x, y))
+      result = aspp.einsum(description, a, b)
+      self.assertIsInstance(result, aspp.blocked)
+      self.assertTrue(aspp.array_equal(result, expected))
+      self.assertEqual(result.digest(), expected.digest())
+    self.assertTrue(np.array_equal(aspp.add(A, aspp.general(self.A.T)).as_ndarray(), self.A | self.A.T))
+    self.assertTrue(np.array_equal(A.transposed((1, 0)).as_ndarray(), self.A.T))
+    self.assertTrue(np.array_equal(A.indexSum('ij', 'j').as_ndarray(), self.A.any(axis=0)))
+
+  def test_query(self):
+    A = aspp.blocked(self.A, (self.grid, self.grid))
+    self.assertEqual(A.blockShape(), (3, 3))
+    self.assertEqual(A.nonzeroBlocks(), [(0, 0), (1, 0), (1, 1), (2, 0), (2, 1), (2, 2)])
+    self.assertEqual(A.blockFlag((2, 1)), aspp.blocked.DENSE)
+    self.assertEqual(A.blockFlag((0, 2)), aspp.blocked.ZERO)
+    self.assertEqual(A.blockRange((2, 1)), ((4, 10), (1, 4)))
+    self.assertTrue(np.array_equal(A.blockPattern((1, 1)), self.A[1:4, 1:4]))
+    # The product of block lower triangular matrices is block lower triangular
+    product = aspp.einsum('ij,jk->ik', A, A)
+    self.assertEqual(product.blockFlag((2, 0)), aspp.blocked.DENSE)
+    self.assertEqual(product.blockFlag((0, 1)), aspp.blocked.ZERO)
+    with self.assertRaises(ValueError):
+      A.regrid(((0, 10), (0, 10)))
+
+
+class OperationCacheTest(unittest.TestCase):
+  def test_lru(self):
+    cache = aspp.OperationCache(maxBytes=2500)
+    entries = [np.zeros(1000, dtype=np.uint8) for _ in range(3)]
+    cache.lookup('a', lambda: entries[0])
+    cache.lookup('b', lambda: entries[1])
+    self.assertIs(cache.lookup('a', lambda: None), entries[0])
+    # Makes room by evicting the least recently used entry
+    cache.lookup('c', lambda: entries[2])
+    self.assertEqual((cache.hits, cache.misses, cache.evictions, len(cache)), (1, 3, 1, 2))
+    self.assertLessEqual(cache.bytes, cache.maxBytes)
+    self.assertIsNone(cache.lookup('b', lambda: None))
+
+  def test_operations(self):
+    rng = np.random.default_rng(5)
+    A = aspp.general(rng.random((6, 7)) < 0.5)
+    B = aspp.general(rng.random((7, 8)) < 0.5)
+    hits = aspp.cache.hits
+    C = aspp.einsum('ij,jk->ik', A, B)
+    # Equal patterns are identified by their content
+    self.assertIs(aspp.einsum('ij,jk->ik', A.copy(), B.copy()), C)
+    self.assertIs(C.indexSum('ik', 'k'), C.indexSum('ik', 'k'))
+    # Results are keyed by the operation which computed them, without hashing their content
+    self.assertIsNone(C._digest)
+    self.assertIsNot(aspp.einsum('ij,jk->ik', aspp.packed(A.pattern), B), C)
+    self.assertEqual(aspp.cache.hits - hits, 2)
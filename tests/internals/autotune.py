@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+from yateto import Generator, Tensor, useArchitectureIdentifiedBy
+from yateto.ast.cost import BoundingBoxCostEstimator
+from yateto.autotune import Autotuner, TuningDatabase
+from yateto.gemm_configuration import GeneratorCollection
+
+COMPILER = os.environ.get(Autotuner.COMPILER_ENV, 'c++')
+
+
+@unittest.skipIf(shutil.which(COMPILER) is None, 'No C++ compiler')
+class AutotuneTest(unittest.TestCase):
+  def generator(self):
+    arch = useArchitectureIdentifiedBy('dnoarch')
+    A = Tensor('A', (8, 16))
+    B = Tensor('B', (16, 2))
+    C = Tensor('C', (2, 16))
+    D = Tensor('D', (8, 16))
+    generator = Generator(arch)
+    generator.add('chain', D['il'] <= A['ij'] * B['jk'] * C['kl'])
+    return generator
+
+  def test_database(self):
+    with tempfile.TemporaryDirectory() as directory:
+      database = os.path.join(directory, 'tuning.json')
+      for run in range(2):
+        tuner = Autotuner(database, candidates=2, minTime=0.001)
+        generator = self.generator()
+        generator.generate(directory, gemm_cfg=GeneratorCollection([]), unit_tests=False, autotune=tuner)
+        self.assertEqual((tuner.database.hits, tuner.database.misses), (run, 1 - run))
+
+      entry, = TuningDatabase(database)._entries.values()
+      self.assertEqual(entry['name'], 'chain')
+      einsum = 'A[ij]*B[jk]*C[kl]->il'
+      self.assertEqual(list(entry['ranks']), [einsum])
+      self.assertEqual(len(entry['seconds'][einsum]), 2)
+      self.assertTrue(all(seconds > 0 for seconds in entry['seconds'][einsum]))
+      self.assertEqual(entry['ranks'][einsum], entry['seconds'][einsum].index(min(entry['seconds'][einsum])))
+
+  def test_einsums(self):
+    generator = self.generator()
+    A = Tensor('A', (8, 16))
+    B = Tensor('B', (16, 2))
+    C = Tensor('C', (2, 16))
+    D = Tensor('D', (8, 16))
+    E = Tensor('E', (16, 16))
+    generator.add('pair', [E['jl'] <= B['jk'] * C['kl'], D['il'] <= A['ij'] * E['jk'] * E['kl']])
+    with tempfile.TemporaryDirectory() as directory:
+      tuner = Autotuner(os.path.join(directory, 'tuning.json'), candidates=2, minTime=0.001, kernels=['pair'])
+      strategies = tuner.searchStrategy(generator, BoundingBoxCostEstimator, None, GeneratorCollection([]))
+    self.assertIsNone(strategies['chain'])
+    entry, = tuner.database._entries.values()
+    # Every Einsum is tuned on its own; the first one has a single contraction tree
+    product, chain = 'B[jk]*C[kl]->jl', 'A[ij]*E[jk]*E[kl]->il'
+    self.assertEqual(list(entry['ranks']), [product, chain])
+    self.assertEqual(entry['seconds'][product], [None, None])
+    self.assertTrue(all(seconds > 0 for seconds in entry['seconds'][chain]))
+    self.assertEqual(strategies['pair'].ranks, {chain: entry['ranks'][chain]} if entry['ranks'][chain] else {})
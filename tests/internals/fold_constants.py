@@ -0,0 +1,72 @@
+import copy
+import unittest
+import numpy as np
+from yateto.type import Tensor
+from yateto.ast.node import IndexedTensor
+from yateto.ast.transformer import DeduceIndices, FoldConstants
+from yateto.ast.visitor import ComputeConstantExpression, FindTensors
+
+
+def fold(ast):
+  return FoldConstants().visit(DeduceIndices().visit(ast)).rightTerm()
+
+
+class Evaluate(ComputeConstantExpression):
+  """Evaluates an AST, where values of non-constant tensors are taken from a dict."""
+  def __init__(self, values):
+    super().__init__()
+    self._values = values
+
+  def visit_IndexedTensor(self, node):
+    if node.tensor.name() in self._values:
+      return self._values[node.tensor.name()]
+    return super().visit_IndexedTensor(node)
+
+
+class FoldConstantsTest(unittest.TestCase):
+  def setUp(self):
+    self.a = np.arange(1.0, 17.0).reshape(4, 4)
+    self.b = np.diag([1.0, 2.0, 3.0, 4.0])
+    self.A = Tensor('A', (4, 4), spp=self.a)
+    self.B = Tensor('B', (4, 4), spp=self.b)
+    self.C = Tensor('C', (4, 4))
+    self.X = Tensor('X', (4, 4))
+
+  def test_constant_operands(self):
+    node = fold(self.C['ij'] <= self.A['ik'] * self.X['lj'] * self.B['kl'])
+    self.assertEqual([child.tensor.name() for child in node][1], 'X')
+    # Index k is summed within the constant operands
+    self.assertEqual(node[0].indices.tostring(), 'il')
+    self.assertTrue(np.array_equal(node[0].tensor.values_as_ndarray(), self.a @ self.b))
+
+  def test_constant_expression(self):
+    node = fold(self.C['ij'] <= 2.0 * self.A['ik'] * self.B['kj'] + self.A['ji'])
+    self.assertIsInstance(node, IndexedTensor)
+    self.assertTrue(np.array_equal(node.tensor.values_as_ndarray(), 2.0 * self.a @ self.b + self.a.T))
+    self.assertEqual(node.tensor.name(), fold(self.C['ij'] <= 2.0 * self.A['ik'] * self.B['kj'] + self.A['ji']).tensor.name())
+
+  def test_denser_result_is_not_folded(self):
+    u = Tensor('u', (4,), spp=np.arange(1.0, 5.0))
+    v = Tensor('v', (4,), spp=np.arange(1.0, 5.0))
+    node = fold(self.C['ij'] <= u['i'] * v['j'] * self.X['ij'])
+    self.assertEqual([child.tensor.name() for child in node], ['u', 'v', 'X'])
+
+  def test_names(self):
+    foldConstants = FoldConstants()
+    first = foldConstants.visit(DeduceIndices().visit(self.C['ij'] <= self.A['ik'] * self.B['kj'])).rightTerm()
+    second = foldConstants.visit(DeduceIndices().visit(self.C['ij'] <= self.A['ki'] * self.B['kj'])).rightTerm()
+    again = foldConstants.visit(DeduceIndices().visit(self.C['ij'] <= self.A['ik'] * self.B['kj'])).rightTerm()
+    self.assertEqual([first.tensor.name(), second.tensor.name()], ['A_B_folded0', 'A_B_folded1'])
+    self.assertIs(again.tensor, first.tensor)
+    # Names do not depend on the values
+    A = Tensor('A', (4, 4), spp=2.0 * self.a)
+    self.assertEqual(fold(self.C['ij'] <= A['ik'] * self.B['kj']).tensor.name(), 'A_B_folded0')
+
+  def test_folded_kernel_is_equivalent(self):
+    Y = Tensor('Y', (4, 4))
+    ast = DeduceIndices().visit(self.C['ij'] <= 2.0 * self.A['ik'] * self.X['lj'] * self.B['kl'] + self.A['ji'] * self.B['ik'] * Y['kj'])
+    folded = FoldConstants().visit(copy.deepcopy(ast))
+    rng = np.random.default_rng(7)
+    values = {'X': rng.random((4, 4)), 'Y': rng.random((4, 4))}
+    self.assertEqual(set(FindTensors().visit(folded)), {'A_B_folded0', 'A_B_folded1', 'C', 'X', 'Y'})
+    self.assertTrue(np.allclose(Evaluate(values).visit(folded.rightTerm()), Evaluate(values).visit(ast.rightTerm()), rtol=1e-14))
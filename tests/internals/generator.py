@@ -0,0 +1,197 @@
+import copy
+import os
+import re
+import tempfile
+import unittest
+import numpy as np
+from yateto import Scalar, Tensor, Generator, simpleParameterSpace
+from yateto.arch import useArchitectureIdentifiedBy
+from yateto.ast.cost import BoundingBoxCostEstimator
+from yateto.ast.transformer import StrengthReduction
+from yateto.gemm_configuration import GeneratorCollection, Eigen
+from yateto.plan_cache import PlanCache
+from yateto.profiling import Profiler
+
+
+def add_kernels(g):
+  N = 8
+  A = Tensor('A', (N, N))
+  B = Tensor('B', (N, N, N))
+  w = Tensor('w', (N,))
+  C = Tensor('C', (N, N))
+  g.add('kernel', C['ij'] <= 2.0 * C['ij'] + A['lj'] * B['ikl'] * w['k'])
+
+  D = [Tensor('D({})'.format(i), (N, N)) for i in range(3)]
+  alpha = Scalar('alpha')
+  g.addFamily('family', simpleParameterSpace(3), lambda i: C['ij'] <= alpha * D[i]['ik'] * A['kj'])
+
+
+class GeneratorOutput(unittest.TestCase):
+  def generate(self, outputDir, add=add_kernels, **kwargs):
+    arch = useArchitectureIdentifiedBy('dhsw')
+    g = Generator(arch)
+    add(g)
+    g.generate(outputDir, gemm_cfg=GeneratorCollection([Eigen(arch)]), **kwargs)
+    if kwargs.get('unit_tests') == 'deferred':
+      g.generateUnitTests(outputDir, gemm_cfg=GeneratorCollection([Eigen(arch)]))
+    files = dict()
+    for fileName in sorted(os.listdir(outputDir)):
+      with open(os.path.join(outputDir, fileName)) as f:
+        files[fileName] = f.read()
+    return files
+
+  def test_parallel_optimization_is_deterministic(self):
+    with tempfile.TemporaryDirectory() as serialDir, tempfile.TemporaryDirectory() as parallelDir:
+      serial = self.generate(serialDir)
+      parallel = self.generate(parallelDir, jobs=2)
+    self.assertEqual(serial, parallel)
+
+  def test_plan_cache(self):
+    with tempfile.TemporaryDirectory() as cacheDir:
+      with tempfile.TemporaryDirectory() as outputDir:
+        reference = self.generate(outputDir)
+      cold = PlanCache(cacheDir)
+      with tempfile.TemporaryDirectory() as outputDir:
+        self.assertEqual(reference, self.generate(outputDir, plan_cache=cold))
+      self.assertEqual((cold.hits, cold.misses), (0, 2))
+      warm = PlanCache(cacheDir)
+      with tempfile.TemporaryDirectory() as outputDir:
+        self.assertEqual(reference, self.generate(outputDir, plan_cache=warm))
+      self.assertEqual((warm.hits, warm.misses), (2, 0))
+
+  def test_write_if_changed(self):
+    with tempfile.TemporaryDirectory() as referenceDir, tempfile.TemporaryDirectory() as outputDir:
+      reference = self.generate(referenceDir)
+      self.assertEqual(reference, self.generate(outputDir, write_if_changed=True))
+      for fileName in reference:
+        os.utime(os.path.join(outputDir, fileName), ns=(0, 0))
+      self.assertEqual(reference, self.generate(outputDir, write_if_changed=True))
+      for fileName in reference:
+        self.assertEqual(os.stat(os.path.join(outputDir, fileName)).st_mtime_ns, 0)
+      self.assertEqual(sorted(os.listdir(outputDir)), sorted(reference))
+
+  def test_shards(self):
+    with tempfile.TemporaryDirectory() as referenceDir, tempfile.TemporaryDirectory() as outputDir:
+      reference = self.generate(referenceDir)
+      sharded = self.generate(outputDir, shards=2)
+    for fileName in ['kernel.h', 'subroutine.h', 'tensor.h', 'tensor.cpp', 'init.h', 'init.cpp']:
+      self.assertEqual(reference[fileName], sharded[fileName])
+    definitions = lambda source: sorted(line for line in source.splitlines() if '::execute' in line)
+    self.assertEqual(definitions(reference['kernel.cpp']),
+                     definitions(sharded['kernel.cpp'] + sharded['kernel_1.cpp']))
+    self.assertTrue(definitions(sharded['kernel.cpp']) and definitions(sharded['kernel_1.cpp']))
+
+  def test_fewer_shards(self):
+    with tempfile.TemporaryDirectory() as referenceDir, tempfile.TemporaryDirectory() as outputDir:
+      reference = self.generate(referenceDir, shards=2)
+      self.generate(outputDir, shards=3)
+      # Shards of the previous run beyond the current number of shards are removed
+      self.assertEqual(reference, self.generate(outputDir, shards=2))
+
+  def test_unit_tests(self):
+    with tempfile.TemporaryDirectory() as referenceDir, tempfile.TemporaryDirectory() as skipDir, \
+         tempfile.TemporaryDirectory() as deferredDir:
+      reference = self.generate(referenceDir)
+      skipped = self.generate(skipDir, unit_tests=False)
+      deferred = self.generate(deferredDir, unit_tests='deferred')
+    unitTests = {Generator.DOCTEST_FILE_NAME + '.cpp', Generator.CXXTEST_FILE_NAME + '.h'}
+    self.assertEqual({name: source for name, source in reference.items() if name not in unitTests}, skipped)
+    self.assertEqual(reference, deferred)
+
+  def test_profile(self):
+    profiler = Profiler()
+    with tempfile.TemporaryDirectory() as referenceDir, tempfile.TemporaryDirectory() as outputDir:
+      self.assertEqual(self.generate(referenceDir), self.generate(outputDir, profile=profiler, jobs=2))
+    kernels = {event.kernel for event in profiler.events if event.name == 'prepareUntilCodeGen'}
+    self.assertEqual(kernels, {'kernel', '_family_0'})
+    self.assertEqual([event.name for event in profiler.events if event.kernel is None][-1], 'generate')
+    self.assertIn('StrengthReduction', profiler.report())
+    self.assertEqual(len(profiler.chromeTrace()['traceEvents']), len(profiler.events))
+
+  def test_isomorphic_family_members(self):
+    with tempfile.TemporaryDirectory() as outputDir:
+      source = self.generate(outputDir)['kernel.cpp']
+    executes = [body.split('\n  }\n')[0] for body in source.split('void kernel::family::execute')[1:]]
+    self.assertEqual(len(executes), 3)
+    for i in range(1, 3):
+      self.assertEqual(executes[i], str(i) + executes[0][1:].replace('D(0)', 'D({})'.format(i)))
+
+  def test_equal_family_members(self):
+    def add(g):
+      A = Tensor('A', (8, 8))
+      C = Tensor('C', (8, 8))
+      g.addFamily('same', simpleParameterSpace(2), lambda i: C['ij'] <= A['ik'] * A['kj'])
+    with tempfile.TemporaryDirectory() as outputDir:
+      files = self.generate(outputDir, add)
+    self.assertEqual(files['kernel.cpp'].count('void kernel::same::execute'), 1)
+    self.assertIn('ExecutePtrs[] = {&same::execute0, &same::execute0};', files['kernel.h'])
+    # Every member keeps its execute function, which the unit tests call
+    called = set(re.findall(r'krnl\.(execute\d+)\(\);', ''.join(files[name] for name in files if name.startswith('test-'))))
+    self.assertEqual(called, {'execute0', 'execute1'})
+    for execute in called:
+      self.assertRegex(files['kernel.h'], r'void {}\(\)'.format(execute))
+
+  def test_shared_family_bodies(self):
+    with tempfile.TemporaryDirectory() as outputDir:
+      files = self.generate(outputDir)
+    # The members of family differ in D(i) only, which is passed to one shared body
+    self.assertEqual(files['kernel.cpp'].count('void kernel::family::_executeShared0(double const* _group_D_0) {'), 1)
+    self.assertEqual(files['kernel.cpp'].count('_mapC = '), 2)
+    for i in range(3):
+      self.assertIn('_executeShared0(D({}));'.format(i), files['kernel.cpp'])
+
+  def test_merge_keeps_reused_results(self):
+    # Elimination of A*B yields F = A*B; C = F; D = F*E; MergeActions must not write A*B to C only
+    arch = useArchitectureIdentifiedBy('dhsw')
+    g = Generator(arch)
+    A, B, C, D, E, F = [Tensor(name, (8, 8)) for name in 'ABCDEF']
+    g.add('reuse', [C['ij'] <= A['ik'] * B['kj'], D['il'] <= A['ik'] * B['kj'] * E['jl'], F['ij'] <= 2.0 * A['ik'] * B['kj'] + E['ij']])
+    with tempfile.TemporaryDirectory() as outputDir:
+      g.generate(outputDir, gemm_cfg=GeneratorCollection([Eigen(arch)]))
+    written = set()
+    for pp in g.kernels()[0].cfg[:-1]:
+      read = {var.name for var in pp.action.variables() if var.writable}
+      self.assertEqual(read - written, set())
+      written.add(pp.action.result.name)
+
+  def test_common_subexpressions(self):
+    def add(g):
+      A, B, C, D, E = [Tensor(name, (8, 8)) for name in 'ABCDE']
+      g.add('repeated', [C['ij'] <= A['ik'] * B['kj'], D['ij'] <= A['ik'] * B['kj'] + E['ij']])
+      g.add('first', C['ij'] <= A['ik'] * B['kj'] + E['ij'])
+      g.add('second', D['ij'] <= 2.0 * (A['ik'] * B['kj'] + E['ij']))
+      g.shareIntermediates('S', ['first', 'second'])
+    with tempfile.TemporaryDirectory() as outputDir:
+      files = self.generate(outputDir, add)
+    structs = {struct.split(' {')[0]: struct for struct in files['kernel.h'].split('struct ')[1:]}
+    # A*B is computed once in repeated
+    self.assertIn('HardwareFlops = 1088;', structs['repeated'])
+    self.assertIn('double* S_0{};', structs['first'])
+    self.assertIn('double const* S_0{};', structs['second'])
+    self.assertIn('HardwareFlops = 64;', structs['second'])
+
+
+class NonZeroFlops(unittest.TestCase):
+  def test_single_optimization(self):
+    arch = useArchitectureIdentifiedBy('dhsw')
+    N = 8
+    spp = np.zeros((N, N), dtype=bool)
+    spp[:3, :] = True
+    A = Tensor('A', (N, N), spp=spp)
+    B = Tensor('B', (N, N, N))
+    w = Tensor('w', (N,))
+    C = Tensor('C', (N, N))
+    G = Tensor('G', (N, N), spp=np.triu(np.ones((N, N), dtype=bool)))
+    G.setGroupSpp(np.ones((N, N), dtype=bool))
+    g = Generator(arch)
+    g.add('sparse', C['ij'] <= 2.0 * C['ij'] + A['lj'] * B['ikl'] * w['k'])
+    g.add('scaled', C['ij'] <= Scalar('alpha') * A['ik'] * C['kj'] - A['ij'])
+    g.add('group', [C['ij'] <= G['ik'] * A['kl'] * C['lj'], C['ij'] <= A['ik'] * C['kj']])
+    for kernel in g.kernels():
+      kernel.prepareUntilUnitTest(False)
+      # Count of the former separate optimization with the sparsity patterns of the tensors
+      strengthReduction = StrengthReduction(BoundingBoxCostEstimator)
+      expected = sum(kernel._nonZeroFlopsOfCopy(ast, strengthReduction) for ast in kernel.ast)
+      kernel.prepareUntilCodeGen(BoundingBoxCostEstimator)
+      self.assertEqual(kernel.nonZeroFlops, expected, kernel.name)
+      self.assertGreater(kernel.nonZeroFlops, 0)
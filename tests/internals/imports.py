@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import unittest
+
+OPTIONAL_MODULES = ('matplotlib', 'gemmforge', 'chainforge', 'lxml')
+
+# Time in seconds which importing yateto may take, excluding numpy
+IMPORT_TIME_BUDGET = float(os.environ.get('YATETO_IMPORT_TIME_BUDGET', 0.5))
+
+# Records every attempt to find an optional module during "import yateto"
+PROBE = '''
+import sys
+requested = set()
+class Probe(object):
+  def find_spec(self, name, path=None, target=None):
+    if name.split('.')[0] in {optional}:
+      requested.add(name)
+    return None
+sys.meta_path.insert(0, Probe())
+import yateto
+print(sorted(requested))
+'''.format(optional=repr(OPTIONAL_MODULES))
+
+
+class ImportTest(unittest.TestCase):
+  def run_python(self, *args):
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return subprocess.run([sys.executable] + list(args), cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+  def test_optional_modules_are_not_imported(self):
+    self.assertEqual(self.run_python('-c', PROBE).stdout.strip(), '[]')
+
+  def test_import_time_budget(self):
+    # Lines of -X importtime are "import time: self [us] | cumulative | imported package"
+    cumulative = dict()
+    for line in self.run_python('-X', 'importtime', '-c', 'import yateto').stderr.splitlines():
+      fields = line.split('|')
+      if len(fields) == 3 and fields[1].strip().isdigit():
+        cumulative.setdefault(fields[2].strip(), int(fields[1]))
+    seconds = (cumulative['yateto'] - cumulative.get('numpy', 0)) * 1e-6
+    self.assertLess(seconds, IMPORT_TIME_BUDGET)
@@ -0,0 +1,166 @@
+import unittest
+import numpy as np
+from yateto.type import Tensor
+from yateto.ast.node import IndexedTensor
+from yateto.arch import getArchitectureIdentifiedBy
+from yateto.ast.cost import BoundingBoxCostEstimator, ExactCost, RooflineCostEstimator, FusedGemmsBoundingBoxCostEstimator
+from yateto.ast.opt import strengthReduction, exhaustiveStrengthReduction, BranchAndBound, Greedy, RandomRestartGreedy, SearchStatistics, NodeTable, rankedStrengthReduction
+from yateto.ast import opt, transformer
+from yateto.ast.transformer import DeduceIndices, EquivalentSparsityPattern
+
+
+def einsum(ast):
+  ast = DeduceIndices().visit(ast)
+  return EquivalentSparsityPattern().visit(ast).rightTerm()
+
+def structure(node):
+  return '{}[{}]({})'.format(type(node).__name__, node.indices, ','.join(structure(child) for child in node))
+
+def leaves(node):
+  return [node] if isinstance(node, IndexedTensor) else [leaf for child in node for leaf in leaves(child)]
+
+class CountingCostEstimator(BoundingBoxCostEstimator):
+  def __init__(self):
+    super().__init__()
+    self.products = 0
+
+  def estimate_Product(self, node):
+    self.products += 1
+    return super().estimate_Product(node)
+
+
+class StrengthReduction(unittest.TestCase):
+  def assertSameTree(self, node):
+    for costEstimator in [BoundingBoxCostEstimator, ExactCost]:
+      expected = exhaustiveStrengthReduction(list(node), node.indices, costEstimator())
+      for strategy in [strengthReduction, BranchAndBound()]:
+        tree = strategy(list(node), node.indices, costEstimator())
+        self.assertEqual(structure(expected), structure(tree))
+
+  def test_tensor_ring(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(5)]
+    C = Tensor('C', (4, 4))
+    self.assertSameTree(einsum(C['af'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx']))
+
+  def test_ties_and_sparsity(self):
+    spp = np.zeros((9, 9), dtype=bool)
+    spp[:4, :] = True
+    A = Tensor('A', (9, 9), spp=spp)
+    B = Tensor('B', (9, 9))
+    Q = Tensor('Q', (9, 9))
+    C = Tensor('C', (9, 9))
+    self.assertSameTree(einsum(C['il'] <= A['ij'] * Q['jk'] * B['kl'] * B['lm'] * Q['mi']))
+
+  def test_branch_and_bound_budget(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(6)]
+    C = Tensor('C', (4, 4))
+    node = einsum(C['ag'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx'] * A[5]['fgx'])
+    complete = SearchStatistics()
+    optimal = BranchAndBound()(list(node), node.indices, BoundingBoxCostEstimator(), complete)
+    self.assertFalse(complete.budgetExceeded)
+    self.assertGreater(complete.pruned, 0)
+
+    limited = SearchStatistics()
+    tree = BranchAndBound(nodeLimit=3)(list(node), node.indices, BoundingBoxCostEstimator(), limited)
+    self.assertTrue(limited.budgetExceeded)
+    self.assertLess(limited.explored, complete.explored)
+    self.assertEqual(set(tree.indices), set(node.indices))
+    self.assertGreaterEqual(BoundingBoxCostEstimator().estimate(tree), BoundingBoxCostEstimator().estimate(optimal))
+
+  def test_heuristics(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(6)]
+    C = Tensor('C', (4, 4))
+    node = einsum(C['ag'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx'] * A[5]['fgx'])
+    cost = lambda tree: BoundingBoxCostEstimator().estimate(tree)
+    optimal = cost(strengthReduction(list(node), node.indices, BoundingBoxCostEstimator()))
+    greedy = cost(Greedy()(list(node), node.indices, BoundingBoxCostEstimator()))
+    randomized = [cost(RandomRestartGreedy(seed=1)(list(node), node.indices, BoundingBoxCostEstimator())) for _ in range(2)]
+    self.assertLessEqual(optimal, randomized[0])
+    self.assertLessEqual(randomized[0], greedy)
+    self.assertEqual(randomized[0], randomized[1])
+
+  def test_roofline(self):
+    sizes = {'a': 32, 'b': 4, 'c': 64, 'e': 16, 'f': 64}
+    tensor = lambda name, indices: Tensor(name, tuple(sizes[index] for index in indices))[indices]
+    C = Tensor('C', (32, 64, 16))
+    node = einsum(C['ace'] <= tensor('F', 'f') * tensor('G', 'fe') * tensor('H', 'acb') * tensor('V', 'b'))
+    roofline = lambda: RooflineCostEstimator(getArchitectureIdentifiedBy('dhsw'))
+    flops = strengthReduction(list(node), node.indices, BoundingBoxCostEstimator())
+    time = strengthReduction(list(node), node.indices, roofline())
+    # The flop-optimal tree writes a 32x64x16 outer product which does not fit into L2
+    self.assertLess(roofline().estimate(time), roofline().estimate(flops))
+    self.assertGreater(BoundingBoxCostEstimator().estimate(time), BoundingBoxCostEstimator().estimate(flops))
+
+  def test_node_table(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(5)]
+    C = Tensor('C', (4, 4))
+    node = einsum(C['af'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx'])
+    strategies = [RandomRestartGreedy(), BranchAndBound(), strengthReduction]
+    unshared = CountingCostEstimator()
+    for strategy in strategies:
+      strategy(list(node), node.indices, unshared)
+    nodes = NodeTable()
+    estimator = CountingCostEstimator()
+    trees = [strategy(list(node), node.indices, estimator, None, nodes) for strategy in strategies]
+    estimated = estimator.products
+    self.assertLess(estimated, unshared.products)
+    # Equal subexpressions are estimated once
+    again = strengthReduction(list(node), node.indices, estimator, None, nodes)
+    self.assertEqual(estimator.products, estimated)
+    # Results are copies whose leaves are the terms of the Einsum
+    self.assertEqual(structure(again), structure(trees[-1]))
+    self.assertIsNot(again, trees[-1])
+    self.assertEqual(sorted(map(id, leaves(again))), sorted(map(id, node)))
+
+  def test_shared_node_table(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(5)]
+    C = Tensor('C', (4, 4))
+    nodes = NodeTable()
+    estimated = list()
+    # E.g. the ASTs of two kernels with the same Einsum
+    for _ in range(2):
+      ast = DeduceIndices().visit(C['af'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx'])
+      ast = EquivalentSparsityPattern().visit(ast)
+      transformer.StrengthReduction(CountingCostEstimator, nodes=nodes).visit(ast)
+      estimated.append(nodes.costEstimator(CountingCostEstimator).products)
+    self.assertGreater(estimated[0], 0)
+    self.assertEqual(estimated[1], estimated[0])
+    # Stateful estimators are not shared
+    self.assertIsNot(nodes.costEstimator(FusedGemmsBoundingBoxCostEstimator), nodes.costEstimator(FusedGemmsBoundingBoxCostEstimator))
+
+  def test_ranked(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(5)]
+    C = Tensor('C', (4, 4))
+    node = einsum(C['af'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx'])
+    trees = rankedStrengthReduction(list(node), node.indices, BoundingBoxCostEstimator(), 8)
+    costs = [BoundingBoxCostEstimator().estimate(tree) for tree in trees]
+    optimal = strengthReduction(list(node), node.indices, BoundingBoxCostEstimator())
+    self.assertEqual(len(trees), 8)
+    self.assertEqual(costs, sorted(costs))
+    self.assertEqual(costs[0], BoundingBoxCostEstimator().estimate(optimal))
+    self.assertEqual(len(set(map(str, map(structure, trees)))), 8)
+
+  def test_ranked_per_einsum(self):
+    A = [Tensor('A{}'.format(i), (4, 4, 6)) for i in range(5)]
+    C = Tensor('C', (4, 4))
+    D = Tensor('D', (4, 4))
+    nodes = [einsum(C['af'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'] * A[3]['dex'] * A[4]['efx']),
+             einsum(D['ad'] <= A[0]['abx'] * A[1]['bcx'] * A[2]['cdx'])]
+    name = opt.einsumName(list(nodes[0]), nodes[0].indices)
+    self.assertEqual(name, 'A0[abx]*A1[bcx]*A2[cdx]*A3[dex]*A4[efx]->af')
+    # Only the rank of the named Einsum changes
+    ranked = opt.Ranked(0, {name: 2})
+    for node, rank in zip(nodes, [2, 0]):
+      expected = rankedStrengthReduction(list(node), node.indices, BoundingBoxCostEstimator(), rank + 1)[-1]
+      self.assertEqual(structure(ranked(list(node), node.indices, BoundingBoxCostEstimator())), structure(expected))
+
+  def test_equivalent_sparsity_pattern(self):
+    rng = np.random.default_rng(1)
+    spps = [rng.random((5, 5)) < 0.3 for _ in range(4)]
+    M = [Tensor('M{}'.format(i), (5, 5), spp=spp | np.eye(5, dtype=bool)) for i, spp in enumerate(spps)]
+    C = Tensor('C', (5, 5))
+    node = einsum(C['ae'] <= M[0]['ab'] * M[1]['bc'] * M[2]['cd'] * M[3]['de'])
+    full = np.einsum('ab,bc,cd,de->abcde', *[m.spp().as_ndarray() for m in M])
+    self.assertTrue(np.array_equal(node.eqspp().as_ndarray(), full.any(axis=(1, 2, 3))))
+    for child, axes in zip(node, [(2, 3, 4), (0, 3, 4), (0, 1, 4), (0, 1, 2)]):
+      self.assertTrue(np.array_equal(child.eqspp().as_ndarray(), full.any(axis=axes)))
@@ -0,0 +1,93 @@
+import os
+import random
+import stat
+import sys
+import tempfile
+import time
+import unittest
+from yateto.arch import useArchitectureIdentifiedBy
+from yateto.codegen.cache import MicrokernelCache, RoutineCache, RoutineGenerator
+from yateto.codegen.gemm.gemmgen import ExecuteGemmGen
+from yateto.gemm_configuration import LIBXSMM
+
+
+class SlowGenerator(RoutineGenerator):
+  THREAD_SAFE = True
+
+  def __init__(self, body):
+    self._body = body
+
+  def __eq__(self, other):
+    return self._body == other._body
+
+  def header(self, cpp):
+    cpp('// header')
+
+  def __call__(self, routineName, fileName):
+    time.sleep(random.random() * 0.01)
+    with open(fileName, 'a') as f:
+      f.write('void {}() {{ {} }}\n'.format(routineName, self._body))
+    return 'void {}();'.format(routineName)
+
+
+class RoutineCacheTest(unittest.TestCase):
+  def generate(self, directory, jobs):
+    cache = RoutineCache()
+    for i in range(16):
+      cache.addRoutine('routine{}'.format(i), SlowGenerator(str(i)))
+    declarations = list()
+    cppFileName = os.path.join(directory, 'subroutine.cpp')
+    cache.generate(declarations.append, cppFileName, os.path.join(directory, 'gpulike_subroutine.cpp'), jobs=jobs)
+    with open(cppFileName) as f:
+      return declarations, f.read()
+
+  def test_parallel_generation_keeps_order(self):
+    with tempfile.TemporaryDirectory() as serialDir, tempfile.TemporaryDirectory() as parallelDir:
+      serial = self.generate(serialDir, jobs=1)
+      parallel = self.generate(parallelDir, jobs=4)
+    self.assertEqual(serial, parallel)
+    self.assertEqual(serial[0], ['void routine{}();'.format(i) for i in range(16)])
+
+  def test_microkernel_cache(self):
+    arch = useArchitectureIdentifiedBy('dhsw')
+    gemm = {'M': 8, 'N': 8, 'K': 8, 'LDA': 8, 'LDB': 8, 'LDC': 8, 'alpha': 1, 'beta': 0,
+            'alignedA': 1, 'alignedC': 1, 'prefetch': 'pfsigonly'}
+    with tempfile.TemporaryDirectory() as tmpDir:
+      # Fake libxsmm which logs its invocations
+      cmd = os.path.join(tmpDir, 'gemm_generator')
+      log = os.path.join(tmpDir, 'calls')
+      with open(cmd, 'w') as f:
+        f.write('#!{}\n'.format(sys.executable))
+        f.write('import sys\n')
+        f.write('open({!r}, "a").write("x")\n'.format(log))
+        f.write('open(sys.argv[2], "a").write("void " + sys.argv[3] + "() {}\\n")\n')
+      os.chmod(cmd, stat.S_IRWXU)
+
+      cache = MicrokernelCache(os.path.join(tmpDir, 'cache'))
+      outputs = list()
+      for i in range(2):
+        fileName = os.path.join(tmpDir, '{}.cpp'.format(i))
+        generator = ExecuteGemmGen(arch, gemm, None, None, LIBXSMM(arch, cmd=cmd), cache)
+        declaration = generator('gemm', fileName)
+        with open(fileName) as f:
+          outputs.append((declaration, f.read()))
+      with open(log) as f:
+        self.assertEqual(f.read(), 'x')
+    self.assertEqual(outputs[0], outputs[1])
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+  def test_tool_digest_covers_python_packages(self):
+    with tempfile.TemporaryDirectory() as tmpDir:
+      # Launcher like pspamm.py, which imports a package next to it
+      cmd = os.path.join(tmpDir, 'launcher.py')
+      with open(cmd, 'w') as f:
+        f.write('#!{}\nimport tool\ntool.main()\n'.format(sys.executable))
+      os.chmod(cmd, stat.S_IRWXU)
+      os.makedirs(os.path.join(tmpDir, 'tool'))
+      module = os.path.join(tmpDir, 'tool', '__init__.py')
+      digests = list()
+      for version in range(2):
+        with open(module, 'w') as f:
+          f.write('def main():\n  return {}\n'.format(version))
+        digests.append(MicrokernelCache(os.path.join(tmpDir, 'cache')).toolDigest(cmd))
+    self.assertNotEqual(digests[0], digests[1])
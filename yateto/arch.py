@@ -86,9 +86,28 @@ class Architecture(object):
     self._tmpStackLimit = 524288
     self.is_accelerator = backend != 'cpp' and self.host_name != None
 
+    # Roofline model of a single core, cf. setRoofline
+    self.peakFlopsPerCycle = 4 * self.alignedReals
+    self.cacheSizes = (32768, 1048576)
+    self.bandwidths = (2 * self.alignment, self.alignment, 8)
+
   def setTmpStackLimit(self, tmpStackLimit):
     self._tmpStackLimit = tmpStackLimit
 
+  def setRoofline(self, peakFlopsPerCycle, cacheSizes, bandwidths):
+    """Sets the parameters of the roofline model of a single core.
+
+    Args:
+      peakFlopsPerCycle (int): peak floating point operations per cycle
+      cacheSizes (tuple): sizes of the cache levels in bytes, innermost first
+      bandwidths (tuple): bandwidths of the cache levels and of the main memory in bytes per cycle
+    """
+    if len(bandwidths) != len(cacheSizes) + 1:
+      raise ValueError('Expected one bandwidth per cache level and one for the main memory.')
+    self.peakFlopsPerCycle = peakFlopsPerCycle
+    self.cacheSizes = tuple(cacheSizes)
+    self.bandwidths = tuple(bandwidths)
+
   def alignedLower(self, index):
     return index - index % self.alignedReals
 
@@ -128,6 +147,21 @@ def getArchitectureIdentifiedBy(ident):
     'thunderx2t99': Architecture(name, precision, 16, False),
     'power9': Architecture(name, precision, 16, False)
   }
+  # Peak flops per cycle in double precision, L1 and L2 size, and L1, L2, and memory bandwidth
+  roofline = {
+    'wsm': (4, (32768, 262144), (32, 32, 8)),
+    'snb': (8, (32768, 262144), (48, 32, 8)),
+    'hsw': (16, (32768, 262144), (96, 64, 8)),
+    'skx': (32, (32768, 1048576), (192, 64, 8)),
+    'knc': (16, (32768, 524288), (64, 32, 4)),
+    'knl': (32, (32768, 524288), (128, 32, 8)),
+    'rome': (16, (32768, 524288), (96, 32, 8)),
+    'thunderx2t99': (8, (32768, 262144), (32, 32, 8)),
+    'power9': (8, (32768, 524288), (64, 32, 8))
+  }
+  if name in roofline:
+    peak, cacheSizes, bandwidths = roofline[name]
+    arch[name].setRoofline(peak * 8 // arch[name].bytesPerReal, cacheSizes, bandwidths)
   return arch[name]
 
 
@@ -1,6 +1,11 @@
+import collections
+import functools
+import hashlib
 import numpy as np
 import numpy.lib
 import re
+import sys
+import threading
 from abc import ABC, abstractmethod
 
 class ASpp(ABC):
@@ -10,10 +15,20 @@ class ASpp(ABC):
     for s in shape:
       self.size *= s
     self.ndim = len(shape)
+    self._digest = None
+    self._origin = None
 
   def identity(self):
     return self
 
+  def cacheKey(self):
+    """Identifies class and content of the pattern, cf. OperationCache.
+
+    Results of cached operations are identified by the operation which computed
+    them, hence their content is not hashed.
+    """
+    return (type(self).__name__, self._origin if self._origin is not None else self.digest())
+
   @abstractmethod
   def count_nonzero(self):
     pass
@@ -50,6 +65,94 @@ class ASpp(ABC):
   def as_ndarray(self):
     pass
 
+  def digest(self):
+    """Hex digest which identifies shape and content of the pattern.
+
+    The digest is computed once, hence patterns must not be modified afterwards.
+    """
+    if self._digest is None:
+      self._digest = self._computeDigest()
+    return self._digest
+
+  @abstractmethod
+  def _computeDigest(self):
+    pass
+
+class OperationCache(object):
+  """LRU cache of the results of operations on patterns, with hit/miss statistics.
+
+  Entries are keyed by the operation, the cache keys of the patterns, and the other
+  arguments. The results of at most maxBytes, estimated from their arrays, are kept.
+  Results are shared between callers, hence must not be modified.
+  """
+  def __init__(self, maxBytes=1 << 28):
+    self.maxBytes = maxBytes
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @classmethod
+  def nbytes(cls, value):
+    if isinstance(value, np.ndarray):
+      return value.nbytes
+    if isinstance(value, ASpp):
+      return sys.getsizeof(value) + cls.nbytes(vars(value))
+    if isinstance(value, dict):
+      return sys.getsizeof(value) + sum(cls.nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+      return sys.getsizeof(value) + sum(cls.nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+  def lookup(self, key, compute):
+    """Returns the entry of key, which is computed by compute() if missing."""
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+      self.misses += 1
+    value = compute()
+    size = self.nbytes(value)
+    with self._lock:
+      if size <= self.maxBytes and key not in self._entries:
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.maxBytes:
+          _, (_, evicted) = self._entries.popitem(last=False)
+          self.bytes -= evicted
+          self.evictions += 1
+    return value
+
+  def __len__(self):
+    return len(self._entries)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.bytes = 0
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+# Shared by all pattern operations of the process; set maxBytes to 0 to disable it
+cache = OperationCache()
+
+def _cached(operation):
+  """Serves repeated calls of operation with equal arguments from the cache."""
+  @functools.wraps(operation)
+  def cachedOperation(*args):
+    if cache.maxBytes <= 0:
+      return operation(*args)
+    key = (operation.__qualname__,) + tuple(arg.cacheKey() if isinstance(arg, ASpp) else str(arg) for arg in args)
+    value = cache.lookup(key, lambda: operation(*args))
+    if isinstance(value, ASpp) and value._origin is None and value._digest is None and all(value is not arg for arg in args):
+      value._origin = hashlib.md5(repr(key).encode()).hexdigest()
+    return value
+  return cachedOperation
+
 class dense(ASpp):
   def count_nonzero(self):
     return self.size
@@ -105,12 +208,30 @@ class dense(ASpp):
   def as_general(self):
     return general(self.as_ndarray())
 
+  def as_packed(self):
+    return packed(self.as_ndarray())
+
+  def as_coo(self):
+    return coo(self.as_ndarray())
+
+  def as_blocked(self):
+    return blocked(self.as_ndarray())
+
   def as_ndarray(self):
     return np.ones(self.shape, dtype=bool, order=general.NUMPY_DEFAULT_ORDER)
 
+  def _computeDigest(self):
+    return hashlib.md5('dense{}'.format(self.shape).encode()).hexdigest()
+
 class general(ASpp):
   NUMPY_DEFAULT_ORDER = 'F'
   OPTIMIZE_EINSUM = {'optimize': True } if np.lib.NumpyVersion(np.__version__) >= '1.12.0' else {}
+  # Contractions over index spaces of at least MATMUL_MIN_WORK entries, whose operands
+  # have at least MATMUL_MIN_OPERANDS entries in product, are computed by BLAS matrix
+  # products of MATMUL_DTYPE, which beat np.einsum on bool but have a larger overhead
+  MATMUL_MIN_OPERANDS = 1 << 17
+  MATMUL_MIN_WORK = 1 << 15
+  MATMUL_DTYPE = np.float32
 
   def __init__(self, npspp: np.ndarray):
     super().__init__(npspp.shape)
@@ -135,6 +256,7 @@ class general(ASpp):
       cache[tail] = cls.sumAxes(spp, cache, tail)
     return cache[tail].sum(axis=head)
 
+  @_cached
   def nnzbounds(self):
     n = len(self.shape)
     bounds = list()
@@ -160,6 +282,7 @@ class general(ASpp):
   def transposed(self, perm):
     return type(self)(self.pattern.transpose(perm).copy(order=self.NUMPY_DEFAULT_ORDER))
 
+  @_cached
   def indexSum(self, sourceIndices, targetIndices):
     return general(np.einsum('{}->{}'.format(sourceIndices, targetIndices), self.pattern))
 
@@ -169,33 +292,672 @@ class general(ASpp):
 
   @staticmethod
   def einsum(description, a1, a2):
-    return general(np.einsum(description, a1.pattern, a2.pattern))
+    # Checked before the description is analysed, as the overhead of the analysis
+    # exceeds the run time of np.einsum for small operands
+    if a1.size * a2.size < general.MATMUL_MIN_OPERANDS:
+      return general(np.einsum(description, a1.pattern, a2.pattern))
+    p = re.match(r'(\w*),(\w*)->(\w*)', description)
+    if not p or any(len(set(indices)) != len(indices) for indices in p.groups()):
+      return general(np.einsum(description, a1.pattern, a2.pattern))
+    A, B, C = p.groups()
+    extents = {index: a1.shape[A.find(index)] for index in A}
+    extents.update({index: a2.shape[B.find(index)] for index in B})
+    extent = lambda group: functools.reduce(lambda size, index: size * extents[index], group, 1)
+    if extent(extents.keys()) < general.MATMUL_MIN_WORK:
+      return general(np.einsum(description, a1.pattern, a2.pattern))
+    a1, A = _sumExclusive(a1, A, B, C)
+    a2, B = _sumExclusive(a2, B, A, C)
+    contracted = ''.join(index for index in A if index in B and index not in C)
+    if not contracted:
+      # Every entry is the AND of two entries, hence there are no reductions
+      return general(np.einsum('{},{}->{}'.format(A, B, C), a1.pattern, a2.pattern))
+
+    batch = ''.join(index for index in A if index in B and index in C)
+    freeA = ''.join(index for index in A if index not in B)
+    freeB = ''.join(index for index in B if index not in A)
+    nb, n1, n2, nk = extent(batch), extent(freeA), extent(freeB), extent(contracted)
+
+    # An entry is non-zero iff the matrix product of the operands as 0/1 matrices is
+    # positive, which holds in floating point arithmetic, too
+    matrix = lambda a, indices, order, shape: \
+      a.pattern.transpose([indices.find(index) for index in order]).reshape(shape).astype(general.MATMUL_DTYPE)
+    product = np.matmul(matrix(a1, A, batch + freeA + contracted, (nb, n1, nk)),
+                        matrix(a2, B, batch + contracted + freeB, (nb, nk, n2))) > 0
+    order = batch + freeA + freeB
+    product = product.reshape(tuple(extents[index] for index in order))
+    return general(product.transpose(tuple(order.find(index) for index in C)))
 
   @staticmethod
   def array_equal(a1, a2):
     return np.array_equal(a1.pattern, a2.pattern)
 
+  def as_packed(self):
+    return packed(self.pattern)
+
+  def as_coo(self):
+    return coo(self.pattern)
+
+  def as_blocked(self):
+    return blocked(self.pattern)
+
   def as_ndarray(self):
     return self.pattern
 
+  def _computeDigest(self):
+    sha = hashlib.md5('general{}'.format(self.shape).encode())
+    sha.update(np.packbits(np.ravel(self.pattern, order=self.NUMPY_DEFAULT_ORDER)).tobytes())
+    return sha.hexdigest()
+
+def _sumExclusive(a, indices, other, result):
+  """Sums the indices of a which occur neither in other nor in result."""
+  target = ''.join(index for index in indices if index in other or index in result)
+  return (a.indexSum(indices, target) if target != indices else a), target
+
+def _popcount(words):
+  if hasattr(np, 'bitwise_count'):
+    return np.bitwise_count(words)
+  return packed.POPCOUNT[words]
+
+class packed(ASpp):
+  """Pattern with one bit per entry, packed along the first axis.
+
+  words[w, j, ...] holds the entries 8w, ..., 8w+7 of the first axis in its bits
+  0, ..., 7; padding bits are zero. Unions, counts, bounds, and index sums work on
+  the words. Contractions pack the contracted indices and compute every entry by a
+  word-wise AND and OR. Only transpositions and reshapes which change the first
+  axis unpack the pattern.
+  """
+  POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+  # Upper bound in bytes on the temporary array of a contraction
+  CHUNK_BYTES = 1 << 24
+
+  def __init__(self, npspp: np.ndarray):
+    npspp = np.asarray(npspp, dtype=bool)
+    super().__init__(npspp.shape)
+    self.words = self._pack(npspp)
+
+  @staticmethod
+  def _pack(npspp):
+    if npspp.ndim == 0:
+      npspp = npspp.reshape(1)
+    return np.packbits(npspp, axis=0, bitorder='little')
+
+  @classmethod
+  def _fromWords(cls, shape, words):
+    spp = cls.__new__(cls)
+    ASpp.__init__(spp, shape)
+    spp.words = words
+    return spp
+
+  def _unpack(self):
+    n = self.shape[0] if self.ndim > 0 else 1
+    return np.unpackbits(self.words, axis=0, count=n, bitorder='little').astype(bool).reshape(self.shape)
+
+  def count_nonzero(self):
+    return int(np.sum(_popcount(self.words), dtype=np.int64))
+
+  def is_dense(self):
+    return self.count_nonzero() == self.size
+
+  @_cached
+  def nnzbounds(self):
+    bounds = list()
+    for axis in range(self.ndim):
+      others = tuple(a for a in range(self.ndim) if a != axis)
+      if axis == 0:
+        rows = np.bitwise_or.reduce(self.words, axis=others) if others else self.words
+        nonzeros = np.unpackbits(rows, count=self.shape[0], bitorder='little').nonzero()[0]
+      else:
+        nonzeros = np.any(self.words != 0, axis=others).nonzero()[0]
+      bounds.append((nonzeros[0], nonzeros[-1]))
+    return bounds
+
+  def nonzero(self):
+    return self._unpack().nonzero()
+
+  def copy(self):
+    return self._fromWords(self.shape, self.words.copy())
+
+  def reshape(self, shape):
+    shape = tuple(shape)
+    if -1 in shape:
+      known = int(np.prod([s for s in shape if s != -1], dtype=np.int64))
+      shape = tuple(self.size // known if s == -1 else s for s in shape)
+    if self.ndim > 0 and len(shape) > 0 and shape[0] == self.shape[0]:
+      words = self.words.reshape((self.words.shape[0],) + shape[1:], order=general.NUMPY_DEFAULT_ORDER)
+      return self._fromWords(shape, words)
+    return type(self)(self._unpack().reshape(shape, order=general.NUMPY_DEFAULT_ORDER))
+
+  def transposed(self, perm):
+    perm = tuple(perm)
+    if len(perm) == 0:
+      return self.copy()
+    if perm[0] == 0:
+      return self._fromWords(tuple(self.shape[p] for p in perm), self.words.transpose(perm).copy())
+    return type(self)(self._unpack().transpose(perm))
+
+  @_cached
+  def indexSum(self, sourceIndices, targetIndices):
+    source = str(sourceIndices)
+    target = str(targetIndices)
+    summed = tuple(axis for axis, index in enumerate(source) if index not in target)
+    kept = [index for index in source if index in target]
+    if source and source[0] in target:
+      words = np.bitwise_or.reduce(self.words, axis=summed) if summed else self.words
+      spp = self._fromWords(tuple(self.shape[source.find(index)] for index in kept), words)
+    else:
+      # The first axis is summed: a word is non-zero iff one of its entries is
+      nonzero = np.any(self.words != 0, axis=summed) if self.ndim > 0 else self.words != 0
+      spp = type(self)(nonzero.reshape(tuple(self.shape[source.find(index)] for index in kept)))
+    return spp.transposed(tuple(kept.index(index) for index in target))
+
+  @classmethod
+  def _matrix(cls, a, indices, batch, free, contracted):
+    """Returns the bits of a as (batch, free, packed contracted) words."""
+    order = [indices.find(index) for index in batch + free + contracted]
+    bits = a._unpack().transpose(order)
+    extent = lambda group: int(np.prod([a.shape[indices.find(index)] for index in group], dtype=np.int64))
+    bits = bits.reshape((extent(batch), extent(free), extent(contracted)))
+    return np.packbits(bits, axis=2, bitorder='little')
+
+  @staticmethod
+  def add(a1, a2):
+    assert a1.shape == a2.shape
+    return packed._fromWords(a1.shape, np.bitwise_or(a1.words, a2.words))
+
+  @staticmethod
+  def einsum(description, a1, a2):
+    p = re.match(r'(\w*),(\w*)->(\w*)', description)
+    if not p:
+      raise ValueError(description + ' not understood.')
+    A, B, C = p.groups()
+    a1, A = _sumExclusive(a1, A, B, C)
+    a2, B = _sumExclusive(a2, B, A, C)
+    contracted = ''.join(index for index in A if index in B and index not in C)
+    if not contracted:
+      pattern = np.einsum('{},{}->{}'.format(A, B, C), a1._unpack(), a2._unpack())
+      return packed(pattern)
+
+    batch = ''.join(index for index in A if index in B and index in C)
+    freeA = ''.join(index for index in A if index not in B)
+    freeB = ''.join(index for index in B if index not in A)
+    words1 = packed._matrix(a1, A, batch, freeA, contracted)
+    words2 = packed._matrix(a2, B, batch, freeB, contracted)
+    nb, n1, nw = words1.shape
+    n2 = words2.shape[1]
+    result = np.empty((nb, n1, n2), dtype=bool)
+    # An entry is non-zero iff the AND of some pair of words is non-zero
+    chunk = max(1, packed.CHUNK_BYTES // max(1, n2 * nw))
+    for b in range(nb):
+      for start in range(0, n1, chunk):
+        stop = min(n1, start + chunk)
+        result[b, start:stop] = np.any(words1[b, start:stop, None, :] & words2[b, None, :, :], axis=2)
+
+    extents = {index: a1.shape[A.find(index)] for index in A}
+    extents.update({index: a2.shape[B.find(index)] for index in B})
+    order = batch + freeA + freeB
+    result = result.reshape(tuple(extents[index] for index in order))
+    return packed(result.transpose(tuple(order.find(index) for index in C)))
+
+  @staticmethod
+  def array_equal(a1, a2):
+    return a1.shape == a2.shape and np.array_equal(a1.words, a2.words)
+
+  def as_general(self):
+    return general(self._unpack())
+
+  def as_packed(self):
+    return self
+
+  def as_coo(self):
+    return coo(self._unpack())
+
+  def as_blocked(self):
+    return blocked(self._unpack())
+
+  def as_ndarray(self):
+    pattern = self._unpack()
+    return pattern.copy(order=general.NUMPY_DEFAULT_ORDER)
+
+  def _computeDigest(self):
+    # Equal to the digest of the general pattern with the same entries
+    return general(self._unpack()).digest()
+
+class coo(ASpp):
+  """Pattern given by the coordinates of its non-zeros.
+
+  coordinates[n] is the multi-index of the n-th non-zero; the rows are unique and
+  sorted lexicographically, i.e. in the order of nonzero(). Memory and run time
+  scale with the number of non-zeros instead of the size. Contractions join the
+  non-zeros of both operands on their shared indices.
+  """
+  # dispatch stores the result of an operation as coordinates if the operands have
+  # at most this fraction of non-zeros
+  DENSITY_THRESHOLD = 0.01
+
+  def __init__(self, npspp: np.ndarray):
+    npspp = np.asarray(npspp, dtype=bool)
+    super().__init__(npspp.shape)
+    self.coordinates = np.argwhere(npspp).astype(np.int64)
+
+  @staticmethod
+  def _strides(shape, order='C'):
+    strides = np.ones(len(shape), dtype=np.int64)
+    axes = range(len(shape) - 2, -1, -1) if order == 'C' else range(1, len(shape))
+    for axis in axes:
+      neighbour = axis + 1 if order == 'C' else axis - 1
+      strides[axis] = strides[neighbour] * shape[neighbour]
+    return strides
+
+  @staticmethod
+  def _unravel(keys, shape, order='C'):
+    return (keys[:, None] // coo._strides(shape, order)) % np.array(shape, dtype=np.int64)
+
+  @classmethod
+  def _fromCoordinates(cls, shape, coordinates):
+    """Sorts the coordinates and removes duplicates."""
+    shape = tuple(shape)
+    keys = np.unique(coordinates @ cls._strides(shape))
+    spp = cls.__new__(cls)
+    ASpp.__init__(spp, shape)
+    spp.coordinates = cls._unravel(keys, shape)
+    return spp
+
+  def count_nonzero(self):
+    return self.coordinates.shape[0]
+
+  def is_dense(self):
+    return self.count_nonzero() == self.size
+
+  @_cached
+  def nnzbounds(self):
+    return [(column.min(), column.max()) for column in self.coordinates.T]
+
+  def nonzero(self):
+    return tuple(self.coordinates[:, axis] for axis in range(self.ndim))
+
+  def copy(self):
+    return self._fromCoordinates(self.shape, self.coordinates.copy())
+
+  def reshape(self, shape):
+    shape = tuple(shape)
+    if -1 in shape:
+      known = int(np.prod([s for s in shape if s != -1], dtype=np.int64))
+      shape = tuple(self.size // known if s == -1 else s for s in shape)
+    assert self.size == int(np.prod(shape, dtype=np.int64))
+    keys = self.coordinates @ self._strides(self.shape, general.NUMPY_DEFAULT_ORDER)
+    return self._fromCoordinates(shape, self._unravel(keys, shape, general.NUMPY_DEFAULT_ORDER))
+
+  def transposed(self, perm):
+    perm = list(perm)
+    return self._fromCoordinates(tuple(self.shape[p] for p in perm), self.coordinates[:, perm])
+
+  @_cached
+  def indexSum(self, sourceIndices, targetIndices):
+    source = str(sourceIndices)
+    columns = [source.find(index) for index in str(targetIndices)]
+    return self._fromCoordinates(tuple(self.shape[c] for c in columns), self.coordinates[:, columns])
+
+  @staticmethod
+  def add(a1, a2):
+    assert a1.shape == a2.shape
+    return coo._fromCoordinates(a1.shape, np.concatenate((a1.coordinates, a2.coordinates)))
+
+  @staticmethod
+  def _groups(a, indices, shared, extents):
+    """Sorts the non-zeros of a by their shared indices.
+
+    Returns the permutation, the distinct keys of the shared indices, and the start
+    and length of the run of every key in the sorted non-zeros.
+    """
+    strides = coo._strides([extents[index] for index in shared])
+    keys = a.coordinates[:, [indices.find(index) for index in shared]] @ strides
+    order = np.argsort(keys, kind='stable')
+    unique, start, count = np.unique(keys[order], return_index=True, return_counts=True)
+    return order, unique, start, count
+
+  @staticmethod
+  def einsum(description, a1, a2):
+    p = re.match(r'(\w*),(\w*)->(\w*)', description)
+    if not p:
+      raise ValueError(description + ' not understood.')
+    A, B, C = p.groups()
+    a1, A = _sumExclusive(a1, A, B, C)
+    a2, B = _sumExclusive(a2, B, A, C)
+    extents = {index: a1.shape[A.find(index)] for index in A}
+    extents.update({index: a2.shape[B.find(index)] for index in B})
+    shared = ''.join(index for index in A if index in B)
+
+    order1, keys1, start1, count1 = coo._groups(a1, A, shared, extents)
+    order2, keys2, start2, count2 = coo._groups(a2, B, shared, extents)
+    _, i1, i2 = np.intersect1d(keys1, keys2, assume_unique=True, return_indices=True)
+    start1, count1 = start1[i1], count1[i1]
+    start2, count2 = start2[i2], count2[i2]
+    # Every pair of non-zeros with equal shared indices yields a non-zero
+    pairs = count1 * count2
+    group = np.repeat(np.arange(pairs.size), pairs)
+    offset = np.arange(group.size) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+    rows1 = order1[start1[group] + offset // count2[group]]
+    rows2 = order2[start2[group] + offset % count2[group]]
+
+    columns = [a1.coordinates[rows1, A.find(index)] if index in A else a2.coordinates[rows2, B.find(index)] for index in C]
+    coordinates = np.stack(columns, axis=1) if columns else np.zeros((group.size, 0), dtype=np.int64)
+    return coo._fromCoordinates(tuple(extents[index] for index in C), coordinates)
+
+  @staticmethod
+  def array_equal(a1, a2):
+    return a1.shape == a2.shape and np.array_equal(a1.coordinates, a2.coordinates)
+
+  def as_general(self):
+    return general(self.as_ndarray())
+
+  def as_packed(self):
+    return packed(self.as_ndarray())
+
+  def as_coo(self):
+    return self
+
+  def as_blocked(self):
+    return blocked(self.as_ndarray())
+
+  def as_ndarray(self):
+    if self.ndim == 0:
+      return np.array(self.count_nonzero() > 0)
+    pattern = np.zeros(self.shape, dtype=bool, order=general.NUMPY_DEFAULT_ORDER)
+    pattern[self.nonzero()] = True
+    return pattern
+
+  def _computeDigest(self):
+    # Equal to the digest of the general pattern with the same entries
+    return general(self.as_ndarray()).digest()
+
+class blocked(ASpp):
+  """Pattern on a grid of blocks, each of which is zero, dense, or general.
+
+  grid[axis] holds the increasing offsets of the blocks along axis, starting at 0
+  and ending at shape[axis]; if grid is None, every axis is one block. flags holds
+  the kind of every block and patterns the entries of the general blocks. Sums,
+  unions, and contractions work on blocks, hence their cost scales with the number
+  of blocks as long as the blocks are zero or dense. Operands on different grids
+  are refined to the union of their offsets. Reshapes lose the block structure.
+
+  The block structure is queried with blockShape(), nonzeroBlocks(), blockFlag(),
+  blockRange(), and blockPattern(), e.g. to select memory layouts or to split
+  GEMMs into blocks.
+  """
+  ZERO = 0
+  DENSE = 1
+  GENERAL = 2
+
+  def __init__(self, npspp: np.ndarray, grid=None):
+    npspp = np.asarray(npspp, dtype=bool)
+    super().__init__(npspp.shape)
+    self.grid = self._checkGrid(self.shape, grid)
+    self.flags = np.zeros(self.blockShape(), dtype=np.int8)
+    self.patterns = dict()
+    for block in np.ndindex(*self.blockShape()):
+      self._setBlock(block, npspp[self._slices(block)])
+
+  @classmethod
+  def _checkGrid(cls, shape, grid):
+    if grid is None:
+      return tuple((0, s) if s > 0 else (0,) for s in shape)
+    grid = tuple(tuple(int(offset) for offset in offsets) for offsets in grid)
+    if len(grid) != len(shape) or \
+       any(offsets[0] != 0 or offsets[-1] != s or any(a >= b for a, b in zip(offsets[:-1], offsets[1:]))
+           for offsets, s in zip(grid, shape) if s > 0):
+      raise ValueError('Grid {} does not partition shape {}.'.format(grid, shape))
+    return grid
+
+  @classmethod
+  def _fromBlocks(cls, shape, grid, flags, patterns):
+    spp = cls.__new__(cls)
+    ASpp.__init__(spp, shape)
+    spp.grid = grid
+    spp.flags = flags
+    spp.patterns = patterns
+    return spp
+
+  def cacheKey(self):
+    return super().cacheKey() + (self.grid,)
+
+  def _slices(self, block):
+    return tuple(slice(offsets[b], offsets[b+1]) for offsets, b in zip(self.grid, block))
+
+  def _setBlock(self, block, pattern):
+    if pattern.any() and not pattern.all():
+      self.flags[block] = self.GENERAL
+      self.patterns[block] = np.asarray(pattern, order=general.NUMPY_DEFAULT_ORDER)
+    else:
+      self.flags[block] = self.DENSE if pattern.any() else self.ZERO
+      self.patterns.pop(block, None)
+
+  def blockShape(self):
+    """Returns the number of blocks along every axis."""
+    return tuple(len(offsets) - 1 for offsets in self.grid)
+
+  def nonzeroBlocks(self):
+    """Returns the indices of the dense and general blocks in lexicographic order."""
+    return [tuple(int(b) for b in block) for block in np.argwhere(self.flags != self.ZERO)]
+
+  def blockFlag(self, block):
+    """Returns ZERO, DENSE, or GENERAL."""
+    return int(self.flags[tuple(block)])
+
+  def blockRange(self, block):
+    """Returns the (start, stop) of a block along every axis."""
+    return tuple((offsets[b], offsets[b+1]) for offsets, b in zip(self.grid, block))
+
+  def blockPattern(self, block):
+    """Returns the entries of a block as boolean array."""
+    block = tuple(block)
+    flag = self.flags[block]
+    if flag == self.GENERAL:
+      return self.patterns[block]
+    shape = tuple(stop - start for start, stop in self.blockRange(block))
+    return np.full(shape, flag == self.DENSE, dtype=bool, order=general.NUMPY_DEFAULT_ORDER)
+
+  def count_nonzero(self):
+    nnz = sum(int(np.count_nonzero(pattern)) for pattern in self.patterns.values())
+    for block in np.argwhere(self.flags == self.DENSE):
+      nnz += int(np.prod([stop - start for start, stop in self.blockRange(block)], dtype=np.int64))
+    return nnz
+
+  def is_dense(self):
+    return bool(np.all(self.flags == self.DENSE))
+
+  @_cached
+  def nnzbounds(self):
+    bounds = list()
+    for axis in range(self.ndim):
+      others = tuple(a for a in range(self.ndim) if a != axis)
+      lower, upper = list(), list()
+      for block in self.nonzeroBlocks():
+        start, stop = self.blockRange(block)[axis]
+        if self.flags[block] == self.GENERAL:
+          nonzeros = np.any(self.patterns[block], axis=others).nonzero()[0]
+          lower.append(start + nonzeros[0])
+          upper.append(start + nonzeros[-1])
+        else:
+          lower.append(start)
+          upper.append(stop - 1)
+      bounds.append((min(lower), max(upper)))
+    return bounds
+
+  def nonzero(self):
+    return self.as_ndarray().nonzero()
+
+  def copy(self):
+    return self._fromBlocks(self.shape, self.grid, self.flags.copy(), {block: pattern.copy() for block, pattern in self.patterns.items()})
+
+  def reshape(self, shape):
+    return type(self)(self.as_ndarray().reshape(shape, order=general.NUMPY_DEFAULT_ORDER))
+
+  def transposed(self, perm):
+    indices = ''.join(chr(ord('a') + axis) for axis in range(self.ndim))
+    return self.indexSum(indices, ''.join(indices[p] for p in perm))
+
+  def regrid(self, grid):
+    """Returns the pattern on grid, which must refine the grid of this pattern."""
+    grid = self._checkGrid(self.shape, grid)
+    if any(not set(old) <= set(new) for old, new in zip(self.grid, grid)):
+      raise ValueError('Grid {} does not refine grid {}.'.format(grid, self.grid))
+    if grid == self.grid:
+      return self
+    parents = [np.searchsorted(old, new[:-1], side='right') - 1 for old, new in zip(self.grid, grid)]
+    spp = self._fromBlocks(self.shape, grid, self.flags[np.ix_(*parents)], dict())
+    for block in np.argwhere(spp.flags == self.GENERAL):
+      block = tuple(block)
+      parent = tuple(int(p[b]) for p, b in zip(parents, block))
+      local = tuple(slice(start - old[p], stop - old[p]) for (start, stop), old, p in zip(spp.blockRange(block), self.grid, parent))
+      spp._setBlock(block, self.patterns[parent][local])
+    return spp
+
+  @staticmethod
+  def _mergeGrids(grid1, grid2):
+    return tuple(sorted(set(offsets1) | set(offsets2)) for offsets1, offsets2 in zip(grid1, grid2))
+
+  def _accumulate(self, block, pattern):
+    """ORs pattern into a block; None stands for a dense block."""
+    if self.flags[block] == self.DENSE:
+      return
+    if pattern is None:
+      self.flags[block] = self.DENSE
+      self.patterns.pop(block, None)
+    elif self.flags[block] == self.GENERAL:
+      self._setBlock(block, self.patterns[block] | pattern)
+    else:
+      self._setBlock(block, pattern)
+
+  @_cached
+  def indexSum(self, sourceIndices, targetIndices):
+    source = str(sourceIndices)
+    target = str(targetIndices)
+    axes = [source.find(index) for index in target]
+    spp = self._fromBlocks(tuple(self.shape[a] for a in axes), tuple(self.grid[a] for a in axes),
+                           np.zeros(tuple(self.flags.shape[a] for a in axes), dtype=np.int8), dict())
+    description = '{}->{}'.format(source, target)
+    for block in self.nonzeroBlocks():
+      pattern = None if self.flags[block] == self.DENSE else np.einsum(description, self.patterns[block])
+      spp._accumulate(tuple(block[a] for a in axes), pattern)
+    return spp
+
+  @staticmethod
+  def add(a1, a2):
+    assert a1.shape == a2.shape
+    grid = blocked._mergeGrids(a1.grid, a2.grid)
+    a1 = a1.regrid(grid).copy()
+    a2 = a2.regrid(grid)
+    for block in a2.nonzeroBlocks():
+      a1._accumulate(block, None if a2.flags[block] == blocked.DENSE else a2.patterns[block])
+    return a1
+
+  @staticmethod
+  def einsum(description, a1, a2):
+    p = re.match(r'(\w*),(\w*)->(\w*)', description)
+    if not p:
+      raise ValueError(description + ' not understood.')
+    A, B, C = p.groups()
+    a1, A = _sumExclusive(a1, A, B, C)
+    a2, B = _sumExclusive(a2, B, A, C)
+    shared = ''.join(index for index in A if index in B)
+    grids = {index: a1.grid[A.find(index)] for index in A}
+    for index in B:
+      grids[index] = tuple(sorted(set(grids.get(index, ())) | set(a2.grid[B.find(index)])))
+    a1 = a1.regrid(tuple(grids[index] for index in A))
+    a2 = a2.regrid(tuple(grids[index] for index in B))
+
+    extents = {index: a1.shape[A.find(index)] for index in A}
+    extents.update({index: a2.shape[B.find(index)] for index in B})
+    spp = blocked._fromBlocks(tuple(extents[index] for index in C), tuple(grids[index] for index in C),
+                              np.zeros(tuple(len(grids[index]) - 1 for index in C), dtype=np.int8), dict())
+    # Join the non-zero blocks on the shared indices
+    blocks2 = dict()
+    for block in a2.nonzeroBlocks():
+      blocks2.setdefault(tuple(block[B.find(index)] for index in shared), list()).append(block)
+    description = '{},{}->{}'.format(A, B, C)
+    for block1 in a1.nonzeroBlocks():
+      for block2 in blocks2.get(tuple(block1[A.find(index)] for index in shared), []):
+        block = tuple(block1[A.find(index)] if index in A else block2[B.find(index)] for index in C)
+        if spp.flags[block] == blocked.DENSE:
+          continue
+        if a1.flags[block1] == blocked.DENSE and a2.flags[block2] == blocked.DENSE:
+          pattern = None
+        else:
+          pattern = np.einsum(description, a1.blockPattern(block1), a2.blockPattern(block2))
+        spp._accumulate(block, pattern)
+    return spp
+
+  @staticmethod
+  def array_equal(a1, a2):
+    if a1.shape != a2.shape:
+      return False
+    grid = blocked._mergeGrids(a1.grid, a2.grid)
+    a1 = a1.regrid(grid)
+    a2 = a2.regrid(grid)
+    return np.array_equal(a1.flags, a2.flags) and \
+           all(np.array_equal(pattern, a2.patterns[block]) for block, pattern in a1.patterns.items())
+
+  def as_general(self):
+    return general(self.as_ndarray())
+
+  def as_blocked(self):
+    return self
+
+  def as_ndarray(self):
+    pattern = np.zeros(self.shape, dtype=bool, order=general.NUMPY_DEFAULT_ORDER)
+    for block in self.nonzeroBlocks():
+      pattern[self._slices(block)] = self.blockPattern(block)
+    return pattern
+
+  def _computeDigest(self):
+    # Equal to the digest of the general pattern with the same entries
+    return general(self.as_ndarray()).digest()
+
 _binary_op = {
   (dense, dense): dense,
   (dense, general): general,
   (general, dense): general,
-  (general, general): general
+  (general, general): general,
+  (dense, packed): packed,
+  (packed, dense): packed,
+  (general, packed): packed,
+  (packed, general): packed,
+  (packed, packed): packed,
+  (dense, coo): general,
+  (coo, dense): general,
+  (general, coo): general,
+  (coo, general): general,
+  (coo, coo): coo,
+  (packed, coo): packed,
+  (coo, packed): packed,
+  (dense, blocked): blocked,
+  (blocked, dense): blocked,
+  (general, blocked): blocked,
+  (blocked, general): blocked,
+  (packed, blocked): blocked,
+  (blocked, packed): blocked,
+  (coo, blocked): blocked,
+  (blocked, coo): blocked,
+  (blocked, blocked): blocked
 }
 
 def dispatch(a1, a2):
   cls = _binary_op[(a1.__class__, a2.__class__)]
+  if cls is general or cls is coo:
+    sparse = all(a.count_nonzero() <= coo.DENSITY_THRESHOLD * a.size for a in (a1, a2))
+    cls = coo if sparse else general
   castMethod = 'as_' + cls.__name__
   c1 = getattr(a1, castMethod, a1.identity)
   c2 = getattr(a2, castMethod, a2.identity)
   return cls, c1(), c2()
 
+@_cached
 def add(a1, a2):
   cls, a1, a2 = dispatch(a1, a2)
   return cls.add(a1, a2)
 
+@_cached
 def einsum(description, a1, a2):
   cls, a1, a2 = dispatch(a1, a2)
   return cls.einsum(description, a1, a2)
@@ -1,7 +1,13 @@
 from .indices import BoundingBox
+from .node import Product, IndexSum
+from ..memory import DenseMemoryLayout
 from abc import ABC, abstractmethod
 
 class CostEstimator(ABC):
+  # True if estimates only depend on the node, such that an instance may be shared
+  # by the searches of several Einsums, cf. opt.NodeTable.costEstimator
+  stateless = False
+
   def estimate(self, node):
     childCost = 0
     for child in node:
@@ -15,6 +21,8 @@ class CostEstimator(ABC):
     pass
 
 class ShapeCostEstimator(CostEstimator):
+  stateless = True
+
   def generic_estimate(self, node):
     return 0
 
@@ -31,6 +39,8 @@ class ShapeCostEstimator(CostEstimator):
     return cost
 
 class CachedCostEstimator(CostEstimator):
+  stateless = True
+
   def __init__(self):
     self._cost = dict()
   
@@ -81,6 +91,52 @@ class BoundingBoxCostEstimator(CachedCostEstimator):
     return tbb.size() - bb.size()
 
 
+class RooflineCostEstimator(BoundingBoxCostEstimator):
+  """Estimates the run time in cycles with a roofline model.
+
+  A product or index sum takes max(flops / peak, bytes / bandwidth) cycles. Bytes
+  are the bounding boxes of the operands it reads and of the result it writes, and
+  the bandwidth is the one of the smallest cache holding both. The product inside
+  an index sum, i.e. a contraction, is neither written nor read again.
+  The parameters are taken from the architecture, which defaults to the one set
+  by useArchitectureIdentifiedBy, cf. Architecture.setRoofline.
+  """
+  def __init__(self, arch=None):
+    super().__init__()
+    if arch is None:
+      arch = DenseMemoryLayout.ALIGNMENT_ARCH
+    if arch is None:
+      from ..arch import getArchitectureIdentifiedBy
+      arch = getArchitectureIdentifiedBy('dnoarch')
+    self._arch = arch
+    self._time = dict()
+
+  @staticmethod
+  def _fused(node, child):
+    return isinstance(node, IndexSum) and isinstance(child, (Product, IndexSum))
+
+  def _bandwidth(self, workingSet):
+    for cacheSize, bandwidth in zip(self._arch.cacheSizes, self._arch.bandwidths):
+      if workingSet <= cacheSize:
+        return bandwidth
+    return self._arch.bandwidths[-1]
+
+  def estimate(self, node, materialized=True):
+    key = (node, materialized)
+    if key in self._time:
+      return self._time[key]
+    time = sum(self.estimate(child, not self._fused(node, child)) for child in node)
+    method = 'estimate_' + node.__class__.__name__
+    flops = getattr(self, method, self.generic_estimate)(node)
+    if isinstance(node, (Product, IndexSum)):
+      reads = sum(self._cache[child].size() for child in node if not self._fused(node, child))
+      writes = self._cache[node].size() if materialized else 0
+      bytes = (reads + writes) * self._arch.bytesPerReal
+      time += max(flops / self._arch.peakFlopsPerCycle, bytes / self._bandwidth(bytes))
+    self._time[key] = time
+    return time
+
+
 class FusedGemmsBoundingBoxCostEstimator(BoundingBoxCostEstimator):
   """Estimates num. of hardware flops for a tensor operation per GPU thread.
   Therefore, results of BoundingBoxCostEstimator are divided by a size
@@ -88,6 +144,9 @@ class FusedGemmsBoundingBoxCostEstimator(BoundingBoxCostEstimator):
   Note, the estimator includes GPU caching. This estimator is relevant to
   fused gemms kernels.
   """
+  # The cost of a product depends on the operands estimated before
+  stateless = False
+
   def __init__(self):
     super().__init__()
     self._lead_dim = 0
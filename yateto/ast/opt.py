@@ -1,25 +1,127 @@
+import collections
+import random
 import sys
-from .node import IndexSum, Product
+import time
+from .node import IndexedTensor, IndexSum, Product
 
-def strengthReduction(terms, target_indices, cost_estimator, split = 0):
+class SearchStatistics(object):
+  """Work of the contraction order search.
+
+  explored is the number of (partial) trees which are estimated, pruned is the
+  number of (partial) trees which are discarded by a lower bound, and
+  budgetExceeded is true if the search was stopped before it was complete.
+  """
+  def __init__(self, explored=0, pruned=0, budgetExceeded=False):
+    self.explored = explored
+    self.pruned = pruned
+    self.budgetExceeded = budgetExceeded
+
+  def add(self, other):
+    self.explored += other.explored
+    self.pruned += other.pruned
+    self.budgetExceeded = self.budgetExceeded or other.budgetExceeded
+
+  def __repr__(self):
+    return 'SearchStatistics(explored={}, pruned={}, budgetExceeded={})'.format(self.explored, self.pruned, self.budgetExceeded)
+
+class NodeTable(object):
+  """Hash-consing of the products and index sums created by the search.
+
+  Structurally equal nodes are represented by a single object, hence the caches of
+  CachedCostEstimator and CachedVisitor, which are keyed by nodes, hit for every
+  subexpression which is created again. Leaves are identified by tensor, indices,
+  and equivalent sparsity pattern, such that a table may be shared by the searches
+  of several Einsums. Nodes of the table must not be modified; tree returns a copy.
+  """
+  def __init__(self):
+    self._nodes = dict()
+    self._costEstimators = dict()
+
+  def costEstimator(self, costEstimatorClass):
+    """Returns an instance of costEstimatorClass for the search of an Einsum.
+
+    Instances of stateless estimators are shared by all users of the table.
+    Other estimators, e.g. FusedGemmsBoundingBoxCostEstimator, are created anew,
+    such that the tree of an Einsum does not depend on the Einsums searched before.
+    """
+    if not getattr(costEstimatorClass, 'stateless', False):
+      return costEstimatorClass()
+    if costEstimatorClass not in self._costEstimators:
+      self._costEstimators[costEstimatorClass] = costEstimatorClass()
+    return self._costEstimators[costEstimatorClass]
+
+  def _intern(self, key, create):
+    node = self._nodes.get(key)
+    if node is None:
+      node = create()
+      self._nodes[key] = node
+    return node
+
+  @staticmethod
+  def _leafKey(node):
+    if isinstance(node, IndexedTensor):
+      eqspp = node.eqspp()
+      return ('IndexedTensor', node.tensor.namespace, node.tensor.name(), str(node.indices),
+              eqspp.digest() if eqspp is not None else None)
+    # Other leaves are kept alive by the table, hence their id is not reused
+    return ('Node', id(node))
+
+  def leaf(self, node):
+    return self._intern(self._leafKey(node), lambda: node)
+
+  def product(self, left, right):
+    return self._intern(('Product', id(left), id(right)), lambda: Product(left, right))
+
+  def indexSum(self, term, index):
+    return self._intern(('IndexSum', id(term), index), lambda: IndexSum(term, index))
+
+  def tree(self, node, terms):
+    """Returns a copy of node with new products and index sums, whose leaves are terms."""
+    leaves = collections.defaultdict(list)
+    for term in reversed(terms):
+      leaves[id(self.leaf(term))].append(term)
+    def copy(node):
+      if id(node) in leaves:
+        return leaves[id(node)].pop()
+      if isinstance(node, Product):
+        return Product(copy(node.leftTerm()), copy(node.rightTerm()))
+      return IndexSum(copy(node.term()), str(node.sumIndex()))
+    return copy(node)
+
+def _sumIndices(terms, target_indices, split, nodes):
+  """Sums over every index which occurs in a single term of terms[split:] only."""
   n = len(terms)
-  
+
   indexList = [index for term in terms for index in term.indices]
   uniqueIndices = set(indexList)
   summationIndices = set([index for index in uniqueIndices if indexList.count(index) == 1]) - set(target_indices)
-  
+
   while len(summationIndices) != 0:
     i = split
     while i < n:
       intersection = summationIndices & terms[i].indices
       if len(intersection) > 0:
         index = next(iter(intersection))
-        addTerm = IndexSum(terms[i], index)
+        addTerm = nodes.indexSum(terms[i], index)
         selection = set(range(n)) - set([i])
         terms = [terms[i] for i in selection] + [addTerm]
         summationIndices -= set([index])
       else:
         i = i + 1
+  return terms
+
+def exhaustiveStrengthReduction(terms, target_indices, cost_estimator, split = 0, nodes=None):
+  """Reference implementation of strengthReduction, which enumerates all products.
+
+  The run time is exponential in the number of terms, with a huge base.
+  """
+  nodes = nodes if nodes is not None else NodeTable()
+  tree = _exhaustiveStrengthReduction([nodes.leaf(term) for term in terms], target_indices, cost_estimator, split, nodes)
+  return nodes.tree(tree, terms)
+
+def _exhaustiveStrengthReduction(terms, target_indices, cost_estimator, split, nodes):
+  n = len(terms)
+  terms = _sumIndices(terms, target_indices, split, nodes)
 
   if n == 1:
     return terms[0]
@@ -28,13 +130,360 @@ def strengthReduction(terms, target_indices, cost_estimator, split = 0):
   minCost = sys.maxsize
   for i in range(n):
     for j in range(max(i+1,split),n):
-      mulTerm = Product(terms[i], terms[j])
+      mulTerm = nodes.product(terms[i], terms[j])
       prodCost = cost_estimator.estimate(mulTerm)
       if best == None or prodCost < minCost:
         selection = set(range(n)) - set([i,j])
-        tree = strengthReduction([terms[i] for i in selection] + [mulTerm], target_indices, cost_estimator, j-1)
+        tree = _exhaustiveStrengthReduction([terms[i] for i in selection] + [mulTerm], target_indices, cost_estimator, j-1, nodes)
         treeCost = cost_estimator.estimate(tree)
         if best == None or treeCost < minCost:
           best = tree
           minCost = treeCost
   return best
+
+def strengthReduction(terms, target_indices, cost_estimator, statistics=None, nodes=None):
+  """Returns the binary tree of products and index sums of terms with minimal cost.
+
+  Dynamic program over subsets of terms, which are represented as bit masks:
+  The optimal tree of a subset is the optimal product of the optimal trees of two
+  disjoint subsets, as the cost estimators only depend on the bounding box or
+  sparsity pattern of a subtree, but not on its shape. Hence, only O(3^n) products
+  are estimated instead of O(n!^2). Among several optimal trees, the one found first
+  by exhaustiveStrengthReduction is returned.
+  """
+  nodes = nodes if nodes is not None else NodeTable()
+  leaves = terms
+  terms = _sumIndices([nodes.leaf(term) for term in terms], target_indices, 0, nodes)
+  n = len(terms)
+
+  if n > 1:
+    splits = _optimalSplits(terms, target_indices, cost_estimator, statistics if statistics is not None else SearchStatistics(), nodes)
+    for i, j in _firstOptimalSequence(splits, n):
+      selection = [k for k in range(len(terms)) if k != i and k != j]
+      terms = [terms[k] for k in selection] + [nodes.product(terms[i], terms[j])]
+      terms = _sumIndices(terms, target_indices, j-1, nodes)
+  return nodes.tree(terms[0], leaves)
+
+def _optimalSplits(terms, target_indices, cost_estimator, statistics, nodes):
+  """Returns the mapping subset -> set of (left, right) subsets with minimal cost."""
+  # Mask of the terms which contain an index
+  occurrence = dict()
+  for k, term in enumerate(terms):
+    for index in term.indices:
+      occurrence[index] = occurrence.get(index, 0) | (1 << k)
+  targetIndices = set(target_indices)
+
+  # Mapping subset -> (cost, tree)
+  best = dict()
+  splits = dict()
+  for k, term in enumerate(terms):
+    best[1 << k] = (cost_estimator.estimate(term), term)
+    splits[1 << k] = set()
+
+  # Subsets of a mask are smaller than the mask, hence they are optimized before the mask
+  for mask in range(3, 1 << len(terms)):
+    if mask & (mask - 1) == 0:
+      continue
+    lowest = mask & -mask
+    rest = mask ^ lowest
+    minCost = None
+    # Enumerates every split into left (containing the lowest term) and right once
+    sub = 0
+    while sub != rest:
+      left = lowest | sub
+      right = rest ^ sub
+      leftCost, leftTree = best[left]
+      rightCost, rightTree = best[right]
+      # Costs are non-negative, hence the cost of the children is a lower bound
+      if minCost is None or leftCost + rightCost <= minCost:
+        statistics.explored += 1
+        tree = nodes.product(leftTree, rightTree)
+        for index in tree.indices:
+          if index not in targetIndices and occurrence[index] & ~mask == 0:
+            tree = nodes.indexSum(tree, index)
+        cost = cost_estimator.estimate(tree)
+        if minCost is None or cost < minCost:
+          minCost = cost
+          best[mask] = (cost, tree)
+          splits[mask] = set()
+        if cost == minCost:
+          splits[mask].add((left, right))
+      else:
+        statistics.pruned += 1
+      sub = (sub - rest) & rest
+  return splits
+
+def rankedStrengthReduction(terms, target_indices, cost_estimator, count, statistics=None, nodes=None):
+  """Returns up to count trees of terms with the smallest costs, cheapest first.
+
+  Same dynamic program as strengthReduction, but the count cheapest trees of every
+  subset are kept: the k-th cheapest tree of a subset is a product of some of the
+  count cheapest trees of two disjoint subsets.
+  """
+  statistics = statistics if statistics is not None else SearchStatistics()
+  nodes = nodes if nodes is not None else NodeTable()
+  leaves = terms
+  terms = _sumIndices([nodes.leaf(term) for term in terms], target_indices, 0, nodes)
+  if len(terms) == 1:
+    return [nodes.tree(terms[0], leaves)]
+
+  occurrence = dict()
+  for k, term in enumerate(terms):
+    for index in term.indices:
+      occurrence[index] = occurrence.get(index, 0) | (1 << k)
+  targetIndices = set(target_indices)
+
+  # Mapping subset -> list of (cost, tree), cheapest first
+  ranked = dict()
+  for k, term in enumerate(terms):
+    ranked[1 << k] = [(cost_estimator.estimate(term), term)]
+
+  for mask in range(3, 1 << len(terms)):
+    if mask & (mask - 1) == 0:
+      continue
+    lowest = mask & -mask
+    rest = mask ^ lowest
+    candidates = list()
+    sub = 0
+    while sub != rest:
+      left = lowest | sub
+      right = rest ^ sub
+      for leftCost, leftTree in ranked[left]:
+        for rightCost, rightTree in ranked[right]:
+          # Candidates are sorted, hence the remaining right trees are not cheaper
+          if len(candidates) >= count and leftCost + rightCost > candidates[count-1][0]:
+            statistics.pruned += 1
+            break
+          statistics.explored += 1
+          tree = nodes.product(leftTree, rightTree)
+          for index in tree.indices:
+            if index not in targetIndices and occurrence[index] & ~mask == 0:
+              tree = nodes.indexSum(tree, index)
+          candidates.append((cost_estimator.estimate(tree), len(candidates), tree))
+          candidates.sort(key=lambda candidate: candidate[:2])
+          del candidates[count:]
+      sub = (sub - rest) & rest
+    ranked[mask] = [(cost, tree) for cost, _, tree in candidates]
+  return [nodes.tree(tree, leaves) for _, tree in ranked[(1 << len(terms)) - 1]]
+
+def _firstOptimalSequence(splits, n):
+  """Returns the pairs of positions which exhaustiveStrengthReduction multiplies.
+
+  The products are enumerated in the same order as in exhaustiveStrengthReduction,
+  but only products which are part of an optimal tree are considered.
+  """
+  full = (1 << n) - 1
+  def isOptimal(masks):
+    # True if the terms masks are subtrees of some optimal tree
+    blocks = set(masks)
+    memo = dict()
+    def refines(mask):
+      if mask in blocks:
+        return True
+      if mask not in memo:
+        memo[mask] = any(all(block & left == 0 or block & right == 0 for block in blocks) and refines(left) and refines(right)
+                         for left, right in splits[mask])
+      return memo[mask]
+    return refines(full)
+
+  def search(masks, split):
+    n = len(masks)
+    if n == 1:
+      return []
+    for i in range(n):
+      for j in range(max(i+1,split),n):
+        product = masks[i] | masks[j]
+        if (masks[i], masks[j]) not in splits[product] and (masks[j], masks[i]) not in splits[product]:
+          continue
+        selection = [k for k in range(n) if k != i and k != j]
+        reduced = [masks[k] for k in selection] + [product]
+        if isOptimal(reduced):
+          sequence = search(reduced, j-1)
+          if sequence is not None:
+            return [(i, j)] + sequence
+    return None
+
+  return search([1 << k for k in range(n)], 0)
+
+def _greedyStrengthReduction(terms, target_indices, cost_estimator, statistics, choose, nodes):
+  """Multiplies a pair of terms selected by choose until a single term is left.
+
+  choose receives the candidate products sorted by (size of the intermediate result,
+  estimated cost of the product) and returns the selected one. terms must be leaves of nodes.
+  """
+  terms = _sumIndices(terms, target_indices, 0, nodes)
+  while len(terms) > 1:
+    candidates = list()
+    n = len(terms)
+    for i in range(n):
+      for j in range(i+1,n):
+        selection = [k for k in range(n) if k != i and k != j]
+        reduced = _sumIndices([terms[k] for k in selection] + [nodes.product(terms[i], terms[j])], target_indices, n-2, nodes)
+        size = 1
+        for extent in reduced[-1].indices.shape():
+          size *= extent
+        cost = cost_estimator.estimate(reduced[-1]) - cost_estimator.estimate(terms[i]) - cost_estimator.estimate(terms[j])
+        candidates.append((size, cost, len(candidates), reduced))
+    statistics.explored += len(candidates)
+    candidates.sort(key=lambda candidate: candidate[:3])
+    terms = choose(candidates)[3]
+  return terms[0]
+
+class Greedy(object):
+  """Multiplies the pair of terms with the smallest intermediate result first.
+
+  The size of an intermediate result is the number of entries of its indices;
+  ties are broken by the estimated cost of the product. O(n^3) products are
+  estimated, but the tree is not necessarily optimal.
+  """
+  def __call__(self, terms, target_indices, cost_estimator, statistics=None, nodes=None):
+    statistics = statistics if statistics is not None else SearchStatistics()
+    nodes = nodes if nodes is not None else NodeTable()
+    tree = _greedyStrengthReduction([nodes.leaf(term) for term in terms], target_indices, cost_estimator, statistics,
+                                    lambda candidates: candidates[0], nodes)
+    return nodes.tree(tree, terms)
+
+  def __repr__(self):
+    return 'Greedy()'
+
+class RandomRestartGreedy(object):
+  """Repeats Greedy with randomized choices and returns the cheapest tree.
+
+  The first run is Greedy; in the other runs one of the choices best candidates is
+  picked uniformly at random in every step. The result is deterministic for a given seed.
+  """
+  def __init__(self, restarts=16, choices=3, seed=0):
+    self.restarts = restarts
+    self.choices = choices
+    self.seed = seed
+
+  def __repr__(self):
+    return 'RandomRestartGreedy(restarts={}, choices={}, seed={})'.format(self.restarts, self.choices, self.seed)
+
+  def __call__(self, terms, target_indices, cost_estimator, statistics=None, nodes=None):
+    statistics = statistics if statistics is not None else SearchStatistics()
+    nodes = nodes if nodes is not None else NodeTable()
+    leaves = [nodes.leaf(term) for term in terms]
+    rng = random.Random(self.seed)
+    best = _greedyStrengthReduction(leaves, target_indices, cost_estimator, statistics, lambda candidates: candidates[0], nodes)
+    minCost = cost_estimator.estimate(best)
+    for restart in range(self.restarts):
+      tree = _greedyStrengthReduction(leaves, target_indices, cost_estimator, statistics,
+                                      lambda candidates: rng.choice(candidates[:self.choices]), nodes)
+      cost = cost_estimator.estimate(tree)
+      if cost < minCost:
+        best = tree
+        minCost = cost
+    return nodes.tree(best, terms)
+
+class DynamicProgramming(object):
+  """Optimal contraction order, see strengthReduction."""
+  def __call__(self, terms, target_indices, cost_estimator, statistics=None, nodes=None):
+    return strengthReduction(terms, target_indices, cost_estimator, statistics, nodes)
+
+  def __repr__(self):
+    return 'DynamicProgramming()'
+
+def einsumName(terms, target_indices):
+  """Describes an Einsum by its terms and the indices of its result, e.g. A[ik]*B[kj]->ij.
+
+  Terms which are not tensors are described by their type, indices, and children.
+  """
+  def describe(node):
+    children = list(node)
+    return str(node) + ('({})'.format(','.join(describe(child) for child in children)) if children else '')
+  return '{}->{}'.format('*'.join(describe(term) for term in terms), target_indices)
+
+class Ranked(object):
+  """The rank-th cheapest tree (counting from 0), see rankedStrengthReduction.
+
+  ranks maps names of Einsums (see einsumName) to their rank, which overrides rank.
+  Einsums with fewer trees fall back to their most expensive one. The ranks are
+  alternatives to the optimal tree, e.g. for the Autotuner.
+  """
+  def __init__(self, rank=0, ranks=None):
+    self.rank = rank
+    self.ranks = dict(ranks) if ranks is not None else dict()
+
+  def __call__(self, terms, target_indices, cost_estimator, statistics=None, nodes=None):
+    rank = self.ranks.get(einsumName(terms, target_indices), self.rank) if self.ranks else self.rank
+    trees = rankedStrengthReduction(terms, target_indices, cost_estimator, rank + 1, statistics, nodes)
+    return trees[-1]
+
+  def __repr__(self):
+    if self.ranks:
+      return 'Ranked({}, {})'.format(self.rank, dict(sorted(self.ranks.items())))
+    return 'Ranked({})'.format(self.rank)
+
+class BranchAndBound(object):
+  """Depth-first search over all products with pruning by admissible lower bounds.
+
+  The lower bound of a partial tree is the cost of its terms plus the cost of the
+  cheapest product of two of its terms. The tree of Greedy serves as initial upper bound.
+  The search of an Einsum stops after nodeLimit partial trees or timeLimit seconds,
+  if given, and the best tree found so far is returned. Note that a time limit makes
+  the result depend on the speed of the machine.
+  Without limits, the tree is the same as the one of exhaustiveStrengthReduction.
+  """
+  class _BudgetExceeded(Exception):
+    pass
+
+  def __init__(self, nodeLimit=None, timeLimit=None):
+    self.nodeLimit = nodeLimit
+    self.timeLimit = timeLimit
+
+  def __repr__(self):
+    return 'BranchAndBound(nodeLimit={}, timeLimit={})'.format(self.nodeLimit, self.timeLimit)
+
+  def __call__(self, terms, target_indices, cost_estimator, statistics=None, nodes=None):
+    statistics = statistics if statistics is not None else SearchStatistics()
+    nodes = nodes if nodes is not None else NodeTable()
+    leaves = terms
+    terms = [nodes.leaf(term) for term in terms]
+    greedy = _greedyStrengthReduction(terms, target_indices, cost_estimator, statistics, lambda candidates: candidates[0], nodes)
+    deadline = time.perf_counter() + self.timeLimit if self.timeLimit is not None else None
+    nodeLimit = statistics.explored + self.nodeLimit if self.nodeLimit is not None else None
+    # best is None as long as the upper bound stems from the greedy tree, which is
+    # only replaced by a tree of the same cost if the latter is found first
+    best = None
+    minCost = cost_estimator.estimate(greedy)
+
+    def prune(cost):
+      return cost > minCost or (cost == minCost and best is not None)
+
+    def search(terms, fixedCost, split):
+      nonlocal best, minCost
+      if nodeLimit is not None and statistics.explored >= nodeLimit or \
+         deadline is not None and time.perf_counter() > deadline:
+        raise self._BudgetExceeded()
+      statistics.explored += 1
+
+      n = len(terms)
+      if n == 1:
+        best = terms[0]
+        minCost = fixedCost
+        return
+
+      products = list()
+      for i in range(n):
+        for j in range(max(i+1,split),n):
+          selection = [k for k in range(n) if k != i and k != j]
+          reduced = _sumIndices([terms[k] for k in selection] + [nodes.product(terms[i], terms[j])], target_indices, j-1, nodes)
+          cost = fixedCost - cost_estimator.estimate(terms[i]) - cost_estimator.estimate(terms[j]) + cost_estimator.estimate(reduced[-1])
+          products.append((cost, reduced, j-1))
+
+      if prune(min(cost for cost, _, _ in products)):
+        statistics.pruned += 1
+        return
+      for cost, reduced, nextSplit in products:
+        if prune(cost):
+          statistics.pruned += 1
+        else:
+          search(reduced, cost, nextSplit)
+
+    terms = _sumIndices(terms, target_indices, 0, nodes)
+    try:
+      search(terms, sum(cost_estimator.estimate(term) for term in terms), 0)
+    except self._BudgetExceeded:
+      statistics.budgetExceeded = True
+    return nodes.tree(best if best is not None else greedy, leaves)
@@ -1,13 +1,17 @@
+import collections
+import hashlib
 import sys
 from copy import deepcopy
 from typing import Union
-from .visitor import Visitor, PrettyPrinter, ComputeSparsityPattern, ComputeIndexSet
+from .visitor import Visitor, PrettyPrinter, ComputeSparsityPattern, ComputeIndexSet, ComputeConstantExpression
 from .node import IndexedTensor, Op, Assign, Einsum, Add, Product, IndexSum, Contraction, ScalarMultiplication
 from .indices import Indices
 from .log import LoG
 from . import opt
 from .cost import ShapeCostEstimator
 from .. import aspp
+from ..type import FoldedTensor
+import numpy as np
 
 # Similar as ast.NodeTransformer
 class Transformer(Visitor): 
@@ -103,15 +107,116 @@ class DeduceIndices(Transformer):
 
     return node
 
+### Constant folding
+
+class FoldConstants(Transformer):
+  """Replaces operands whose values are known at generation time by precomputed tensors.
+
+  The compute constant operands of an Einsum or Add are folded into one new
+  constant tensor, unless the folded tensor has more non-zeros than the operands
+  it replaces. Folded tensors are named <operands>_folded<n>, where <operands> are
+  the base names of the original operands joined by underscores and n counts the
+  distinct folds of the same operands in order of appearance. Equal folds, also
+  in different ASTs visited by one instance, yield the same tensor. Values are
+  computed in extended precision if the platform provides it.
+  """
+  FOLDED_SUFFIX = 'folded'
+
+  def __init__(self, dtype=np.longdouble):
+    self._dtype = dtype
+    # Mapping folded tensor name -> base names of the original operands
+    self._baseNames = dict()
+    # Mapping (namespace, base names, digest of the values) -> folded tensor
+    self._folded = dict()
+    # Mapping name prefix -> number of distinct folds
+    self._count = collections.Counter()
+
+  @staticmethod
+  def _isConstant(node):
+    return isinstance(node, IndexedTensor) and node.tensor.is_compute_constant()
+
+  @staticmethod
+  def _nonZeros(node):
+    return np.count_nonzero(node.tensor.values_as_ndarray())
+
+  def _fold(self, node, operands):
+    values = ComputeConstantExpression(self._dtype).visit(node)
+    if np.count_nonzero(values) > sum(self._nonZeros(operand) for operand in operands):
+      return None
+    nonZeros = values.nonzero()
+    baseNames = list(dict.fromkeys(baseName for operand in operands
+                                   for baseName in self._baseNames.get(operand.tensor.name(), [operand.tensor.baseName()])))
+    namespaces = {operand.tensor.namespace for operand in operands}
+    namespace = namespaces.pop() if len(namespaces) == 1 else None
+    digest = hashlib.sha1(repr((values.shape, [(entry, str(values[entry])) for entry in zip(*nonZeros)])).encode()).hexdigest()
+    key = (namespace, tuple(baseNames), digest)
+    if key not in self._folded:
+      prefix = '{}_{}'.format('_'.join(baseNames), self.FOLDED_SUFFIX)
+      tensor = FoldedTensor('{}{}'.format(prefix, self._count[prefix]), values.shape, spp=values, namespace=namespace)
+      self._count[prefix] += 1
+      self._baseNames[tensor.name()] = baseNames
+      self._folded[key] = tensor
+    tensor = self._folded[key]
+    return tensor[node.indices.tostring()]
+
+  def _foldOperands(self, node, indices):
+    operands = [child for child in node if self._isConstant(child)]
+    if len(operands) < 2:
+      return node
+    constant = type(node)(*operands)
+    constant.indices = indices
+    folded = self._fold(constant, operands)
+    if folded is None:
+      return node
+    if len(operands) == len(node):
+      return folded
+    # The folded tensor takes the place of the first constant operand
+    first = operands[0]
+    node.setChildren([folded if child is first else child for child in node if child is first or not self._isConstant(child)])
+    return node
+
+  def visit_Einsum(self, node):
+    self.generic_visit(node)
+    if all(self._isConstant(child) for child in node):
+      return self._foldOperands(node, node.indices)
+    # Keep the indices which are shared with other operands or the result
+    free = set(node.indices).union(*[set(child.indices) for child in node if not self._isConstant(child)])
+    kept = list(dict.fromkeys(index for child in node if self._isConstant(child) for index in child.indices if index in free))
+    sizes = {index: child.indices.indexSize(index) for child in node for index in child.indices}
+    return self._foldOperands(node, Indices(kept, tuple(sizes[index] for index in kept)))
+
+  def visit_Add(self, node):
+    self.generic_visit(node)
+    return self._foldOperands(node, node.indices)
+
+  def visit_ScalarMultiplication(self, node):
+    self.generic_visit(node)
+    if node.is_constant() and self._isConstant(node.term()):
+      folded = self._fold(node, [node.term()])
+      if folded is not None:
+        return folded
+    return node
+
 ### Optimal binary tree
 
 class StrengthReduction(Transformer):
-  def __init__(self, costEstimator):
+  """Replaces Einsums by binary trees; strategy is a search strategy from opt.
+
+  The searches of all Einsums visited by one instance share an opt.NodeTable and,
+  if the estimator is stateless, its cost estimator, such that costs of equal
+  subexpressions are estimated once. Pass nodes to share the table with other
+  instances, e.g. those of other kernels.
+  """
+  def __init__(self, costEstimator, strategy=None, nodes=None):
+    self._nodes = nodes if nodes is not None else opt.NodeTable()
     self._costEstimator = costEstimator
+    self._strategy = strategy if strategy is not None else opt.DynamicProgramming()
+    self.statistics = opt.SearchStatistics()
 
   def visit_Einsum(self, node):
     self.generic_visit(node)
-    minTree = opt.strengthReduction(list(node), node.indices, self._costEstimator())
+    costEstimator = self._nodes.costEstimator(self._costEstimator)
+    minTree = self._strategy(list(node), node.indices, costEstimator, self.statistics, self._nodes)
     minTree.setIndexPermutation(node.indices)
     return minTree
 
@@ -208,16 +313,66 @@ class EquivalentSparsityPattern(Transformer):
     minTree = FindContractions().visit(minTree)
     return ComputeSparsityPattern(True).visit(minTree)
   
+  def _propagate(self, terms, targetIndices):
+    """Returns the equivalent sparsity patterns of the Einsum and of its terms.
+
+    The reduced tree is searched once: The pattern of every subtree is passed up, and
+    the pattern of the rest of the Einsum, restricted to the indices it shares with the
+    subtree, is passed down. The pattern of a term is the term's pattern restricted to
+    the entries which meet a non-zero of the rest.
+    """
+    tree = opt.strengthReduction(terms, targetIndices, ShapeCostEstimator())
+    leaves = {id(term) for term in terms}
+    up = dict()
+    def passUp(node):
+      if id(node) in leaves:
+        spp = node.eqspp()
+      else:
+        spp = node.computeSparsityPattern(*[passUp(child) for child in node])
+      up[id(node)] = spp
+      return spp
+
+    # rest is None or the pair (pattern, indices) of the rest of the Einsum
+    down = dict()
+    def passDown(node, rest):
+      if id(node) in leaves:
+        down[id(node)] = rest
+      elif isinstance(node, IndexSum):
+        passDown(node.term(), rest)
+      else:
+        for child, sibling in [(node.leftTerm(), node.rightTerm()), (node.rightTerm(), node.leftTerm())]:
+          siblingIndices = sibling.indices.tostring()
+          restIndices = rest[1] if rest is not None else ''
+          shared = ''.join(index for index in child.indices.tostring() if index in siblingIndices or index in restIndices)
+          if rest is None:
+            spp = up[id(sibling)].indexSum(siblingIndices, shared)
+          else:
+            spp = aspp.einsum('{},{}->{}'.format(restIndices, siblingIndices, shared), rest[0], up[id(sibling)])
+          passDown(child, (spp, shared))
+
+    passUp(tree)
+    passDown(tree, None)
+    eqspp = up[id(tree)].indexSum(tree.indices.tostring(), targetIndices.tostring())
+    termEqspps = list()
+    for term in terms:
+      spp, indices = down[id(term)]
+      termIndices = term.indices.tostring()
+      termEqspps.append(aspp.einsum('{},{}->{}'.format(termIndices, indices, termIndices), term.eqspp(), spp))
+    return eqspp, termEqspps
+
   def visit_Einsum(self, node):
     self.generic_visit(node)
     terms = list(node)
-    node.setEqspp( self.getEqspp(terms, node.indices) )
-    
-    for child in node:
-      child.setEqspp( self.getEqspp(terms, child.indices) )
-
-    # TODO: Backtracking of equivalent sparsity pattern to children?
-
+    if len(terms) == 1 or all(term.eqspp().is_dense() for term in terms):
+      node.setEqspp( self.getEqspp(terms, node.indices) )
+      for child in node:
+        child.setEqspp( self.getEqspp(terms, child.indices) )
+      return node
+
+    eqspp, termEqspps = self._propagate(terms, node.indices)
+    node.setEqspp(eqspp)
+    for child, termEqspp in zip(node, termEqspps):
+      child.setEqspp(termEqspp)
     return node
 
 class SetSparsityPattern(Transformer):
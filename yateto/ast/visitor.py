@@ -9,19 +9,7 @@ from .indices import LoGCost
 from .log import LoG
 from functools import reduce
 
-# Optional modules
-import importlib.util
-mplSpec = importlib.util.find_spec('matplotlib')
-pltSpec = importlib.util.find_spec('matplotlib.pylab') if mplSpec else None
-colorsSpec = importlib.util.find_spec('matplotlib.colors') if mplSpec else None
-try:
-  if pltSpec:
-    plt = pltSpec.loader.load_module()
-except:
-  print('An exception occured trying to load matplotlib. This can be ignored in most cases')
-  plt = None
-if colorsSpec:
-  colors = colorsSpec.loader.load_module()
+from .. import optional
 
 # Similar as ast.NodeVisitor
 class Visitor(object):
@@ -79,6 +67,42 @@ class ComputeOptimalFlopCount(Visitor):
       childFlops += self.visit(child)
     return childFlops + node.nonZeroFlops()
 
+class ComputeNonZeroFlops(Visitor):
+  """Same count as ComputeOptimalFlopCount after SetSparsityPattern, without modifying the AST.
+
+  The sparsity patterns of the operations are computed bottom-up from the equivalent
+  sparsity patterns of the tensors; visit returns the pair (flops, sparsity pattern).
+  """
+  def _visitChildren(self, node):
+    results = [self.visit(child) for child in node]
+    spps = [spp for _, spp in results]
+    return sum(flops for flops, _ in results), spps, node.computeSparsityPattern(*spps)
+
+  def generic_visit(self, node):
+    flops, spps, spp = self._visitChildren(node)
+    return flops, spp
+
+  def visit_IndexedTensor(self, node):
+    return 0, node.eqspp()
+
+  def visit_Add(self, node):
+    flops, spps, spp = self._visitChildren(node)
+    return flops + sum(childSpp.count_nonzero() for childSpp in spps) - spp.count_nonzero(), spp
+
+  def visit_ScalarMultiplication(self, node):
+    flops, spps, spp = self._visitChildren(node)
+    if node.is_constant() and node.scalar() in [-1.0, 1.0]:
+      return flops, spp
+    return flops + spp.count_nonzero(), spp
+
+  def visit_Product(self, node):
+    flops, spps, spp = self._visitChildren(node)
+    return flops + spp.count_nonzero(), spp
+
+  def visit_IndexSum(self, node):
+    flops, spps, spp = self._visitChildren(node)
+    return flops + spps[0].count_nonzero() - spp.count_nonzero(), spp
+
 class FindTensors(Visitor):
   def generic_visit(self, node):
     tensors = dict()
@@ -209,8 +233,10 @@ class FindIndexPermutations(Visitor):
 
 class PrintEquivalentSparsityPatterns(Visitor):
   def __init__(self, directory):
-    if not (pltSpec and colorsSpec):
+    if not optional.isAvailable('matplotlib'):
       raise NotImplementedError('Missing modules matplotlib')
+    colors = optional.load('matplotlib.colors')
+    self._plt = optional.load('matplotlib.pylab')
     self._directory = directory
     self._cmap = colors.ListedColormap(['white', 'black'])
     self._norm = colors.BoundaryNorm([0.0, 0.5, 1.0], 2, clip=True)
@@ -244,7 +270,7 @@ class PrintEquivalentSparsityPatterns(Visitor):
       nSubplots *= eqspp.shape[dim]
     nrows = math.ceil(math.sqrt(nSubplots))
     ncols = math.ceil(nSubplots / nrows)
-    fig, axs = plt.subplots(nrows, ncols)
+    fig, axs = self._plt.subplots(nrows, ncols)
     if ncols > 1:
       axs = [y for x in axs for y in x]
     if nSubplots == 1:
@@ -259,7 +285,7 @@ class PrintEquivalentSparsityPatterns(Visitor):
     #plt.setp(axs, xticks=arange(eqspp.shape[1]), yticks=arange(eqspp.shape[0]))
     fig.tight_layout()
     fig.savefig(fileName, bbox_inches='tight')
-    plt.close()
+    self._plt.close()
     self._directory = baseDirectory
 
 
@@ -307,6 +333,44 @@ class ComputeConstantExpression(Visitor):
     assert term is not None, '{} may only be used when all involved tensors are constant.'.format(self.__class__.__name__)
     return term
 
+class ComputeSignature(Visitor):
+  """Computes a canonical, hashable description of an AST.
+
+  ASTs with equal signature are optimized in the same way. Arguments are passed
+  on to Tensor.signature. If group is false, tensors are numbered in order of
+  their first occurrence, which is recorded in the tensors attribute, such that
+  equal signatures imply that the tensors are used in the same places.
+  """
+  def __init__(self, group=True, values=True):
+    self._group = group
+    self._values = values
+    self._occurrence = dict()
+    self.tensors = list()
+
+  def tensor(self, tensor):
+    signature = tensor.signature(self._group, self._values)
+    if self._group:
+      return signature
+    key = (tensor.namespace, tensor.name())
+    if key not in self._occurrence:
+      self._occurrence[key] = len(self.tensors)
+      self.tensors.append(tensor)
+    return signature + (self._occurrence[key],)
+
+  def _signature(self, node, *attributes):
+    children = tuple(self.visit(child) for child in node)
+    return (type(node).__name__, repr(node.indices) if node.indices is not None else None) + attributes + children
+
+  def generic_visit(self, node):
+    return self._signature(node)
+
+  def visit_ScalarMultiplication(self, node):
+    scalar = node.scalar() if node.is_constant() else str(node.scalar())
+    return self._signature(node, node.is_constant(), scalar)
+
+  def visit_IndexedTensor(self, node):
+    return self._signature(node, self.tensor(node.tensor))
+
 class ComputeIndexSet(CachedVisitor):
   def generic_visit(self, node):
     union = set()
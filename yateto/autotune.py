@@ -0,0 +1,296 @@
+import collections
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from .ast import opt
+from .ast.transformer import DeduceIndices, EquivalentSparsityPattern, StrengthReduction
+from .controlflow.visitor import ScalarsSet, SortedGlobalsList
+from .codegen.visitor import OptimisedKernelGenerator
+from .plan_cache import PlanCache
+from . import profiling
+
+class TuningDatabase(object):
+  """JSON file with the variant of every kernel selected by the Autotuner.
+
+  Entries are keyed by a hash over the kernel's signature, the architecture, the
+  cost estimator, the number of candidates, the compiler and its flags, the GEMM
+  tools, and the sources of yateto, cf. PlanCache.
+  """
+  def __init__(self, fileName):
+    self._fileName = fileName
+    self._lock = threading.Lock()
+    self._entries = self._read()
+    self.hits = 0
+    self.misses = 0
+
+  def _read(self):
+    try:
+      with open(self._fileName, 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return dict()
+
+  @staticmethod
+  def key(signature, arch, costEstimator, candidates, compiler, flags, gemmTools):
+    estimatorName = '{}.{}'.format(getattr(costEstimator, '__module__', ''),
+                                   getattr(costEstimator, '__qualname__', repr(costEstimator)))
+    signature = (PlanCache.sourceDigest(),
+                 signature,
+                 PlanCache._archSignature(arch),
+                 estimatorName,
+                 candidates,
+                 compiler,
+                 tuple(flags),
+                 tuple(gemmTools))
+    return hashlib.sha256(repr(signature).encode()).hexdigest()
+
+  def load(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return entry
+
+  def store(self, key, entry):
+    with self._lock:
+      # Keep the entries which concurrent builds have written in the meantime
+      self._entries = self._read()
+      self._entries[key] = entry
+      directory = os.path.dirname(os.path.abspath(self._fileName))
+      fd, tmpName = tempfile.mkstemp(dir=directory, suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'w') as f:
+          json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmpName, self._fileName)
+      except:
+        os.remove(tmpName)
+        raise
+
+class _EinsumRecorder(object):
+  """Optimal contraction order, which records the names of the Einsums, see opt.einsumName."""
+  def __init__(self):
+    self.einsums = list()
+
+  def __call__(self, terms, target_indices, cost_estimator, statistics=None, nodes=None):
+    name = opt.einsumName(terms, target_indices)
+    if name not in self.einsums:
+      self.einsums.append(name)
+    return opt.strengthReduction(terms, target_indices, cost_estimator, statistics, nodes)
+
+class Autotuner(object):
+  """Selects the contraction order of every Einsum of every kernel by timing it on this machine.
+
+  The candidates cheapest contraction trees of an Einsum according to the cost estimator
+  (see opt.Ranked) are generated as standalone programs, which are compiled with compiler
+  and run on random data. Variants with equal code are measured once. The Einsums of a
+  kernel are tuned one after another, each with the fastest trees of the ones before it.
+  The selection is recorded in database, if given, such that later builds skip the
+  measurement. The whole family is measured for every variant of a family.
+
+  The index permutations and the implementations of the contractions follow from the
+  contraction tree, hence they are not tuned separately. GPU kernels are not tuned.
+  The sources include the headers of the GEMM tools, hence includeDirs must contain
+  their include directories, e.g. the one of Eigen. libraries are appended to the
+  command line of the compiler. If kernels is given, only the listed kernels and
+  families are tuned.
+  """
+  COMPILER_ENV = 'CXX'
+  INCLUDE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'include')
+  BENCHMARK_FILE_NAME = 'benchmark.cpp'
+  EXECUTABLE_NAME = 'benchmark'
+
+  def __init__(self,
+               database=None,
+               candidates=4,
+               compiler=None,
+               flags=('-O3', '-march=native', '-std=c++17'),
+               includeDirs=(),
+               libraries=(),
+               minTime=0.01,
+               kernels=None):
+    self.database = TuningDatabase(database) if isinstance(database, str) else database
+    self.candidates = candidates
+    self.compiler = compiler or os.environ.get(self.COMPILER_ENV, 'c++')
+    self.flags = list(flags)
+    self.includeDirs = list(includeDirs)
+    self.libraries = list(libraries)
+    self.minTime = minTime
+    self.kernels = kernels
+    self._compilerVersion = None
+
+  def compilerVersion(self):
+    if self._compilerVersion is None:
+      result = subprocess.run([self.compiler, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+      self._compilerVersion = result.stdout.split('\n')[0] if result.returncode == 0 else self.compiler
+    return self._compilerVersion
+
+  def searchStrategy(self, generator, costEstimator, searchStrategy, gemm_cfg):
+    """Returns the search strategy for Generator.generate with the fastest variants."""
+    units = collections.OrderedDict()
+    for kernel in generator.kernels():
+      units.setdefault(kernel.family or kernel.name, list()).append(kernel)
+    strategies = dict()
+    for name, kernels in units.items():
+      strategy = searchStrategy.get(name) if isinstance(searchStrategy, dict) else searchStrategy
+      if any(kernel.target != 'cpu' for kernel in kernels) or self.kernels is not None and name not in self.kernels:
+        strategies[name] = strategy
+        continue
+      key = None
+      entry = None
+      if self.database is not None:
+        signature = tuple(kernel.signature() for kernel in kernels)
+        key = self.database.key(signature, generator.arch(), costEstimator, self.candidates, self.compilerVersion(),
+                                self.flags, [type(tool).__name__ for tool in gemm_cfg.gemmTools])
+        entry = self.database.load(key)
+      if entry is None:
+        with profiling.profile('Autotuning', name):
+          entry = self._tune(generator.arch(), name, kernels, costEstimator, gemm_cfg)
+        if key is not None:
+          self.database.store(key, entry)
+      ranks = {einsum: rank for einsum, rank in entry['ranks'].items() if rank > 0}
+      print('Autotuning {}: {} of {} Einsums use a variant'.format(name, len(ranks), len(entry['ranks'])))
+      strategies[name] = opt.Ranked(0, ranks)
+    if self.database is not None:
+      print('Tuning database: {} hits, {} misses'.format(self.database.hits, self.database.misses))
+    return strategies
+
+  @staticmethod
+  def _einsums(kernels, costEstimator):
+    """Names of the Einsums of kernels in the order of their optimization, see opt.einsumName.
+
+    Isomorphic family members share the plan of the first one, hence their Einsums are skipped.
+    """
+    recorder = _EinsumRecorder()
+    signatures = set()
+    for kernel in kernels:
+      signature, _ = kernel.canonicalSignature()
+      if signature in signatures:
+        continue
+      signatures.add(signature)
+      strengthReduction = StrengthReduction(costEstimator, recorder)
+      for ast in copy.deepcopy(kernel.ast):
+        strengthReduction.visit(EquivalentSparsityPattern().visit(DeduceIndices().visit(ast)))
+    return recorder.einsums
+
+  def _tune(self, arch, name, kernels, costEstimator, gemm_cfg):
+    """Selects the rank of every Einsum, where the Einsums are tuned one after another.
+
+    Returns the entry of the database with the rank of every Einsum and the run times
+    of its variants in seconds; variants with equal code share one measurement. The
+    run times of an Einsum are None if all of its variants are equal.
+    """
+    einsums = self._einsums(kernels, costEstimator)
+    ranks = collections.OrderedDict((einsum, 0) for einsum in einsums)
+    seconds = collections.OrderedDict()
+    measured = dict()
+    with tempfile.TemporaryDirectory() as directory:
+      for e, einsum in enumerate(einsums):
+        variants = list()
+        for rank in range(self.candidates):
+          variantDir = os.path.join(directory, '{}_{}'.format(e, rank))
+          os.makedirs(variantDir)
+          variantRanks = dict(ranks)
+          variantRanks[einsum] = rank
+          variants.append(self._generateVariant(arch, kernels, variantRanks, variantDir, costEstimator, gemm_cfg))
+        codes = [code for code, _, _ in variants]
+        # Nothing to choose from, hence nothing is compiled
+        if len(set(codes)) == 1:
+          seconds[einsum] = [None] * len(codes)
+          continue
+        for code, variant, variantDir in variants:
+          if code not in measured:
+            measured[code] = self._run(variant, name, variantDir)
+        seconds[einsum] = [measured[code] for code in codes]
+        ranks[einsum] = seconds[einsum].index(min(seconds[einsum]))
+    return {'name': name, 'ranks': ranks, 'seconds': seconds}
+
+  def _generateVariant(self, arch, kernels, ranks, directory, costEstimator, gemm_cfg):
+    """Generates copies of kernels with the given ranks into directory.
+
+    Returns the code of the kernels, the generator, and directory.
+    """
+    from .generator import Generator
+    variant = Generator(arch)
+    copies = copy.deepcopy([(kernel.ast, kernel.prefetch()) for kernel in kernels])
+    for kernel, (ast, prefetch) in zip(kernels, copies):
+      name = kernel.name if kernel.family is None else '{}({})'.format(kernel.family, kernel.group)
+      variant.add(name, ast, prefetch, kernel.namespace, kernel.target)
+    gemmCfg = copy.copy(gemm_cfg)
+    gemmCfg.selected = set()
+    with contextlib.redirect_stdout(io.StringIO()):
+      variant.generate(directory, gemm_cfg=gemmCfg, cost_estimator=costEstimator,
+                       search_strategy=opt.Ranked(0, ranks), unit_tests=False)
+    with open(os.path.join(directory, Generator.KERNELS_FILE_NAME + '.cpp')) as f:
+      return f.read(), variant, directory
+
+  def _run(self, variant, name, directory):
+    self._writeBenchmark(variant, name, directory)
+    sources = sorted(os.path.join(directory, fileName) for fileName in os.listdir(directory) if fileName.endswith('.cpp'))
+    executable = os.path.join(directory, self.EXECUTABLE_NAME)
+    command = [self.compiler] + self.flags + ['-I' + path for path in [directory, self.INCLUDE_DIR] + self.includeDirs] + \
+              sources + ['-o', executable] + self.libraries
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+      raise RuntimeError('Compiling a variant failed:\n{}\n{}'.format(' '.join(command), result.stderr))
+    result = subprocess.run([executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+      raise RuntimeError('Running a variant failed:\n{}'.format(result.stderr))
+    return float(result.stdout)
+
+  def _writeBenchmark(self, variant, name, directory):
+    arch = variant.arch()
+    buffers = dict()
+    scalars = set()
+    for kernel in variant.kernels():
+      scalars |= ScalarsSet().visit(kernel.cfg)
+      for var in SortedGlobalsList().visit(kernel.cfg):
+        tensorName = '_'.join([var.tensor.baseName()] + [str(g) for g in var.tensor.group()])
+        buffers[tensorName] = (var.tensor, var.memoryLayout().requiredReals())
+
+    kernels = variant.kernels()
+    if kernels[0].family is None:
+      calls = ['krnl.{}();'.format(OptimisedKernelGenerator.EXECUTE_NAME)]
+    else:
+      calls = ['(krnl.*krnl.{}[{}])();'.format(OptimisedKernelGenerator.EXECUTE_ARRAY_NAME, kernel.group) for kernel in kernels]
+    kernelClass = '::'.join(part for part in ['yateto', kernels[0].namespace, OptimisedKernelGenerator.NAMESPACE, name] if part)
+
+    with open(os.path.join(directory, self.BENCHMARK_FILE_NAME), 'w') as f:
+      f.write('#include <chrono>\n#include <cstdio>\n#include <cstdlib>\n#include "kernel.h"\n\n')
+      f.write('static {0}* buffer(std::size_t reals) {{\n'.format(arch.typename))
+      f.write('  std::size_t bytes = (reals * sizeof({0}) + {1} - 1) / {1} * {1};\n'.format(arch.typename, arch.alignment))
+      f.write('  auto* b = static_cast<{0}*>(std::aligned_alloc({1}, bytes > 0 ? bytes : {1}));\n'.format(arch.typename, arch.alignment))
+      f.write('  for (std::size_t i = 0; i < reals; ++i) {\n')
+      f.write('    b[i] = static_cast<{}>(std::rand()) / RAND_MAX - 0.5;\n'.format(arch.typename))
+      f.write('  }\n  return b;\n}\n\n')
+      f.write('int main() {\n')
+      f.write('  {} krnl;\n'.format(kernelClass))
+      for name, (tensor, reals) in buffers.items():
+        group = ','.join(str(g) for g in tensor.group())
+        f.write('  krnl.{}{} = buffer({});\n'.format(tensor.baseName(), '({})'.format(group) if group else '', reals))
+      for scalar in sorted(scalars, key=str):
+        f.write('  krnl.{} = 1.0;\n'.format(scalar))
+      f.write('  auto run = [&](long repetitions) {\n')
+      f.write('    auto start = std::chrono::steady_clock::now();\n')
+      f.write('    for (long r = 0; r < repetitions; ++r) {\n')
+      for call in calls:
+        f.write('      {}\n'.format(call))
+      f.write('    }\n')
+      f.write('    return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();\n')
+      f.write('  };\n')
+      f.write('  long repetitions = 1;\n')
+      f.write('  while (run(repetitions) < {}) {{\n    repetitions *= 2;\n  }}\n'.format(self.minTime))
+      f.write('  double best = run(repetitions);\n')
+      f.write('  for (int batch = 0; batch < 2; ++batch) {\n')
+      f.write('    double seconds = run(repetitions);\n')
+      f.write('    best = seconds < best ? seconds : best;\n')
+      f.write('  }\n')
+      f.write('  std::printf("%.9e\\n", best / repetitions);\n')
+      f.write('  return 0;\n}\n')
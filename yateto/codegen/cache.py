@@ -1,17 +1,116 @@
-from .code import Cpp
+import ast
+import concurrent.futures
+import hashlib
+import importlib.util
+import os
+import shutil
+import sysconfig
+import tempfile
+from .code import Cpp, shard, updateFile
+from ..disk_cache import DiskCache
+from ..profiling import profile
 
 class RoutineGenerator(object):
+  # Set to True if the generator may be called concurrently from multiple threads
+  THREAD_SAFE = False
+
   def __call__(self, routineName, fileName):
     pass
 
 class GpuRoutineGenerator(object):
+  THREAD_SAFE = False
+
   def __call__(self, routineName, fileName):
     pass
 
+class MicrokernelCache(DiskCache):
+  """On-disk cache of routines generated by external tools such as libxsmm or PSpaMM.
+
+  An entry holds the generated code and declaration of a routine. Entries are keyed by
+  the routine name, the generator tool and a digest of its executable, the architecture,
+  the precision, and the tool-specific options. If the executable is a Python launcher,
+  such as pspamm.py, the digest covers the packages next to it and the non-standard
+  modules it imports, too, such that upgrades of the tool invalidate its entries.
+  """
+  FILE_SUFFIX = '.gemm'
+
+  def __init__(self, directory):
+    super().__init__(directory)
+    self._toolDigests = dict()
+
+  def toolDigest(self, cmd):
+    with self._lock:
+      if cmd not in self._toolDigests:
+        path = shutil.which(cmd)
+        digest = None
+        if path is not None:
+          sha = hashlib.sha256()
+          for fileName in [path] + self._pythonSources(path):
+            with open(fileName, 'rb') as f:
+              sha.update(fileName.encode())
+              sha.update(f.read())
+          digest = sha.hexdigest()
+        self._toolDigests[cmd] = digest
+      return self._toolDigests[cmd]
+
+  @staticmethod
+  def _packageSources(directory):
+    sources = list()
+    for root, dirs, files in os.walk(directory):
+      dirs[:] = sorted(d for d in dirs if os.path.isfile(os.path.join(root, d, '__init__.py')))
+      sources += [os.path.join(root, f) for f in sorted(files) if f.endswith('.py')]
+    return sources
+
+  @classmethod
+  def _pythonSources(cls, path):
+    """Returns the sources of the packages next to a Python launcher and of the modules it imports."""
+    with open(path, 'rb') as f:
+      source = f.read()
+    if not source.startswith(b'#!') or b'python' not in source.split(b'\n', 1)[0]:
+      return []
+    directory = os.path.dirname(os.path.abspath(path))
+    sources = [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+               if f.endswith('.py') and os.path.join(directory, f) != os.path.abspath(path)]
+    for d in sorted(os.listdir(directory)):
+      if os.path.isfile(os.path.join(directory, d, '__init__.py')):
+        sources += cls._packageSources(os.path.join(directory, d))
+    try:
+      tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+      return sources
+    names = set()
+    for node in ast.walk(tree):
+      if isinstance(node, ast.Import):
+        names |= {alias.name.split('.')[0] for alias in node.names}
+      elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+        names.add(node.module.split('.')[0])
+    stdlib = os.path.realpath(sysconfig.get_paths()['stdlib'])
+    for name in sorted(names):
+      try:
+        spec = importlib.util.find_spec(name)
+      except (ImportError, ValueError):
+        continue
+      if spec is None or not spec.origin or not os.path.isfile(spec.origin):
+        continue
+      origin = os.path.realpath(spec.origin)
+      if origin.startswith(stdlib + os.sep) and 'site-packages' not in origin:
+        continue
+      if origin.startswith(directory + os.sep):
+        continue
+      sources += cls._packageSources(os.path.dirname(origin)) if spec.submodule_search_locations else [origin]
+    return sources
+
+  def key(self, routineName, tool, cmd, *options):
+    digest = self.toolDigest(cmd)
+    if digest is None:
+      return None
+    return hashlib.sha256(repr((routineName, tool, digest) + options).encode()).hexdigest()
+
 class RoutineCache(object):
-  def __init__(self):
+  def __init__(self, microkernelCache=None):
     self._routines = dict()
     self._generators = dict()
+    self.microkernelCache = microkernelCache
   
   def addRoutine(self, name, generator):
     if name in self._routines and not self._routines[name] == generator:
@@ -23,18 +122,78 @@ class RoutineCache(object):
     if generatorName not in self._generators:
       self._generators[generatorName] = generator
   
-  def generate(self, header, cppFileName, gpuFileName):
-    with Cpp(gpuFileName) as gpucpp:
-      with Cpp(cppFileName) as cpp:
+  def generate(self, header, cppFileName, gpuFileName, writeIfChanged=False, jobs=1):
+    """Calls the routine generators and writes the routines to cppFileName or gpuFileName.
+
+    Both cppFileName and gpuFileName may be lists of file names, in which case the
+    routines are distributed over the files such that they may be compiled in parallel.
+    """
+    cppFileNames = [cppFileName] if isinstance(cppFileName, str) else list(cppFileName)
+    gpuFileNames = [gpuFileName] if isinstance(gpuFileName, str) else list(gpuFileName)
+    if not writeIfChanged:
+      self._generate(header, cppFileNames, gpuFileNames, jobs)
+      return
+
+    # External generators append to the given files, hence they write to
+    # temporary files which are copied to the targets if their content changed.
+    targets = cppFileNames + gpuFileNames
+    temporaries = list()
+    try:
+      for fileName in targets:
+        fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix='.tmp')
+        os.close(fd)
+        temporaries.append(tmpName)
+      self._generate(header, temporaries[:len(cppFileNames)], temporaries[len(cppFileNames):], jobs)
+      for fileName, tmpName in zip(targets, temporaries):
+        with open(tmpName, 'r') as f:
+          updateFile(fileName, f.read())
+    finally:
+      for tmpName in temporaries:
+        os.remove(tmpName)
+
+  @staticmethod
+  def _call(generator, routineName, fileName):
+    with profile(type(generator).__name__, routineName):
+      return generator(routineName, fileName)
+
+  def _generate(self, header, cppFileNames, gpuFileNames, jobs):
+    for fileName in cppFileNames + gpuFileNames:
+      with Cpp(fileName) as cpp:
         for generator in self._generators.values():
-          if isinstance(generator, GpuRoutineGenerator):
-            generator.header(gpucpp)
-          else:
+          if isinstance(generator, GpuRoutineGenerator) == (fileName in gpuFileNames):
             generator.header(cpp)
 
-    for name, generator in self._routines.items():
-      if isinstance(generator, GpuRoutineGenerator):
-        declaration = generator(name, gpuFileName)
-      else:
-        declaration = generator(name, cppFileName)
-      header(declaration)
\ No newline at end of file
+    # Every routine is generated into a file of its own. Thread-safe generators
+    # (i.e. external executables) run concurrently; the outputs are concatenated
+    # in the order in which the routines were added.
+    with tempfile.TemporaryDirectory() as tmpDir, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+      outputs = list()
+      for i, (name, generator) in enumerate(self._routines.items()):
+        fileName = os.path.join(tmpDir, '{}.cpp'.format(i))
+        if jobs > 1 and generator.THREAD_SAFE:
+          declaration = executor.submit(self._call, generator, name, fileName)
+        else:
+          declaration = concurrent.futures.Future()
+          declaration.set_result(self._call(generator, name, fileName))
+        outputs.append((generator, fileName, declaration))
+
+      declarations = [declaration.result() for generator, fileName, declaration in outputs]
+      sizes = [os.path.getsize(fileName) if os.path.exists(fileName) else 0 for generator, fileName, declaration in outputs]
+      isGpu = [isinstance(generator, GpuRoutineGenerator) for generator, fileName, declaration in outputs]
+      shards = dict()
+      for gpu, fileNames in ((False, cppFileNames), (True, gpuFileNames)):
+        indices = [i for i in range(len(outputs)) if isGpu[i] == gpu]
+        for i, j in zip(indices, shard([sizes[i] for i in indices], len(fileNames))):
+          shards[i] = fileNames[j]
+
+      files = {fileName: open(fileName, 'a') for fileName in cppFileNames + gpuFileNames}
+      try:
+        for i, (generator, fileName, declaration) in enumerate(outputs):
+          if os.path.exists(fileName):
+            with open(fileName, 'r') as routine:
+              shutil.copyfileobj(routine, files[shards[i]])
+          header(declarations[i])
+      finally:
+        for f in files.values():
+          f.close()
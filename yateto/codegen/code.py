@@ -37,7 +37,48 @@
 # @section DESCRIPTION
 #
 
+import os
 import sys
+import tempfile
+from io import StringIO
+
+def updateFile(fileName, content):
+  """Replaces the file only if its content differs, such that its mtime is kept otherwise.
+
+  Returns:
+    bool: true if the file was written
+  """
+  try:
+    with open(fileName, 'r') as f:
+      if f.read() == content:
+        return False
+  except OSError:
+    pass
+  directory = os.path.dirname(os.path.abspath(fileName))
+  fd, tmpName = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(fileName), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(content)
+    os.replace(tmpName, fileName)
+  except:
+    os.remove(tmpName)
+    raise
+  return True
+
+def shard(weights, numShards):
+  """Distributes items over shards such that the total weight of the shards is balanced.
+
+  Returns:
+    list: shard index of every item
+  """
+  load = [0] * numShards
+  assignment = [0] * len(weights)
+  # Largest items first, ties are broken by position for deterministic output
+  for i in sorted(range(len(weights)), key=lambda i: (-weights[i], i)):
+    target = min(range(numShards), key=lambda j: (load[j], j))
+    assignment[i] = target
+    load[target] += weights[i]
+  return assignment
 
 class NoScope:
   def __enter__(self):
@@ -106,16 +147,26 @@ class PPIfBlock:
     self.writer('#endif')
 
 class Cpp:
-  def __init__(self, streamOrFileName = sys.stdout):
+  def __init__(self, streamOrFileName = sys.stdout, writeIfChanged = False):
+    """If writeIfChanged is true and a file name is given, the code is rendered
+    into memory and the file is only replaced if its content changes."""
     self.fileHandle = streamOrFileName
     self.indent = 0
+    self._inMemory = writeIfChanged and isinstance(streamOrFileName, str)
     
   def __enter__(self):
-    self.out = open(self.fileHandle, 'w+') if isinstance(self.fileHandle, str) else self.fileHandle
+    if self._inMemory:
+      self.out = StringIO()
+    else:
+      self.out = open(self.fileHandle, 'w+') if isinstance(self.fileHandle, str) else self.fileHandle
     return self
     
   def __exit__(self, type, value, traceback):
-    if self.out is not sys.stdout:
+    if self._inMemory:
+      if type is None:
+        updateFile(self.fileHandle, self.out.getvalue())
+      self.out.close()
+    elif self.out is not sys.stdout:
       self.out.close()
     self.out = None
     
@@ -144,6 +195,9 @@ class Cpp:
       foot = [' // namespace {}'.format(s) for s in spaces]
       return MultiBlock(self, ['namespace ' + space for space in spaces], foot=foot)
 
+  def AnonymousNamespace(self):
+    return Block(self, 'namespace', foot=' // namespace')
+
   def AnonymousScope(self):
     return Block(self, '')
     
@@ -1,16 +1,7 @@
 from ..common import *
 from ..cache import RoutineGenerator, GpuRoutineGenerator
 from ..common import BatchedOperationsAux
-
-
-# Optional modules
-import importlib.util
-gf_spec = importlib.util.find_spec('gemmforge')
-try:
-  if gf_spec:
-    gf = gf_spec.loader.load_module()
-except:
-  raise ('Cannot load gemmforge.')
+from ... import optional
 
 
 class CopyScaleAddGenerator(object):
@@ -66,7 +57,8 @@ class CopyScaleAddGenerator(object):
     Returns:
 
     """
-    if (gf_spec):
+    if optional.isAvailable('gemmforge'):
+      gf = optional.load('gemmforge')
       d = self._descr  # type: copyscaleadd.Description
       m = d.loopRanges[d.result.indices[0]]
       n = d.loopRanges[d.result.indices[1]]
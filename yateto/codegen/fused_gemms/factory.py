@@ -1,11 +1,4 @@
-import importlib.util
-gb_spec = importlib.util.find_spec('chainforge')
-try:
-  if gb_spec:
-    gb = gb_spec.loader.load_module()
-    from .external_generator import FusedGemms
-except:
-  raise ('Found chainforge spec but cannot load. Please, check installation of chainforge')
+from ... import optional
 
 
 class Description(object):
@@ -35,7 +28,9 @@ class Description(object):
 
 
 def generator(arch, descr, target):
-  if target == 'gpu' and gb_spec:
+  if target == 'gpu' and optional.isAvailable('chainforge'):
+    # Imports chainforge
+    from .external_generator import FusedGemms
     return FusedGemms(arch, descr)
   else:
     raise NotImplementedError(f'no implementation found for {target} target')
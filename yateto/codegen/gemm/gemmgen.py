@@ -4,16 +4,7 @@ import tempfile
 from ..cache import RoutineGenerator, GpuRoutineGenerator
 from ...gemm_configuration import BLASlike, CodeGenerator, GemmForge
 from ..common import BatchedOperationsAux
-import importlib.util
-
-
-# Optional modules
-gf_spec = importlib.util.find_spec('gemmforge')
-try:
-  if gf_spec:
-    gf = gf_spec.loader.load_module()
-except:
-  raise ('Cannot load gemmforge.')
+from ... import optional
 
 
 class GemmGen(object):
@@ -100,7 +91,8 @@ class GemmGen(object):
 
     elif isinstance(self._gemm_cfg, GemmForge):
 
-      if gf_spec:
+      if optional.isAvailable('gemmforge'):
+        gf = optional.load('gemmforge')
         aux = BatchedOperationsAux(self._arch.typename)
 
         matrix_a = gf.YatetoInterface.produce_dense_matrix((m, k),
@@ -185,12 +177,15 @@ class GemmGen(object):
           d.prefetchName if d.prefetchName is not None else 'nullptr'
         ))
 
-      routineCache.addRoutine(routineName, ExecuteGemmGen(self._arch, gemm, spp, sppRows, self._gemm_cfg))
+      routineCache.addRoutine(routineName, ExecuteGemmGen(self._arch, gemm, spp, sppRows, self._gemm_cfg, routineCache.microkernelCache))
     
     return flops
 
 class ExecuteGemmGen(RoutineGenerator):  
-  def __init__(self, arch, gemmDescr, spp, sppRows, gemm_cfg):
+  # Every call spawns an external process writing to its own file
+  THREAD_SAFE = True
+
+  def __init__(self, arch, gemmDescr, spp, sppRows, gemm_cfg, microkernelCache=None):
     self._arch = arch
     self._gemmDescr = gemmDescr
     self._spp = spp
@@ -198,6 +193,7 @@ class ExecuteGemmGen(RoutineGenerator):
     self._mode = gemm_cfg.operation_name
     self._cmd = gemm_cfg.cmd
     self._blockSize = gemm_cfg.blockSize(gemmDescr['M'], gemmDescr['N'], gemmDescr['K']) if hasattr(gemm_cfg, 'blockSize') else dict()
+    self._microkernelCache = microkernelCache
   
   def __eq__(self, other):
     return self._arch == other._arch and \
@@ -218,6 +214,28 @@ class ExecuteGemmGen(RoutineGenerator):
       raise RuntimeError('GEMM code generator executable "{}" not found. (Make sure to add the folder containing the executable to your PATH.)'.format(self._cmd))
   
   def __call__(self, routineName, fileName):
+    if self._microkernelCache is None:
+      return self._generate(routineName, fileName)
+
+    # The routine name encodes the GEMM description including a hash of the sparsity pattern
+    cpu_arch = self._arch.host_name if self._arch.host_name else self._arch.name
+    key = self._microkernelCache.key(routineName, self._mode, self._cmd, cpu_arch, self._arch.precision,
+                                     self._sppRows, sorted(self._blockSize.items()))
+    entry = self._microkernelCache.load(key) if key is not None else None
+    if entry is not None:
+      declaration, code = entry
+      with open(fileName, 'a') as f:
+        f.write(code)
+      return declaration
+
+    declaration = self._generate(routineName, fileName)
+    if key is not None:
+      with open(fileName, 'r') as f:
+        code = f.read()
+      self._microkernelCache.store(key, (declaration, code))
+    return declaration
+
+  def _generate(self, routineName, fileName):
     cpu_arch = self._arch.host_name if self._arch.host_name else self._arch.name
 
     if self._mode == 'pspamm':
@@ -1,12 +1,13 @@
 import collections
 import operator
+import re
 from functools import reduce
 from io import StringIO
 from ..memory import DenseMemoryLayout
 from ..controlflow.visitor import ScalarsSet, SortedGlobalsList, SortedPrefetchList
-from ..controlflow.transformer import DetermineLocalInitialization
-from ..controlflow.graph import Variable
-from ..type import Tensor
+from ..controlflow.transformer import DetermineLocalInitialization, LivenessAnalysis
+from ..controlflow.graph import Variable, Expression, ProgramAction, ProgramPoint
+from ..type import Tensor, FoldedTensor
 from .code import Cpp
 from .factory import *
 from .common import BatchedOperationsAux
@@ -105,6 +106,8 @@ class OptimisedKernelGenerator(KernelGenerator):
   MEMBER_FUNCTION_PTR_NAME = 'member_function_ptr'
   TEMP_MEM_REQUIRED_NAME = 'TmpMemRequiredInBytes'
   TEMP_MAX_MEM_REQUIRED_NAME = 'TmpMaxMemRequiredInBytes'
+  SHARED_EXECUTE_NAME = '_executeShared'
+  PARAMETER_PREFIX = '_group'
 
   
   def __init__(self, arch, routineCache):
@@ -122,7 +125,10 @@ class OptimisedKernelGenerator(KernelGenerator):
                  function,
                  tmp_mem_size,
                  is_compute_constant_tensors,
-                 target):
+                 target,
+                 folded_tensors=frozenset(),
+                 parameters=None,
+                 parameterizedFunction=None):
 
       self.nonZeroFlops = nonZeroFlops
       self.hwFlops = hwFlops
@@ -134,6 +140,10 @@ class OptimisedKernelGenerator(KernelGenerator):
       self.tmp_mem_size = tmp_mem_size
       self.is_compute_constant_tensors = is_compute_constant_tensors
       self.target = target
+      self.folded_tensors = folded_tensors
+      # List of (parameter, argument, writable), see OptimisedKernelGenerator._parameterized
+      self.parameters = parameters
+      self.parameterizedFunction = parameterizedFunction
 
     @classmethod
     def _addTensor(cls, tensor, tensors):
@@ -147,12 +157,48 @@ class OptimisedKernelGenerator(KernelGenerator):
       else:
         tensors[base_name] = {group}
   
-  def generateKernelOutline(self, nonZeroFlops, cfg, gemm_cfg, target):
+  @classmethod
+  def _parameterized(cls, cfg):
+    """Replaces the variables of grouped tensors by parameters.
+
+    Parameters are named after the base name of the tensor and numbered in order of
+    first occurrence, hence isomorphic family members have equal parameterized cfgs.
+    Returns the new cfg and the list of (parameter, argument, writable).
+    """
+    renamed = dict()
+    count = collections.Counter()
+    def rename(var):
+      if var.isGlobal() and var.tensor.group():
+        if var.name not in renamed:
+          baseName = var.tensor.baseName()
+          parameter = '{}_{}_{}'.format(cls.PARAMETER_PREFIX, baseName, count[baseName])
+          count[baseName] += 1
+          renamed[var.name] = Variable(parameter, var.writable, var.memoryLayout(), var.eqspp(), var.tensor)
+        return renamed[var.name]
+      return var
+
+    parameterized = list()
+    for pp in cfg:
+      action = pp.action
+      if action:
+        result = rename(action.result)
+        if action.isRHSExpression():
+          term = Expression(action.term.node, action.term.memoryLayout(), [rename(var) for var in action.term.variableList()])
+        else:
+          term = rename(action.term)
+        action = ProgramAction(result, term, action.add, action.scalar)
+      parameterized.append(ProgramPoint(action))
+    parameters = [(var.name, name, var.writable) for name, var in renamed.items()]
+    return LivenessAnalysis().visit(parameterized), parameters
+
+  def generateKernelOutline(self, nonZeroFlops, cfg, gemm_cfg, target, parameterize=False):
+    """If parameterize is true, the function is also generated with parameters, see _parameterized."""
     scalars = ScalarsSet().visit(cfg)
     variables = SortedGlobalsList().visit(cfg)
     tensors = collections.OrderedDict()
     writable = dict()
     is_compute_constant_tensors = dict()
+    folded_tensors = set()
     for var in variables:
       self.KernelOutline._addTensor(var.tensor, tensors)
       bn = var.tensor.baseNameWithNamespace()
@@ -164,12 +210,19 @@ class OptimisedKernelGenerator(KernelGenerator):
         writable[bn] = var.writable
 
       is_compute_constant_tensors[bn] = var.tensor.is_compute_constant()
+      if isinstance(var.tensor, FoldedTensor):
+        folded_tensors.add(bn)
 
     prefetchTensors = SortedPrefetchList().visit(cfg)
     prefetch = collections.OrderedDict()
     for tensor in prefetchTensors:
       self.KernelOutline._addTensor(tensor, prefetch)
 
+    parameters = None
+    parameterizedFunction = None
+    if parameterize and target == 'cpu':
+      cfg, parameters = self._parameterized(cfg)
+
     functionIO = StringIO()
     function = ''
     with Cpp(functionIO) as fcpp:
@@ -179,6 +232,13 @@ class OptimisedKernelGenerator(KernelGenerator):
       factory.reset_stream()
       factory.reset_flags()
       function = functionIO.getvalue()    
+
+    if parameters:
+      # Parameter names are unique identifiers, hence the arguments may be substituted back
+      parameterizedFunction = function
+      substitution = {parameter: argument for parameter, argument, _ in parameters}
+      function = re.sub(r'\b{}_\w+\b'.format(self.PARAMETER_PREFIX),
+                        lambda match: substitution.get(match.group(0), match.group(0)), function)
     return self.KernelOutline(nonZeroFlops,
                               hwFlops,
                               tensors,
@@ -188,7 +248,10 @@ class OptimisedKernelGenerator(KernelGenerator):
                               function,
                               tmp_memory,
                               is_compute_constant_tensors,
-                              target)
+                              target,
+                              frozenset(folded_tensors),
+                              parameters,
+                              parameterizedFunction)
 
   @classmethod
   def _addFromKO(cls, koEntries, entries):
@@ -205,8 +268,10 @@ class OptimisedKernelGenerator(KernelGenerator):
     writable = dict()
     scalars = set()
     is_compute_constant_tensors = dict()
+    folded_tensors = set()
     for ko in kernelOutlines:
       if ko:
+        folded_tensors |= ko.folded_tensors
         scalars = scalars | ko.scalars
         self._addFromKO(ko.tensors, tensors)
         self._addFromKO(ko.writable, writable)
@@ -224,6 +289,27 @@ class OptimisedKernelGenerator(KernelGenerator):
 
     scalars = sorted(list(scalars), key=str)
 
+    # Family members with equal execute bodies share one function
+    bodies = [self._executeBody(kernelOutline, target) if kernelOutline else None for kernelOutline in kernelOutlines]
+    aliases = list(range(len(kernelOutlines)))
+    if familyStride is not None:
+      firstIndex = dict()
+      for index, body in enumerate(bodies):
+        if body is not None:
+          aliases[index] = firstIndex.setdefault(body, index)
+
+    # Other members whose bodies are equal up to their grouped tensors share a function,
+    # which receives the tensors as arguments from the execute functions of the members
+    shared = [None] * len(kernelOutlines)
+    if familyStride is not None:
+      firstIndex = dict()
+      for index, kernelOutline in enumerate(kernelOutlines):
+        if kernelOutline and aliases[index] == index and kernelOutline.parameters:
+          key = (kernelOutline.parameterizedFunction, self._parameterList(kernelOutline))
+          shared[index] = firstIndex.setdefault(key, index)
+      sharing = collections.Counter(shared)
+      shared = [index if index is not None and sharing[index] > 1 else None for index in shared]
+
     if familyStride is not None:
       executeName = lambda index: self.EXECUTE_NAME + str(index)
       formatArray = lambda lst: '{{{}}}'.format(', '.join([str(l) for l in lst]))
@@ -282,6 +368,10 @@ class OptimisedKernelGenerator(KernelGenerator):
             class_name = f'{prefix}{InitializerGenerator.TENSOR_NAMESPACE}::{base_name}'
             container_type = f'{InitializerGenerator.CONTAINER_CLASS_NAME}<{typ}{ptr_type}>'
             header(f'{class_name}::{container_type} {base_name};')
+          elif is_constant and base_name_with_namespace in folded_tensors:
+            # Folded tensors point to their values in the init code by default
+            values = f'{prefix}{InitializerGenerator.INIT_NAMESPACE}::{base_name}::{InitializerGenerator.VALUES_BASENAME}'
+            header(f'{typ}{ptr_type} {base_name}{{{values}}};')
           else:
             header(f'{typ}{ptr_type} {base_name}{{}};')
         
@@ -322,8 +412,15 @@ class OptimisedKernelGenerator(KernelGenerator):
           header.emptyline()
 
         for index, kernelOutline in enumerate(kernelOutlines):
-          if kernelOutline:
+          if kernelOutline and aliases[index] == index:
             header.functionDeclaration(executeName(index))
+          elif kernelOutline:
+            # Members equal to an earlier member share its body
+            with header.Function(executeName(index), '', '{} void'.format(INLINE)):
+              header('{}();'.format(executeName(aliases[index])))
+        for index, kernelOutline in enumerate(kernelOutlines):
+          if shared[index] == index:
+            header.functionDeclaration(self.SHARED_EXECUTE_NAME + str(index), self._parameterList(kernelOutline))
 
         if familyStride is not None:
           header('using {} = void ({}::*)();'.format(self.MEMBER_FUNCTION_PTR_NAME, name))
@@ -331,7 +428,7 @@ class OptimisedKernelGenerator(KernelGenerator):
             MODIFIERS,
             self.MEMBER_FUNCTION_PTR_NAME,
             self.EXECUTE_ARRAY_NAME,
-            formatArray(['&{}::{}'.format(name, executeName(index)) if kernelOutline else 'nullptr' for index, kernelOutline in enumerate(kernelOutlines)])
+            formatArray(['&{}::{}'.format(name, executeName(aliases[index])) if kernelOutline else 'nullptr' for index, kernelOutline in enumerate(kernelOutlines)])
           ))
           args = typedNdArgs(len(familyStride), self._arch.uintTypename)
           indexF = indexFun(familyStride)
@@ -364,27 +461,45 @@ class OptimisedKernelGenerator(KernelGenerator):
         self.MEMBER_FUNCTION_PTR_NAME,
         self.EXECUTE_ARRAY_NAME
       ))
-    for index, kernelOutline in enumerate(kernelOutlines):
-      if kernelOutline is None:
+    for index, body in enumerate(bodies):
+      if body is None or aliases[index] != index:
         continue
 
+      kernelOutline = kernelOutlines[index]
+      if shared[index] is not None:
+        if shared[index] == index:
+          with cpp.Function('{}::{}::{}'.format(self.NAMESPACE, name, self.SHARED_EXECUTE_NAME + str(index)), self._parameterList(kernelOutline)):
+            cpp(kernelOutline.parameterizedFunction)
+        arguments = ', '.join(argument for _, argument, _ in kernelOutline.parameters)
+        body = self._executeBody(kernelOutline, target, '{}{}({});'.format(self.SHARED_EXECUTE_NAME, shared[index], arguments))
+
       with cpp.Function('{}::{}::{}'.format(self.NAMESPACE, name, executeName(index))):
-        sclrs = sorted(list(kernelOutline.scalars), key=str)
-        for scalar in sclrs:
-          cpp('assert(!std::isnan({}));'.format(scalar))
-        for base_name_with_namespace, groups in kernelOutline.tensors.items():
-          base_name = Tensor.splitBasename(base_name_with_namespace)[-1]
-          if len(next(iter(groups))) > 0:
-            for gis in groups:
-              cpp('assert({}({}) != nullptr);'.format(base_name, ','.join(str(gi) for gi in gis)))
-          else:
-            cpp(f'assert({base_name} != nullptr);')
+        cpp(body)
+
+  def _parameterList(self, kernelOutline):
+    return ', '.join('{}{}* {}'.format(self._arch.typename, '' if writable else ' const', parameter)
+                     for parameter, _, writable in kernelOutline.parameters)
+
+  def _executeBody(self, kernelOutline, target, function=None):
+    bodyIO = StringIO()
+    with Cpp(bodyIO) as cpp:
+      sclrs = sorted(list(kernelOutline.scalars), key=str)
+      for scalar in sclrs:
+        cpp('assert(!std::isnan({}));'.format(scalar))
+      for base_name_with_namespace, groups in kernelOutline.tensors.items():
+        base_name = Tensor.splitBasename(base_name_with_namespace)[-1]
+        if len(next(iter(groups))) > 0:
+          for gis in groups:
+            cpp('assert({}({}) != nullptr);'.format(base_name, ','.join(str(gi) for gi in gis)))
+        else:
+          cpp(f'assert({base_name} != nullptr);')
 
-        if target == 'gpu':
-          cpp(f'assert({BatchedOperationsAux.NUM_ELEMENTS_NAME} != 0);')
-          cpp(f'assert({BatchedOperationsAux.STREAM_PTR_NAME} != {BatchedOperationsAux.FORBIDDEN_STREAM_PTR});')
+      if target == 'gpu':
+        cpp(f'assert({BatchedOperationsAux.NUM_ELEMENTS_NAME} != 0);')
+        cpp(f'assert({BatchedOperationsAux.STREAM_PTR_NAME} != {BatchedOperationsAux.FORBIDDEN_STREAM_PTR});')
 
-        cpp(kernelOutline.function)
+      cpp(kernelOutline.function if function is None else function)
+      return bodyIO.getvalue()
 
 class UnitTestGenerator(KernelGenerator):
   KERNEL_VAR = 'krnl'
@@ -1,6 +1,7 @@
 from .graph import *
+import collections
 from collections import deque
-from ..ast.node import LoopOverGEMM
+from ..ast.node import LoopOverGEMM, IndexSum, Permute, Product, ScalarMultiplication
 from .fused_gemm_automata import Context as FusedGemmsContext
 
 
@@ -80,6 +81,73 @@ class RemoveEmptyStatements(object):
         i += 1
     return cfg
 
+class EliminateCommonSubexpressions(object):
+  """Computes equal right-hand sides only once.
+
+  An action is equal to an earlier one if operation, operands, scalar, and memory
+  layouts agree and no operand has been written in between. Local results are replaced
+  by the earlier result, global results copy the earlier result. Actions with an
+  operation whose attributes are unknown to _attributes are never eliminated.
+  """
+  @staticmethod
+  def _attributes(node):
+    """Attributes of node which determine its code besides indices and memory layouts."""
+    if isinstance(node, LoopOverGEMM):
+      return (repr(node.loopIndices()), node.transA(), node.transB())
+    if isinstance(node, IndexSum):
+      return (repr(node.sumIndex()),)
+    if isinstance(node, ScalarMultiplication):
+      return (str(node.scalar()),)
+    if isinstance(node, (Product, Permute)):
+      return ()
+    return None
+
+  @classmethod
+  def _key(cls, action):
+    if action.isCompound():
+      return None
+    if action.isRHSVariable():
+      operation = ('Variable', action.term.name, str(action.term.memoryLayout()))
+    else:
+      node = action.term.node
+      attributes = cls._attributes(node)
+      if attributes is None:
+        return None
+      eqspp = node.eqspp()
+      prefetch = node.prefetch.name() if node.prefetch is not None else None
+      operands = tuple((var.name, repr(child.indices), str(var.memoryLayout()))
+                       for var, child in zip(action.term.variableList(), node))
+      operation = (type(node).__name__, repr(node.indices), attributes, operands, prefetch,
+                   eqspp.digest() if eqspp is not None else None, str(action.term.memoryLayout()))
+    return operation + (str(action.scalar), str(action.result.memoryLayout()))
+
+  def visit(self, cfg):
+    writes = collections.Counter(pp.action.result.name for pp in cfg if pp.action)
+    # Mapping key -> (result, names of operands)
+    available = dict()
+    n = len(cfg)-1
+    i = 0
+    while i < n:
+      ua = cfg[i].action
+      key = self._key(ua)
+      if key in available and writes[ua.result.name] == 1:
+        by = available[key][0]
+        if ua.result.isGlobal():
+          cfg[i].action = ProgramAction(ua.result, by, False)
+        elif all(cfg[j].action.maySubstitute(ua.result, by) for j in range(i+1, n)):
+          for j in range(i+1, n):
+            cfg[j].action = cfg[j].action.substituted(ua.result, by)
+          del cfg[i]
+          n -= 1
+          continue
+      result = cfg[i].action.result
+      available = {k: v for k, v in available.items() if result.name not in v[1]}
+      operands = {var.name for var in ua.term.variables()}
+      if key is not None and writes[result.name] == 1 and result.name not in operands:
+        available.setdefault(key, (result, operands))
+      i += 1
+    return cfg
+
 class MergeActions(object):
   def visit(self, cfg):
     n = len(cfg)-1
@@ -98,7 +166,8 @@ class MergeActions(object):
             break
           else:
             V = V | va.variables() | {va.result}
-        if found >= 0:
+        # The result must not be read after the copy, e.g. if it is reused by EliminateCommonSubexpressions
+        if found >= 0 and ua.result not in cfg[found+1].live:
           va = cfg[found].action
           if ua.maySubstitute(ua.result, va.result, term=False):
             cfg[i].action = ua.substituted(ua.result, va.result, term=False)
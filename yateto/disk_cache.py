@@ -0,0 +1,41 @@
+import os
+import pickle
+import tempfile
+import threading
+
+class DiskCache(object):
+  """Directory of pickled entries, one file per key, with hit/miss statistics."""
+  FILE_SUFFIX = '.pickle'
+
+  def __init__(self, directory):
+    self._directory = directory
+    os.makedirs(self._directory, exist_ok=True)
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def _fileName(self, key):
+    return os.path.join(self._directory, key + self.FILE_SUFFIX)
+
+  def load(self, key):
+    try:
+      with open(self._fileName(key), 'rb') as f:
+        entry = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+      with self._lock:
+        self.misses += 1
+      return None
+    with self._lock:
+      self.hits += 1
+    return entry
+
+  def store(self, key, entry):
+    # Write to a temporary file first such that concurrent builds never see partial entries
+    fd, tmpName = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(tmpName, self._fileName(key))
+    except:
+      os.remove(tmpName)
+      raise
@@ -1,24 +1,35 @@
+import collections
+import concurrent.futures
 import copy
+import io
 import itertools
+import pickle
 import re
 import os
 from functools import wraps
 from yateto import Tensor
+from . import aspp
+from .ast import opt
+from .autotune import Autotuner
 from .ast.cost import BoundingBoxCostEstimator
-from .ast.node import Node
-from .ast.visitor import ComputeOptimalFlopCount, FindIndexPermutations, FindTensors, FindPrefetchCapabilities
+from .ast.node import Node, IndexedTensor
+from .ast.visitor import ComputeOptimalFlopCount, ComputeNonZeroFlops, FindIndexPermutations, FindTensors, FindPrefetchCapabilities, ComputeSignature
 from .ast.transformer import *
 from .codegen.cache import *
-from .codegen.code import Cpp
+from .codegen.code import Cpp, shard
 from .codegen.test_framework import *
 from .codegen.visitor import *
+from .controlflow.graph import Variable
 from .controlflow.visitor import AST2ControlFlow
 from .controlflow.transformer import *
 from .gemm_configuration import GeneratorCollection, DefaultGeneratorCollection, BLASlike
+from .memory import DenseMemoryLayout
+from .plan_cache import PlanCache
+from . import profiling
+from .profiling import Profiler, profile
 from typing import List
 from io import StringIO
-import importlib.util
-chainforge_spec = importlib.util.find_spec('chainforge')
+from . import optional
 
 
 class Kernel(object):
@@ -26,7 +37,8 @@ class Kernel(object):
   VALID_NAME = r'^{}$'.format(BASE_NAME)
   VALID_TARGETS = ['cpu', 'gpu']
 
-  def __init__(self, name, ast, prefetch=None, namespace=None, target='cpu'):
+  def __init__(self, name, ast, prefetch=None, namespace=None, target='cpu', family=None, group=None):
+    """family and group are the name of the family and the group of family members."""
     self.name = name
     if isinstance(ast, list):
       self.ast = ast
@@ -49,62 +61,127 @@ class Kernel(object):
       raise ValueError(f'target platform is incorrect. '
                        f'Given: {target}. Allowed: {", ".join(self.VALID_TARGETS)}')
     self.target = target
+    self.family = family
+    self.group = group
 
     self.cfg = None
+    self.unitTestCfg = None
     self.nonZeroFlops = -1
+    self.searchStatistics = None
 
   @classmethod
   def isValidName(cls, name):
     return re.match(cls.VALID_NAME, name) is not None
 
-  def prepareUntilUnitTest(self):
+  @classmethod
+  def _signature(cls, kernel, signatureVisitor):
+    prefetch = tuple(signatureVisitor.tensor(pf) for pf in kernel._prefetch) if kernel._prefetch is not None else None
+    return (kernel.target, prefetch) + tuple(signatureVisitor.visit(ast) for ast in kernel.ast)
+
+  def prefetch(self):
+    return self._prefetch
+
+  def signature(self):
+    return self._signature(self, ComputeSignature())
+
+  def canonicalSignature(self):
+    """Signature up to the group indices of tensors, and the tensors in canonical order.
+
+    Kernels with equal canonical signature are isomorphic, i.e. the optimized plan of
+    one kernel is valid for the other after exchanging the tensors.
+    """
+    signatureVisitor = ComputeSignature(group=False, values=False)
+    return self._signature(self, signatureVisitor), signatureVisitor.tensors
+
+  def setIsomorphicPlan(self, plan, tensors, ownTensors):
+    """Sets a copy of the plan of an isomorphic kernel, see canonicalSignature."""
+    self.setPlan(_TensorExchange(tensors, ownTensors).copy(plan))
+    # No search took place for this kernel
+    self.searchStatistics = opt.SearchStatistics()
+
+  def plan(self):
+    return self.ast, self.cfg, self.nonZeroFlops, self.searchStatistics
+
+  def setPlan(self, plan):
+    self.ast, cfg, self.nonZeroFlops, self.searchStatistics = plan
+    # Live sets are recomputed such that their iteration order does not depend on unpickling
+    self.cfg = LivenessAnalysis().visit(cfg)
+
+  def prepareUntilUnitTest(self, unitTest=True, copyAst=False):
     self.ast = [DeduceIndices().visit(ast) for ast in self.ast]
+    if unitTest:
+      self.prepareUnitTest(copyAst)
+
+  def prepareUnitTest(self, copyAst=False):
+    """Creates the control flow graph of the unit test.
+
+    The optimization transforms the ASTs in place, hence copyAst must be true
+    if the unit test is generated after prepareUntilCodeGen.
+    """
     ast2cf = AST2ControlFlow(simpleMemoryLayout=True)
-    for ast in self.ast:
+    for ast in (copy.deepcopy(self.ast) if copyAst else self.ast):
       ast2cf.visit(ast)
     self.cfg = ast2cf.cfg()
     self.cfg = LivenessAnalysis().visit(self.cfg)
+    self.unitTestCfg = self.cfg
   
-  def prepareUntilCodeGen(self, cost_estimator):
+  def _apply(self, visitor, node, phase=None):
+    with profile(phase or type(visitor).__name__, self.name):
+      return visitor.visit(node)
+
+  def _nonZeroFlopsOfCopy(self, ast, strengthReduction):
+    ast = copy.deepcopy(ast)
+    ast = self._apply(EquivalentSparsityPattern(groupSpp=False), ast, 'NonZeroFlops/EquivalentSparsityPattern')
+    ast = self._apply(strengthReduction, ast, 'NonZeroFlops/StrengthReduction')
+    ast = self._apply(SetSparsityPattern(), ast, 'NonZeroFlops/SetSparsityPattern')
+    return self._apply(ComputeOptimalFlopCount(), ast, 'NonZeroFlops/ComputeOptimalFlopCount')
+
+  def prepareUntilCodeGen(self, cost_estimator, search_strategy=None, nodes=None):
+    """nodes is an opt.NodeTable which may be shared with other kernels."""
     self.nonZeroFlops = 0
-    for a in self.ast:
-      ast = copy.deepcopy(a)
-      ast = EquivalentSparsityPattern(groupSpp=False).visit(ast)
-      ast = StrengthReduction(cost_estimator).visit(ast)
-      ast = SetSparsityPattern().visit(ast)
-      self.nonZeroFlops += ComputeOptimalFlopCount().visit(ast)
+    # All ASTs share costs of equal subexpressions
+    strengthReduction = StrengthReduction(cost_estimator, search_strategy, nodes)
+    self.searchStatistics = strengthReduction.statistics
 
     tmpASTs = list()
     prefetch = copy.copy(self._prefetch)
     for ast in self.ast:
-      ast = EquivalentSparsityPattern().visit(ast)
-      ast = StrengthReduction(cost_estimator).visit(ast)
-      ast = FindContractions().visit(ast)
-      ast = ComputeMemoryLayout().visit(ast)
-      permutationVariants = FindIndexPermutations().visit(ast)
-      ast = SelectIndexPermutations(permutationVariants).visit(ast)
-      ast = ImplementContractions().visit(ast)
+      # Non-zero flops are counted with the sparsity patterns of the tensors instead of the
+      # ones of their groups. Only if those differ, the count needs an optimization of its own.
+      groupSpp = any(tensor.spp() is not tensor.spp(groupSpp=False) for tensor in FindTensors().visit(ast).values())
+      if groupSpp:
+        self.nonZeroFlops += self._nonZeroFlopsOfCopy(ast, strengthReduction)
+      ast = self._apply(EquivalentSparsityPattern(), ast)
+      ast = self._apply(strengthReduction, ast)
+      if not groupSpp:
+        self.nonZeroFlops += self._apply(ComputeNonZeroFlops(), ast)[0]
+      ast = self._apply(FindContractions(), ast)
+      ast = self._apply(ComputeMemoryLayout(), ast)
+      permutationVariants = self._apply(FindIndexPermutations(), ast)
+      ast = self._apply(SelectIndexPermutations(permutationVariants), ast)
+      ast = self._apply(ImplementContractions(), ast)
       if self._prefetch is not None:
-        prefetchCapabilities = FindPrefetchCapabilities().visit(ast)
+        prefetchCapabilities = self._apply(FindPrefetchCapabilities(), ast)
         assignPf = AssignPrefetch(prefetchCapabilities, prefetch)
-        ast = assignPf.visit(ast)
+        ast = self._apply(assignPf, ast)
         prefetch = [pf for pf in prefetch if pf not in assignPf.assigned()]
       tmpASTs.append(ast)
     self.ast = tmpASTs
 
     ast2cf = AST2ControlFlow()
     for ast in self.ast:
-      ast2cf.visit(ast)
+      self._apply(ast2cf, ast)
     self.cfg = ast2cf.cfg()
-    self.cfg = MergeScalarMultiplications().visit(self.cfg)
-    self.cfg = LivenessAnalysis().visit(self.cfg)
-    self.cfg = SubstituteForward().visit(self.cfg)
-    self.cfg = SubstituteBackward().visit(self.cfg)
-    self.cfg = RemoveEmptyStatements().visit(self.cfg)
-    self.cfg = MergeActions().visit(self.cfg)
-    if self.target == 'gpu' and chainforge_spec:
-      self.cfg = FindFusedGemms().visit(self.cfg)
-      self.cfg = LivenessAnalysis().visit(self.cfg)
+    self.cfg = self._apply(EliminateCommonSubexpressions(), self.cfg)
+    self.cfg = self._apply(MergeScalarMultiplications(), self.cfg)
+    self.cfg = self._apply(LivenessAnalysis(), self.cfg)
+    self.cfg = self._apply(SubstituteForward(), self.cfg)
+    self.cfg = self._apply(SubstituteBackward(), self.cfg)
+    self.cfg = self._apply(RemoveEmptyStatements(), self.cfg)
+    self.cfg = self._apply(MergeActions(), self.cfg)
+    if self.target == 'gpu' and optional.isAvailable('chainforge'):
+      self.cfg = self._apply(FindFusedGemms(), self.cfg)
+      self.cfg = self._apply(LivenessAnalysis(), self.cfg)
 
 class KernelFamily(object):
   GROUP_INDEX = r'\((0|[1-9]\d*)\)'
@@ -162,7 +239,7 @@ class KernelFamily(object):
     
     group = self.group(name)
     internalName = '_{}_{}'.format(baseName, group)
-    self._kernels[group] = Kernel(internalName, ast, prefetch, namespace, target)
+    self._kernels[group] = Kernel(internalName, ast, prefetch, namespace, target, baseName, group)
 
     if namespace is None:
       self.namespace = ''
@@ -172,13 +249,124 @@ class KernelFamily(object):
   def kernels(self):
     return self._kernels.values()
 
-  def prepareUntilUnitTest(self):
+  def prepareUntilUnitTest(self, unitTest=True, copyAst=False):
     for kernel in self._kernels.values():
-      kernel.prepareUntilUnitTest()
+      kernel.prepareUntilUnitTest(unitTest, copyAst)
   
-  def prepareUntilCodeGen(self, costEstimator):
+  def prepareUntilCodeGen(self, costEstimator, searchStrategy=None):
+    nodes = opt.NodeTable()
     for kernel in self._kernels.values():
-      kernel.prepareUntilCodeGen(costEstimator)
+      kernel.prepareUntilCodeGen(costEstimator, searchStrategy, nodes)
+
+class _TensorExchange(object):
+  """Deep copy which replaces tensors, and control flow variables of these tensors."""
+  class _Pickler(pickle.Pickler):
+    def persistent_id(self, obj):
+      if isinstance(obj, Tensor) and (obj.namespace, obj.name()) in self.exchange:
+        return ('Tensor', (obj.namespace, obj.name()))
+      # Variables are named after their tensor
+      if isinstance(obj, Variable) and obj.tensor is not None and (obj.tensor.namespace, obj.tensor.name()) in self.exchange:
+        return ('Variable', dict(vars(obj)))
+      return None
+
+  class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+      kind, state = pid
+      if kind == 'Tensor':
+        return self.exchange[state]
+      variable = Variable.__new__(Variable)
+      vars(variable).update(state)
+      variable.name = variable.tensor.name()
+      return variable
+
+  def __init__(self, tensors, newTensors):
+    # Plans may have been unpickled, hence tensors are identified by name
+    self._exchange = {(tensor.namespace, tensor.name()): newTensor for tensor, newTensor in zip(tensors, newTensors)}
+
+  def copy(self, obj):
+    buffer = io.BytesIO()
+    pickler = self._Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+    pickler.exchange = self._exchange
+    pickler.dump(obj)
+    buffer.seek(0)
+    unpickler = self._Unpickler(buffer)
+    unpickler.exchange = self._exchange
+    return unpickler.load()
+
+class _ShareIntermediates(object):
+  """Replaces subexpressions common to several kernels by shared tensors.
+
+  A shared tensor is computed by the first kernel which uses it, directly before
+  the first Assign that contains it, and read by all later kernels.
+  """
+  def __init__(self, name, kernels):
+    self._name = name
+    self._kernels = kernels
+    self._written = {ast.leftTerm().tensor.nameWithNamespace() for kernel in kernels for ast in kernel.ast}
+    self.tensors = dict()
+
+  def _signature(self, node):
+    if isinstance(node, IndexedTensor) or len(node.indices) == 0:
+      return None
+    if any(tensor.nameWithNamespace() in self._written for tensor in FindTensors().visit(node).values()):
+      return None
+    return ComputeSignature().visit(node)
+
+  def _occurrences(self, node, signatures, maximal):
+    signature = self._signature(node)
+    if signature is not None and (not maximal or signature in signatures):
+      yield signature
+      if maximal:
+        return
+    for child in node:
+      yield from self._occurrences(child, signatures, maximal)
+
+  def _shared(self, signatures, maximal):
+    kernelsOf = collections.defaultdict(set)
+    for kernel in self._kernels:
+      for ast in kernel.ast:
+        for signature in self._occurrences(ast.rightTerm(), signatures, maximal):
+          kernelsOf[signature].add(kernel.name)
+    return {signature for signature, names in kernelsOf.items() if len(names) > 1}
+
+  def _replace(self, node, shared, assigns):
+    signature = self._signature(node)
+    if signature in shared:
+      if signature not in self.tensors:
+        node.setChildren([self._replace(child, shared, assigns) for child in node])
+        eqspp = EquivalentSparsityPattern().visit(copy.deepcopy(node)).eqspp()
+        tensor = Tensor('{}_{}'.format(self._name, len(self.tensors)), node.indices.shape(), spp=eqspp)
+        assigns.append(DeduceIndices().visit(tensor[node.indices.tostring()] <= node))
+        self.tensors[signature] = tensor
+      return self.tensors[signature][node.indices.tostring()]
+    node.setChildren([self._replace(child, shared, assigns) for child in node])
+    return node
+
+  def apply(self):
+    # Only subexpressions which are maximal in at least two kernels are shared
+    shared = self._shared(self._shared(None, False), True)
+    for kernel in self._kernels:
+      asts = list()
+      for ast in kernel.ast:
+        ast.setChildren([ast.leftTerm(), self._replace(ast.rightTerm(), shared, asts)])
+        asts.append(ast)
+      kernel.ast = asts
+
+def _initWorker(alignmentArch, profileMemory):
+  DenseMemoryLayout.setAlignmentArch(alignmentArch)
+  if profileMemory is not None:
+    Profiler(profileMemory).__enter__()
+
+def _prepareUntilCodeGen(kernel, costEstimator, searchStrategy):
+  # Entry point of worker processes; only the optimized state and profiling events are sent back.
+  profiler = profiling.active()
+  if profiler is None:
+    kernel.prepareUntilCodeGen(costEstimator, searchStrategy)
+    return kernel.plan(), None
+  first = len(profiler.events)
+  with profile('prepareUntilCodeGen', kernel.name):
+    kernel.prepareUntilCodeGen(costEstimator, searchStrategy)
+  return kernel.plan(), profiler.events[first:]
 
 def simpleParameterSpace(*args):
   return list(itertools.product(*[list(range(i)) for i in args]))
@@ -197,6 +385,9 @@ class Generator(object):
   DOCTEST_FILE_NAME = 'test-kernel'
   HEADER_GUARD_SUFFIX = 'H_'
   SUPPORT_LIBRARY_HEADER = 'yateto.h'
+  JOBS_ENV = 'YATETO_JOBS'
+  SHARD_BY = ('kernel', 'namespace')
+  UNIT_TESTS = (True, False, 'deferred')
   
   class FileNames(object):
     HEADER = 'h'
@@ -207,10 +398,25 @@ class Generator(object):
       self.cppName = '{}.{}'.format(name, self.CPP)
       self.h = os.path.join(outputDir, self.hName)
       self.cpp = os.path.join(outputDir, self.cppName)
+      self._outputDir = outputDir
+      self._name = name
+
+    def cppShards(self, numShards):
+      """Source files of a library split into numShards translation units: name.cpp, name_1.cpp, ..."""
+      return [self.cpp] + [os.path.join(self._outputDir, '{}_{}.{}'.format(self._name, i, self.CPP)) for i in range(1, numShards)]
+
+    def removeStaleShards(self, numShards):
+      """Removes the shards name_i.cpp with i >= numShards, which are left over from a run with more shards."""
+      pattern = re.compile(r'{}_([0-9]+)\.{}$'.format(re.escape(self._name), self.CPP))
+      for fileName in os.listdir(self._outputDir):
+        match = pattern.match(fileName)
+        if match and int(match.group(1)) >= numShards:
+          os.remove(os.path.join(self._outputDir, fileName))
   
   def __init__(self, arch):
     self._kernels = list()
     self._kernelFamilies = dict()
+    self._sharedIntermediates = list()
     self._arch = arch
 
   def arch(self):
@@ -254,55 +460,287 @@ class Generator(object):
       prefetch = prefetchGenerator(*p) if prefetchGenerator is not None else None
       family.add(indexedName, ast, prefetch, namespace, target=target)
   
+  def shareIntermediates(self, name: str, kernelNames: List[str]):
+    """Computes subexpressions common to the given kernels only once.
+
+    Maximal subexpressions that occur in at least two of the kernels are stored in
+    the tensors name_0, name_1, ..., which are written by the first kernel using
+    them and read by the others. Hence, the kernels must be called in the given
+    order, and their inputs must not change in between. Subexpressions involving
+    an output of one of the kernels are never shared.
+    """
+    if not Tensor.isValidName(name):
+      raise ValueError(f'Tensor name invalid (must match regexp {Tensor.VALID_NAME}): {name}')
+    known = {kernel.name for kernel in self.kernels()}
+    unknown = [kernelName for kernelName in kernelNames if kernelName not in known]
+    if unknown:
+      raise ValueError(f'Unknown kernels: {", ".join(unknown)}')
+    self._sharedIntermediates.append((name, list(kernelNames)))
+
   def _headerGuardName(self, namespace, fileBaseName):
     partlist = namespace.upper().split('::') + [fileBaseName.upper(), self.HEADER_GUARD_SUFFIX]
     return '_'.join(partlist)
 
+  @classmethod
+  def numJobs(cls, jobs=None):
+    """Number of parallel jobs used to optimize kernels and to call external code generators.
+
+    The environment variable YATETO_JOBS takes precedence over the jobs argument.
+    A value smaller than 1 selects the number of available CPUs.
+    """
+    env = os.environ.get(cls.JOBS_ENV, '')
+    if env:
+      try:
+        jobs = int(env)
+      except ValueError:
+        raise ValueError(f'{cls.JOBS_ENV} must be an integer, given: {env}')
+    if jobs is None:
+      return 1
+    if jobs < 1:
+      return os.cpu_count() or 1
+    return jobs
+
+  def _prepareUntilCodeGen(self, cost_estimator, search_strategy, jobs, plan_cache):
+    # Family members are handled individually as families may be large.
+    # Isomorphic members are optimized only once.
+    kernels = [(kernel.name, kernel) for kernel in self._kernels]
+    isomorphic = list()
+    for family in self._kernelFamilies.values():
+      representatives = dict()
+      for kernel in family.kernels():
+        signature, tensors = kernel.canonicalSignature()
+        if signature in representatives:
+          isomorphic.append((kernel, tensors) + representatives[signature])
+        else:
+          representatives[signature] = (kernel, tensors)
+          kernels.append((family.name, kernel))
+
+    def strategy(name):
+      return search_strategy.get(name) if isinstance(search_strategy, dict) else search_strategy
+
+    keys = dict()
+    pending = list()
+    for name, kernel in kernels:
+      if plan_cache is not None:
+        key = plan_cache.key(kernel.signature(), self._arch, cost_estimator, strategy(name))
+        plan = plan_cache.load(key)
+        if plan is not None:
+          kernel.setPlan(plan)
+          continue
+        keys[kernel] = key
+      pending.append((name, kernel))
+
+    lastName = None
+    def finish(name, kernel):
+      nonlocal lastName
+      if name != lastName:
+        print(name)
+        lastName = name
+      if plan_cache is not None:
+        plan_cache.store(keys[kernel], kernel.plan())
+
+    if jobs == 1 or len(pending) <= 1:
+      # Kernels share costs of equal subexpressions; worker processes cannot share them
+      nodes = opt.NodeTable()
+      for name, kernel in pending:
+        with profile('prepareUntilCodeGen', kernel.name):
+          kernel.prepareUntilCodeGen(cost_estimator, strategy(name), nodes)
+        finish(name, kernel)
+    else:
+      profiler = profiling.active()
+      with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                  initializer=_initWorker,
+                                                  initargs=(DenseMemoryLayout.ALIGNMENT_ARCH,
+                                                            profiler.memory if profiler is not None else None)) as executor:
+        results = executor.map(_prepareUntilCodeGen,
+                               [kernel for _, kernel in pending],
+                               itertools.repeat(cost_estimator),
+                               [strategy(name) for name, _ in pending])
+        for (name, kernel), (plan, events) in zip(pending, results):
+          kernel.setPlan(plan)
+          if events is not None:
+            profiler.merge(events)
+          finish(name, kernel)
+
+    for kernel, tensors, representative, representativeTensors in isomorphic:
+      kernel.setIsomorphicPlan(representative.plan(), representativeTensors, tensors)
+    if isomorphic:
+      print('{} isomorphic family members share plans'.format(len(isomorphic)))
+
+    if plan_cache is not None:
+      print('Plan cache: {} hits, {} misses'.format(plan_cache.hits, plan_cache.misses))
+
+    if search_strategy is not None:
+      statistics = opt.SearchStatistics()
+      for _, kernel in kernels:
+        statistics.add(kernel.searchStatistics)
+      print('Contraction order search: {} explored, {} pruned'.format(statistics.explored, statistics.pruned))
+      exceeded = [kernel.name for _, kernel in kernels if kernel.searchStatistics.budgetExceeded]
+      if exceeded:
+        print('Search budget exceeded for: {}'.format(', '.join(exceeded)))
+
   def generate(self,
                outputDir: str,
                namespace='yateto',
                gemm_cfg: GeneratorCollection = None,
                cost_estimator=BoundingBoxCostEstimator,
-               include_tensors=set()):
+               include_tensors=set(),
+               search_strategy=None,
+               jobs=None,
+               plan_cache=None,
+               gemm_cache=None,
+               shards=1,
+               shard_by='kernel',
+               write_if_changed=False,
+               unit_tests=True,
+               fold_constants=False,
+               autotune=None,
+               profile=None):
+    """Generates the kernels into outputDir.
+
+    unit_tests may be True (generate the unit tests), False (skip the unit tests and
+    the preparation thereof), or 'deferred' (prepare the unit tests, which are written
+    by a later call of generateUnitTests).
+
+    shards > 1 splits the kernels and routines into the translation units name.cpp,
+    name_1.cpp, ..., grouped by kernel or namespace (shard_by). Shards left over from
+    an earlier run with more shards are removed.
+
+    If profile is given, wall time and calls of all phases are recorded. profile may be
+    True (print a report), a file name (write a report, or a Chrome trace if the name
+    ends with .json), or a Profiler; Profiler(memory=True) records peak memory, too.
+    With profiling, the statistics of the sparsity pattern cache are printed as well.
+
+    cost_estimator is a CostEstimator class from ast.cost, which scores contraction
+    orders. BoundingBoxCostEstimator counts flops; RooflineCostEstimator estimates
+    the run time including memory traffic with the parameters of the architecture.
+
+    search_strategy selects the contraction order search, e.g. opt.BranchAndBound with
+    a budget or opt.Greedy; the default is opt.DynamicProgramming. A dict selects the
+    strategy per kernel or family name. The work of the search is recorded in the
+    searchStatistics attribute of every kernel.
+
+    If fold_constants is true, compute constant operands of Einsums and Adds of
+    CPU kernels are replaced by precomputed constant tensors, which are named
+    <operands>_folded<n> (see ast.transformer.FoldConstants). Their values are
+    emitted in init.cpp, and the kernels point to them by default, hence the
+    caller does not need to set folded tensors.
+
+    autotune is an autotune.Autotuner, or the file name of its tuning database, which
+    selects the contraction order of every Einsum of the kernels by compiling and timing
+    variants on this machine. The selection overrides search_strategy for the tuned kernels.
+    """
+    args = (outputDir, namespace, gemm_cfg, cost_estimator, search_strategy, include_tensors, jobs,
+            plan_cache, gemm_cache, shards, shard_by, write_if_changed, unit_tests, fold_constants, autotune)
+    if not profile:
+      self._generate(*args)
+      return
+
+    profiler = profile if isinstance(profile, Profiler) else Profiler()
+    with profiler:
+      with profiling.profile('generate'):
+        self._generate(*args)
+    if isinstance(profile, str):
+      profiler.dump(profile)
+    elif profile is True:
+      print(profiler.report())
+
+  def generateUnitTests(self, outputDir: str, namespace='yateto', gemm_cfg: GeneratorCollection = None, write_if_changed=False):
+    """Writes the unit tests after generate(..., unit_tests='deferred')."""
+    if not all(kernel.unitTestCfg is not None for kernel in self.kernels()):
+      raise RuntimeError('Unit tests are not prepared, call generate with unit_tests=\'deferred\' first.')
+    if not gemm_cfg:
+      gemm_cfg = DefaultGeneratorCollection(self._arch)
+    self._generateUnitTests(outputDir, namespace, gemm_cfg, write_if_changed)
+
+  def _generateUnitTests(self, outputDir, namespace, gemm_cfg, write_if_changed):
+    fUTdoctest = self.FileNames(outputDir, self.DOCTEST_FILE_NAME)
+    fUTcxxtest = self.FileNames(outputDir, self.CXXTEST_FILE_NAME)
+    fKernels = self.FileNames(outputDir, self.KERNELS_FILE_NAME)
+    fInit = self.FileNames(outputDir, self.INIT_FILE_NAME)
+
+    print('Generating unit tests...')
+    with profiling.profile('Generating unit tests'):
+      def unit_test_body(cpp, testFramework):
+          for kernel in self._kernels:
+              UnitTestGenerator(self._arch).generate(cpp, kernel.namespace, kernel.name, kernel.name, kernel.unitTestCfg, gemm_cfg, testFramework)
+          for family in self._kernelFamilies.values():
+              for group, kernel in family.items():
+                  UnitTestGenerator(self._arch).generate(cpp, kernel.namespace, kernel.name, family.name, kernel.unitTestCfg, gemm_cfg, testFramework, group)
+      with Cpp(fUTdoctest.cpp, write_if_changed) as cpp:
+          Doctest().generate(cpp, namespace, fKernels.hName, fInit.hName, unit_test_body)
+      with Cpp(fUTcxxtest.h, write_if_changed) as cpp:
+          with cpp.HeaderGuard(self._headerGuardName(namespace, self.CXXTEST_FILE_NAME.replace('.', '_'))):
+              CxxTest().generate(cpp, namespace, fKernels.hName, fInit.hName, unit_test_body)
+
+  def _generate(self,
+                outputDir,
+                namespace,
+                gemm_cfg,
+                cost_estimator,
+                search_strategy,
+                include_tensors,
+                jobs,
+                plan_cache,
+                gemm_cache,
+                shards,
+                shard_by,
+                write_if_changed,
+                unit_tests,
+                fold_constants,
+                autotune):
 
     if not gemm_cfg:
       gemm_cfg = DefaultGeneratorCollection(self._arch)
+    if shards < 1:
+      raise ValueError(f'Number of shards must be positive: {shards}')
+    if shard_by not in self.SHARD_BY:
+      raise ValueError(f'Unknown shard_by {shard_by}, expected one of {self.SHARD_BY}')
+
+    if unit_tests not in self.UNIT_TESTS:
+      raise ValueError(f'Unknown unit_tests {unit_tests}, expected one of {self.UNIT_TESTS}')
+
+    patternStatistics = (aspp.cache.hits, aspp.cache.misses)
 
     print('Deducing indices...')
-    for kernel in self._kernels:
-      kernel.prepareUntilUnitTest()
-    for family in self._kernelFamilies.values():
-      family.prepareUntilUnitTest()
+    with profiling.profile('Deducing indices'):
+      for kernel in self._kernels:
+        kernel.prepareUntilUnitTest(False)
+      for family in self._kernelFamilies.values():
+        family.prepareUntilUnitTest(False)
+      if fold_constants:
+        foldConstants = FoldConstants()
+        for kernel in self.kernels():
+          # Folded values live in host memory
+          if kernel.target == 'cpu':
+            kernel.ast = [foldConstants.visit(ast) for ast in kernel.ast]
+      kernels = {kernel.name: kernel for kernel in self.kernels()}
+      for name, kernelNames in self._sharedIntermediates:
+        _ShareIntermediates(name, [kernels[kernelName] for kernelName in kernelNames]).apply()
+      if unit_tests is not False:
+        for kernel in self.kernels():
+          kernel.prepareUnitTest(copyAst=unit_tests == 'deferred')
 
-    fUTdoctest = self.FileNames(outputDir, self.DOCTEST_FILE_NAME)
-    fUTcxxtest = self.FileNames(outputDir, self.CXXTEST_FILE_NAME)
     fKernels = self.FileNames(outputDir, self.KERNELS_FILE_NAME)
     fRoutines = self.FileNames(outputDir, self.ROUTINES_FILE_NAME)
     fGpulikeRoutines = self.FileNames(outputDir, self.GPULIKE_ROUTINES_FILE_NAME)
     fTensors = self.FileNames(outputDir, self.TENSORS_FILE_NAME)
     fInit = self.FileNames(outputDir, self.INIT_FILE_NAME)
 
-    print('Generating unit tests...')
-    def unit_test_body(cpp, testFramework):
-        for kernel in self._kernels:
-            UnitTestGenerator(self._arch).generate(cpp, kernel.namespace, kernel.name, kernel.name, kernel.cfg, gemm_cfg, testFramework)
-        for family in self._kernelFamilies.values():
-            for group, kernel in family.items():
-                UnitTestGenerator(self._arch).generate(cpp, kernel.namespace, kernel.name, family.name, kernel.cfg, gemm_cfg, testFramework, group)
-    with Cpp(fUTdoctest.cpp) as cpp:
-        Doctest().generate(cpp, namespace, fKernels.hName, fInit.hName, unit_test_body)
-    with Cpp(fUTcxxtest.h) as cpp:
-        with cpp.HeaderGuard(self._headerGuardName(namespace, self.CXXTEST_FILE_NAME.replace('.', '_'))):
-            CxxTest().generate(cpp, namespace, fKernels.hName, fInit.hName, unit_test_body)
+    if unit_tests is True:
+      self._generateUnitTests(outputDir, namespace, gemm_cfg, write_if_changed)
 
 
     print('Optimizing ASTs...')
-    for kernel in self._kernels:
-      print(kernel.name)
-      kernel.prepareUntilCodeGen(cost_estimator)
-    for family in self._kernelFamilies.values():
-      print(family.name)
-      family.prepareUntilCodeGen(cost_estimator)
+    with profiling.profile('Optimizing ASTs'):
+      jobs = self.numJobs(jobs)
+      if isinstance(plan_cache, str):
+        plan_cache = PlanCache(plan_cache)
+      if isinstance(autotune, str):
+        autotune = Autotuner(autotune)
+      if autotune is not None:
+        search_strategy = autotune.searchStrategy(self, cost_estimator, search_strategy, gemm_cfg)
+      self._prepareUntilCodeGen(cost_estimator, search_strategy, jobs, plan_cache)
 
 
     # Create mapping from namespace to kernel/family
@@ -321,62 +759,106 @@ class Generator(object):
         kernel_family_dict[family.namespace] = [family]
 
     print('Generating kernels...')
-    cache = RoutineCache()
-    optKernelGenerator = OptimisedKernelGenerator(self._arch, cache)
-
-    kernelSource = StringIO()
-    kernelSourceContent = ''
-    with Cpp(kernelSource) as cpp:
-      cpp.includeSys('cassert')
-      cpp.includeSys('cstring')
-      cpp.includeSys('cstdlib')
-      cpp.includeSys('limits')
-
-      cpp.include(fRoutines.hName)
-      with Cpp(fKernels.h) as header:
+    with profiling.profile('Generating kernels'):
+      if isinstance(gemm_cache, str):
+        gemm_cache = MicrokernelCache(gemm_cache)
+      cache = RoutineCache(gemm_cache)
+      optKernelGenerator = OptimisedKernelGenerator(self._arch, cache)
+
+      # Every kernel and family is rendered separately such that kernels may be distributed over shards
+      kernelSources = list()
+      sourceIndent = len(namespace.split('::')) if namespace else 0
+
+      with Cpp(fKernels.h, write_if_changed) as header:
         with header.HeaderGuard(self._headerGuardName(namespace, self.KERNELS_FILE_NAME)):
           header.includeSys('cmath')
           header.includeSys('limits')
           header.include('yateto.h')
           header.include(fTensors.hName)
-          cpp.include(fKernels.hName)
-          with cpp.Namespace(namespace), header.Namespace(namespace):
+          if fold_constants:
+            header.include(fInit.hName)
+          with header.Namespace(namespace):
               # Group kernels by namespace
               for kernel_namespace, kernels in kernel_dict.items():
                 for kernel in kernels:
-                  kernelOutline = optKernelGenerator.generateKernelOutline(kernel.nonZeroFlops,
-                                                                           kernel.cfg,
-                                                                           gemm_cfg,
-                                                                           kernel.target)
-                  with cpp.Namespace(kernel_namespace), header.Namespace(kernel_namespace):
-                    optKernelGenerator.generate(cpp, header, kernel.name, [kernelOutline])
+                  with profiling.profile('generateKernelOutline', kernel.name):
+                    kernelOutline = optKernelGenerator.generateKernelOutline(kernel.nonZeroFlops,
+                                                                             kernel.cfg,
+                                                                             gemm_cfg,
+                                                                             kernel.target)
+                  source = StringIO()
+                  with Cpp(source) as cpp:
+                    cpp.indent = sourceIndent
+                    with cpp.Namespace(kernel_namespace), header.Namespace(kernel_namespace):
+                      optKernelGenerator.generate(cpp, header, kernel.name, [kernelOutline])
+                    kernelSources.append((kernel_namespace, source.getvalue()))
 
               # Group families by namespace
               for family_namespace, families in kernel_family_dict.items():
                 for family in families:
                   kernelOutlines = [None] * len(family)
                   for group, kernel in family.items():
-                    kernelOutlines[group] = optKernelGenerator.generateKernelOutline(kernel.nonZeroFlops,
-                                                                                     kernel.cfg,
-                                                                                     gemm_cfg,
-                                                                                     kernel.target)
-
-                  with cpp.Namespace(family_namespace), header.Namespace(family_namespace):
-                    optKernelGenerator.generate(cpp, header, family.name, kernelOutlines, family.stride())
-      kernelSourceContent = kernelSource.getvalue()
-
-    with Cpp(fKernels.cpp) as cpp:
-      for gemm_tool in gemm_cfg.selected:
-        for inc in gemm_tool.includes:
-          cpp.include(inc)
-        if isinstance(gemm_tool, BLASlike):
-          cpp(gemm_tool.c_code_init)
-      cpp.out.write(kernelSourceContent)
+                    with profiling.profile('generateKernelOutline', kernel.name):
+                      kernelOutlines[group] = optKernelGenerator.generateKernelOutline(kernel.nonZeroFlops,
+                                                                                       kernel.cfg,
+                                                                                       gemm_cfg,
+                                                                                       kernel.target,
+                                                                                       parameterize=True)
+
+                  source = StringIO()
+                  with Cpp(source) as cpp:
+                    cpp.indent = sourceIndent
+                    with cpp.Namespace(family_namespace), header.Namespace(family_namespace):
+                      optKernelGenerator.generate(cpp, header, family.name, kernelOutlines, family.stride())
+                    kernelSources.append((family_namespace, source.getvalue()))
+
+      if shard_by == 'namespace':
+        units = list(collections.OrderedDict.fromkeys(kernel_namespace for kernel_namespace, source in kernelSources))
+        unitOf = [units.index(kernel_namespace) for kernel_namespace, source in kernelSources]
+      else:
+        unitOf = list(range(len(kernelSources)))
+        units = unitOf
+      weights = [0] * len(units)
+      for unit, (kernel_namespace, source) in zip(unitOf, kernelSources):
+        weights[unit] += source.count('\n')
+      unitShards = shard(weights, shards)
+
+      for i, fileName in enumerate(fKernels.cppShards(shards)):
+        with Cpp(fileName, write_if_changed) as cpp:
+          for gemm_tool in gemm_cfg.selected:
+            for inc in gemm_tool.includes:
+              cpp.include(inc)
+            if isinstance(gemm_tool, BLASlike):
+              if shards > 1 and gemm_tool.c_code_init:
+                # Every shard needs its own definitions
+                with cpp.AnonymousNamespace():
+                  cpp(gemm_tool.c_code_init)
+              else:
+                cpp(gemm_tool.c_code_init)
+          cpp.includeSys('cassert')
+          cpp.includeSys('cstring')
+          cpp.includeSys('cstdlib')
+          cpp.includeSys('limits')
+          cpp.include(fRoutines.hName)
+          cpp.include(fKernels.hName)
+          with cpp.Namespace(namespace):
+            for unit, (kernel_namespace, source) in zip(unitOf, kernelSources):
+              if unitShards[unit] == i:
+                cpp.out.write(source)
 
     print('Calling external code generators...')
-    with Cpp(fRoutines.h) as header:
-      with header.HeaderGuard(self._headerGuardName(namespace, self.ROUTINES_FILE_NAME)):
-        cache.generate(header, fRoutines.cpp, fGpulikeRoutines.cpp)
+    with profiling.profile('Calling external code generators'):
+      with Cpp(fRoutines.h, write_if_changed) as header:
+        with header.HeaderGuard(self._headerGuardName(namespace, self.ROUTINES_FILE_NAME)):
+          cache.generate(header, fRoutines.cppShards(shards), fGpulikeRoutines.cppShards(shards), write_if_changed, jobs)
+      for fileNames in [fKernels, fRoutines, fGpulikeRoutines]:
+        fileNames.removeStaleShards(shards)
+    if gemm_cache is not None:
+      print('GEMM cache: {} hits, {} misses'.format(gemm_cache.hits, gemm_cache.misses))
+    if profiling.active() is not None:
+      print('Pattern cache: {} hits, {} misses, {} entries in {:.1f} MiB'.format(aspp.cache.hits - patternStatistics[0],
+                                                                              aspp.cache.misses - patternStatistics[1],
+                                                                              len(aspp.cache), aspp.cache.bytes / 2**20))
 
     # Mapping basename -> tensor
     tensors = dict()
@@ -396,27 +878,28 @@ class Generator(object):
         tensors_dict[''].update( FindTensors().visit(kernel.ast) )
 
     print('Generating initialization code...')
-    # Sort order: Namespace, base name of group, idx of tensor in group
-    sort_key = lambda x: (x.namespace, x.name())
-    initGen = InitializerGenerator(self._arch, sorted(tensors.values(), key=sort_key))
-    with Cpp(fTensors.h) as header:
-      with header.HeaderGuard(self._headerGuardName(namespace, self.TENSORS_FILE_NAME)):
-        with header.Namespace(namespace):
-          initGen.generateTensorsH(header)
-    with Cpp(fTensors.cpp) as cpp:
-      cpp.include(fTensors.hName)
-      with cpp.Namespace(namespace):
-        initGen.generateTensorsCpp(cpp)
-    with Cpp(fInit.h) as header:
-      with header.HeaderGuard(self._headerGuardName(namespace, self.INIT_FILE_NAME)):
-        header.include(fTensors.hName)
-        header.include(self.SUPPORT_LIBRARY_HEADER)
-        with header.Namespace(namespace):
-          initGen.generateInitH(header)
-    with Cpp(fInit.cpp) as cpp:
-      cpp.include(fInit.hName)
-      with cpp.Namespace(namespace):
-        initGen.generateInitCpp(cpp)
+    with profiling.profile('Generating initialization code'):
+      # Sort order: Namespace, base name of group, idx of tensor in group
+      sort_key = lambda x: (x.namespace, x.name())
+      initGen = InitializerGenerator(self._arch, sorted(tensors.values(), key=sort_key))
+      with Cpp(fTensors.h, write_if_changed) as header:
+        with header.HeaderGuard(self._headerGuardName(namespace, self.TENSORS_FILE_NAME)):
+          with header.Namespace(namespace):
+            initGen.generateTensorsH(header)
+      with Cpp(fTensors.cpp, write_if_changed) as cpp:
+        cpp.include(fTensors.hName)
+        with cpp.Namespace(namespace):
+          initGen.generateTensorsCpp(cpp)
+      with Cpp(fInit.h, write_if_changed) as header:
+        with header.HeaderGuard(self._headerGuardName(namespace, self.INIT_FILE_NAME)):
+          header.include(fTensors.hName)
+          header.include(self.SUPPORT_LIBRARY_HEADER)
+          with header.Namespace(namespace):
+            initGen.generateInitH(header)
+      with Cpp(fInit.cpp, write_if_changed) as cpp:
+        cpp.include(fInit.hName)
+        with cpp.Namespace(namespace):
+          initGen.generateInitCpp(cpp)
 
 
 class NamespacedGenerator(object):
@@ -6,13 +6,14 @@ from .memory import CSCMemoryLayout, DenseMemoryLayout
 from . import aspp
 from .util import create_collection
 
-import importlib.util
-lxmlSpec = importlib.util.find_spec('lxml')
-etreeSpec = importlib.util.find_spec('lxml.etree') if lxmlSpec else None
-if etreeSpec:
-  etree = etreeSpec.loader.load_module()
-else:
-  etree = importlib.util.find_spec('xml.etree.ElementTree').loader.load_module()
+from . import optional
+
+def _etree():
+  # lxml is preferred but only imported once an XML file is parsed
+  etree = optional.load('lxml.etree')
+  if etree is None:
+    import xml.etree.ElementTree as etree
+  return etree
 
 def __transposeMatrix(matrix):
   matrixT = dict()
@@ -70,7 +71,7 @@ def __complain(child):
   raise ValueError('Unknown tag ' + child.tag)
 
 def parseXMLMatrixFile(xmlFile, clones=dict(), transpose=lambda name: False, alignStride=lambda name: False, namespace=None):
-  tree = etree.parse(xmlFile)
+  tree = _etree().parse(xmlFile)
   root = tree.getroot()
   
   matrices = dict()
@@ -111,7 +112,7 @@ def parseJSONMatrixFile(jsonFile, clones=dict(), transpose=lambda name: False, a
   return create_collection(matrices)
 
 def memoryLayoutFromFile(xmlFile, db, clones):
-  tree = etree.parse(xmlFile)
+  tree = _etree().parse(xmlFile)
   root = tree.getroot()
   strtobool = ['yes', 'true', '1']
   groups = dict()
@@ -329,3 +329,6 @@ class CSCMemoryLayout(MemoryLayout):
 
   def __eq__(self, other):
     return self._bbox == other._bbox and np.array_equal(self._rowIndex, other._rowIndex) and np.array_equal(self._colPtr, other._colPtr)
+
+  def __str__(self):
+    return '{}(shape: {}, bounding box: {}, row index: {}, column pointer: {})'.format(type(self).__name__, self._shape, self._bbox, self._rowIndex.tolist(), self._colPtr.tolist())
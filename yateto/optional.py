@@ -0,0 +1,18 @@
+import functools
+import importlib
+import importlib.util
+
+# Optional modules (matplotlib, gemmforge, chainforge, lxml) are expensive to import,
+# hence they are only imported when they are used for the first time.
+
+@functools.lru_cache(maxsize=None)
+def isAvailable(name):
+  """True if the module name is installed; only the top-level package is searched, i.e. nothing is imported."""
+  return importlib.util.find_spec(name.split('.')[0]) is not None
+
+@functools.lru_cache(maxsize=None)
+def load(name):
+  """Imports the module name on first use; returns None if it is not installed."""
+  if not isAvailable(name):
+    return None
+  return importlib.import_module(name)
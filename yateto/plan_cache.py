@@ -0,0 +1,46 @@
+import hashlib
+import os
+from .disk_cache import DiskCache
+from .memory import DenseMemoryLayout
+
+class PlanCache(DiskCache):
+  """On-disk cache of optimized kernels.
+
+  A plan consists of the optimized ASTs, the control flow graph, the number of
+  non-zero flops, and the search statistics of a kernel. Plans are stored in one file per kernel and are keyed
+  by a hash over the kernel's signature, the architecture, the cost estimator,
+  the search strategy, and the sources of yateto itself, such that any change invalidates the plan.
+  """
+  FILE_SUFFIX = '.plan'
+  _sourceDigest = None
+
+  @classmethod
+  def sourceDigest(cls):
+    if cls._sourceDigest is None:
+      sha = hashlib.sha256()
+      root = os.path.dirname(os.path.abspath(__file__))
+      for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fileName in sorted(filenames):
+          if fileName.endswith('.py'):
+            path = os.path.join(dirpath, fileName)
+            sha.update(os.path.relpath(path, root).encode())
+            with open(path, 'rb') as f:
+              sha.update(f.read())
+      cls._sourceDigest = sha.hexdigest()
+    return cls._sourceDigest
+
+  @staticmethod
+  def _archSignature(arch):
+    return sorted((key, repr(value)) for key, value in vars(arch).items()) if arch is not None else None
+
+  def key(self, kernelSignature, arch, costEstimator, searchStrategy=None):
+    estimatorName = '{}.{}'.format(getattr(costEstimator, '__module__', ''),
+                                   getattr(costEstimator, '__qualname__', repr(costEstimator)))
+    signature = (self.sourceDigest(),
+                 kernelSignature,
+                 self._archSignature(arch),
+                 self._archSignature(DenseMemoryLayout.ALIGNMENT_ARCH),
+                 estimatorName,
+                 repr(searchStrategy))
+    return hashlib.sha256(repr(signature).encode()).hexdigest()
@@ -0,0 +1,160 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+Event = collections.namedtuple('Event', ['name', 'kernel', 'start', 'duration', 'peakMemory', 'pid', 'tid', 'nested'])
+
+_active = None
+
+def active():
+  return _active
+
+@contextlib.contextmanager
+def _nothing():
+  yield
+
+def profile(name, kernel=None):
+  """Records the enclosed code as phase name of kernel in the active profiler, if any."""
+  if _active is None:
+    return _nothing()
+  return _active.phase(name, kernel)
+
+class Profiler(object):
+  """Records wall time, number of calls, and peak memory of the phases of the generator.
+
+  Peak memory is the maximum amount of memory allocated by Python within a phase on top
+  of the memory allocated when the phase started, as reported by tracemalloc. It is only
+  recorded on the main thread, if memory is true, and with Python 3.9 or newer (which
+  provides tracemalloc.reset_peak). Memory tracking is off by default, as tracemalloc
+  slows down the generator considerably.
+  Usage:
+    with Profiler() as profiler:
+      ...
+    print(profiler.report())
+  """
+  def __init__(self, memory=False):
+    self.memory = memory and hasattr(tracemalloc, 'reset_peak')
+    self.events = list()
+    self._origin = time.perf_counter()
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._previous = None
+    self._startedTracing = False
+
+  def __enter__(self):
+    global _active
+    self._previous = _active
+    _active = self
+    if self.memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self._startedTracing = True
+    return self
+
+  def __exit__(self, type, value, traceback):
+    global _active
+    _active = self._previous
+    if self._startedTracing:
+      tracemalloc.stop()
+      self._startedTracing = False
+
+  def _stack(self):
+    if not hasattr(self._local, 'stack'):
+      self._local.stack = list()
+    return self._local.stack
+
+  @contextlib.contextmanager
+  def phase(self, name, kernel=None):
+    stack = self._stack()
+    # Nested phases of the same kernel are not counted twice in the kernel summary
+    nested = kernel is not None and any(frame[0] == kernel for frame in stack)
+    traceMemory = self.memory and tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+    if traceMemory:
+      # The peak is reset for every phase, hence the enclosing phase remembers its peak so far
+      current, peak = tracemalloc.get_traced_memory()
+      if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+      tracemalloc.reset_peak()
+    frame = [kernel, current if traceMemory else 0]
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      duration = time.perf_counter() - start
+      stack.pop()
+      peakMemory = None
+      if traceMemory:
+        peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+        if stack:
+          stack[-1][1] = max(stack[-1][1], peak)
+        peakMemory = peak - current
+      self.record(Event(name, kernel, start, duration, peakMemory, os.getpid(), threading.get_ident(), nested))
+
+  def record(self, event):
+    with self._lock:
+      self.events.append(event)
+
+  def merge(self, events):
+    """Adds events recorded by another process."""
+    with self._lock:
+      self.events.extend(events)
+
+  @staticmethod
+  def _summarize(events, key):
+    summary = collections.OrderedDict()
+    for event in events:
+      k = key(event)
+      calls, duration, peakMemory = summary.get(k, (0, 0.0, None))
+      if event.peakMemory is not None:
+        peakMemory = max(peakMemory or 0, event.peakMemory)
+      summary[k] = (calls + 1, duration + event.duration, peakMemory)
+    return sorted(summary.items(), key=lambda item: -item[1][1])
+
+  @staticmethod
+  def _table(title, rows):
+    width = max([len(title)] + [len(name) for name, _ in rows])
+    lines = ['{:<{width}}  {:>8}  {:>12}  {:>12}'.format(title, 'Calls', 'Time [s]', 'Peak [MiB]', width=width)]
+    for name, (calls, duration, peakMemory) in rows:
+      peak = '{:.2f}'.format(peakMemory / 2**20) if peakMemory is not None else '-'
+      lines.append('{:<{width}}  {:>8}  {:>12.4f}  {:>12}'.format(name, calls, duration, peak, width=width))
+    return lines
+
+  def report(self):
+    """Returns a report of all phases and of all kernels, sorted by decreasing time."""
+    phases = self._summarize(self.events, lambda event: event.name)
+    kernels = self._summarize([event for event in self.events if event.kernel is not None and not event.nested],
+                              lambda event: event.kernel)
+    return '\n'.join(self._table('Phase', phases) + [''] + self._table('Kernel or routine', kernels)) + '\n'
+
+  def chromeTrace(self):
+    """Returns the events in the Chrome trace event format (chrome://tracing, Perfetto)."""
+    traceEvents = list()
+    for event in self.events:
+      args = dict()
+      if event.kernel is not None:
+        args['kernel'] = event.kernel
+      if event.peakMemory is not None:
+        args['peakMemory'] = event.peakMemory
+      traceEvents.append({
+        'name': event.name if event.kernel is None else '{} {}'.format(event.name, event.kernel),
+        'cat': 'kernel' if event.kernel is not None else 'generator',
+        'ph': 'X',
+        'ts': (event.start - self._origin) * 1e6,
+        'dur': event.duration * 1e6,
+        'pid': event.pid,
+        'tid': event.tid,
+        'args': args
+      })
+    return {'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}
+
+  def dump(self, fileName):
+    """Writes a Chrome trace if fileName ends with .json and the report otherwise."""
+    with open(fileName, 'w') as f:
+      if fileName.endswith('.json'):
+        json.dump(self.chromeTrace(), f)
+      else:
+        f.write(self.report())
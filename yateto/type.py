@@ -20,6 +20,12 @@ class Scalar(AbstractType):
       raise ValueError('Scalar name invalid (must match regexp {}): {}'.format(self.VALID_NAME, name))
 
     self._name = name
+
+  def __eq__(self, other):
+    return isinstance(other, Scalar) and self._name == other._name
+
+  def __hash__(self):
+    return hash(self._name)
   
   def __str__(self):
     return self._name
@@ -151,6 +157,28 @@ class Tensor(AbstractType):
         A[multiIndex] = value
     return A
 
+  def signature(self, group=True, values=True):
+    """Hashable description of all properties of the tensor that enter code generation.
+
+    Args:
+      group (bool): If false, the tensor is identified by its base name only
+      values (bool): If false, only constness of the values is taken into account
+
+    Returns:
+      tuple: signature of the tensor
+    """
+    if values:
+      valueSignature = sorted((entry, str(value)) for entry, value in self._values.items()) if self._values else None
+    else:
+      valueSignature = self.is_compute_constant()
+    return (self.namespace,
+            self._name if group else self.baseName(),
+            self._shape,
+            self._spp.digest(),
+            self._groupSpp.digest(),
+            str(self._memoryLayout),
+            valueSignature)
+
   def is_compute_constant(self):
     """Tells whether both values and sparsity pattern were provided.
 
@@ -175,6 +203,14 @@ class Tensor(AbstractType):
   def __str__(self):
     return '{}: {}'.format(self._name, self._shape)
 
+class FoldedTensor(Tensor):
+  """Constant tensor which is computed by ast.transformer.FoldConstants.
+
+  Kernels point to the values of the tensor in the init code by default, hence,
+  unlike other tensors, folded tensors need not be set by the caller.
+  """
+  pass
+
 class Collection(object):
   def update(self, collection):
     self.__dict__.update(collection.__dict__)